@@ -5,7 +5,10 @@ import pandas as pd
 import numpy as np
 import re
 import os
+import sys
+import glob
 import json
+import hashlib
 import tqdm
 import itertools
 from functools import reduce
@@ -26,45 +29,119 @@ from Bio import SeqIO
 
 from sklearn.metrics import roc_curve, auc
 
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.realpath(__file__)), '..', '..'))
+import cotr_io
+
+
+def _cached(loader, path, cache_dir, *args):
+    """loader(path, *args), pickled in cache_dir (a sidecar named by the file,
+    its hash, the loader and its arguments) and reused while the file is unchanged
+
+    cache_dir None, or a path that is not a local file: no cache"""
+    if cache_dir is None or not os.path.isfile(path):
+        return loader(path, *args)
+    prefix = os.path.join(cache_dir, os.path.basename(path))
+    extra = [cotr_io.file_key(a) if isinstance(a, str) and os.path.isfile(a) else a for a in args]
+    key = cotr_io.file_key(path)
+    if args:
+        key += '.' + hashlib.blake2b(json.dumps(extra).encode(), digest_size=4).hexdigest()
+    sidecar = f'{prefix}.{key}.{loader.__name__}.pkl'
+    if os.path.isfile(sidecar):
+        return pd.read_pickle(sidecar)
+    df = loader(path, *args)
+    try:
+        df.to_pickle(f'{sidecar}.{os.getpid()}.tmp')
+        os.replace(f'{sidecar}.{os.getpid()}.tmp', sidecar)
+    except OSError as e: # read-only directory: no cache
+        print(f"{loader.__name__} cache not written: {e}")
+        return df
+    for stale in glob.glob(f'{glob.escape(prefix)}.*.{loader.__name__}.pkl'):
+        if stale != sidecar:
+            os.remove(stale)
+    return df
 
-def transitionstoogs(transitions_file):
-    
-    transitions = pd.read_table(transitions_file)
-    transitions['og1name'] = transitions['ognames'].apply(lambda x: x.split(' --- ')[0])
-    transitions['og2name'] = transitions['ognames'].apply(lambda x: x.split(' --- ')[1])
-    transitions = transitions.drop('ognames', axis=1)
-
-    ogs = pd.concat([transitions[['Orthogroup1','k_score','p','p.adj','og1name']
-                          ].rename(columns={'Orthogroup1':'og','og1name':'ogname'}),
-               transitions[['Orthogroup2','k_score','p','p.adj','og2name']
-                          ].rename(columns={'Orthogroup2':'og','og2name':'ogname'})]
-             )
-
-    ogs['p'] = ogs['p'].astype(float)
-    ogs['k_score'] = ogs['k_score'].astype(float)
-    ogs['p.adj'] = ogs['p.adj'].astype(float)
-    ogs = ogs.sort_values('p.adj').drop_duplicates('og')
+
+def _transitions(transitions_file, csv_file=None):
+    """og, k_score, p, p.adj, ogname of the pair with the lowest p.adj of every
+    orthogroup, by increasing p.adj"""
+    columns = ['Orthogroup1', 'Orthogroup2', 'k_score', 'p', 'p.adj']
+    if os.path.isdir(transitions_file): # binary pair table (cotr_transitions.py --fisher -o DIR)
+        transitions = cotr_io.pairs_frame(transitions_file, ['i', 'j'] + columns[2:])
+        ognames = pd.Series(dtype=object)
+        if csv_file is not None: # pairs with both names, as the ognames column of the notebook
+            ognames = pd.read_table(csv_file, usecols=['Orthogroup', 'Description'],
+                                    dtype=str).set_index('Orthogroup')['Description']
+            named = transitions['Orthogroup1'].isin(ognames.index) & transitions['Orthogroup2'].isin(ognames.index)
+            transitions = transitions[named.values]
+    else:
+        dtypes = dict.fromkeys(columns[:2] + ['ognames'], object) | dict.fromkeys(columns[2:], float)
+        transitions = pd.read_table(transitions_file, usecols=list(dtypes), dtype=dtypes)
+
+    n = len(transitions)
+    og = np.concatenate([transitions['Orthogroup1'].to_numpy(dtype=object),
+                         transitions['Orthogroup2'].to_numpy(dtype=object)])
+    codes, _ = pd.factorize(og)
+    padj = np.tile(transitions['p.adj'].to_numpy(dtype=float), 2)
+    valid = np.flatnonzero(~np.isnan(padj)) # order of sort_values('p.adj'): ties as its quicksort, NaN last
+    order = np.concatenate([valid[np.argsort(padj[valid], kind='quicksort')], np.flatnonzero(np.isnan(padj))])
+    _, first = np.unique(codes[order], return_index=True)
+    rows = order[np.sort(first)]
+    row = rows % n
+
+    ogs = pd.DataFrame({'og': og[rows]})
+    for c in ['k_score', 'p', 'p.adj']:
+        ogs[c] = transitions[c].to_numpy(dtype=float)[row]
+    if 'ognames' in transitions:
+        names = transitions['ognames'].to_numpy(dtype=object)[row]
+        names = pd.Series(names).str.split(' --- ', n=2, expand=True).reindex(columns=[0, 1])
+        ogs['ogname'] = np.where(rows < n, names[0], names[1])
+    else:
+        ogs['ogname'] = ogs['og'].map(ognames).to_numpy(dtype=object) if len(ognames) else None
+    return ogs
+
+
+def transitionstoogs(transitions_file, csv_file=None, cache_dir=None):
+    """orthogroups of the transitions (k_score > 0) with their best pair (lowest p.adj)
+
+    transitions_file: .transitions.annotated table with the ognames column, or
+    binary pair table (names from the Description column of csv_file);
+    cache_dir: keep the table of the orthogroups of a text table there (e.g. '.'),
+    reused while the file is unchanged"""
+    ogs = _cached(_transitions, transitions_file, cache_dir, csv_file)
     
     ogs = ogs[ogs['k_score']>0]
     
     return ogs
 
-def clustersfromraw(clusters_raw_file, transitions_file):
 
-    df = pd.read_table(clusters_raw_file, header=None)
-    df = pd.DataFrame(list(zip(df.index.tolist(), df.values.tolist()))).explode([1]).dropna()
-    n = dict(df.groupby(0)[1].count().reset_index().values)
-    df['n'] = df[0].apply(lambda x: n.get(x))
+def _lines(path):
+    """lines of a text file as a Series (as readlines, without the newlines)"""
+    with open(path) as f:
+        lines = f.read().split('\n')
+    return pd.Series(lines[:-1] if lines[-1] == '' else lines, dtype=object)
+
 
-    trans = transitionstoogs(transitions_file)
-    ognames = dict(trans[['og','ogname']].values)
-    df['ogname'] = df[1].apply(lambda x: ognames.get(x))
+def _rawclusters(clusters_raw_file):
+    """(cluster, og) of the tab-separated orthogroups of the clusters (one per line)"""
+    lines = _lines(clusters_raw_file)
+    lines = lines[lines.str.strip() != '']
+    df = lines.str.split('\t').explode()
+    df = df[df != '']
+    return pd.DataFrame({'cluster': df.index.values, 'og': df.values})
+
+
+def clustersfromraw(clusters_raw_file, transitions_file, cache_dir=None):
+
+    df = _cached(_rawclusters, clusters_raw_file, cache_dir)
+    df['n'] = df.groupby('cluster')['og'].transform('size')
+
+    trans = transitionstoogs(transitions_file, cache_dir=cache_dir)
+    df['name'] = df['og'].map(trans.set_index('og')['ogname'])
 
     # aggiungi le righe per gli score e le transitions dalle transitions
     df['score'] = ''
     df['transition'] = ''
 
-    df.columns = ['cluster','og','n','name','score','transition']
     df = df[['cluster','score','transition','n','og','name']]
     df = df[df['n']>1]
 
@@ -107,14 +184,25 @@ def scalepval(df, col, minrange, maxrange):
     
     return final2
 
-def clustersfromann(clusters_file, level):
-    
-    clusters = pd.DataFrame(itertools.chain.from_iterable(map(lambda y: list(map(lambda x: [y[0]]+ x.split(f'{level}:')+[y[1].split(':')[0]],':'.join(y[1].split(':')[1:]).strip().strip(' ###').split(' ### '))),
-                                                              enumerate(open(clusters_file).readlines())))).dropna(subset=[3])
+def _annclusters(clusters_file, level):
+    """(cluster, og, name, feat) of the members of the annotated clusters"""
+    lines = _lines(clusters_file)
+    lines = lines.str.partition(':')
+    members = lines[2].str.strip().str.strip(' ###').str.split(' ### ').explode()
+    members = members.str.split(f'{level}:', n=1, expand=True).reindex(columns=[0, 1])
+    clusters = members.assign(feat=lines[0].reindex(members.index)).dropna(subset=[1])
+    clusters.index.name = 'cluster'
+    clusters = clusters.reset_index()
     clusters.columns = ['cluster','og', 'name', 'feat']
-    clusters[['score', 'transition', 'n']] = clusters['feat'].str.split(' ', expand=True)
-    clusters['n'] = clusters['n'].apply(lambda x: x.strip('(').strip(')'))
+    return clusters
+
+
+def clustersfromann(clusters_file, level, cache_dir=None):
+    
+    clusters = _cached(_annclusters, clusters_file, cache_dir, level)
+    clusters[['score', 'transition', 'n']] = clusters['feat'].str.split(' ', n=2, expand=True)
+    clusters['n'] = clusters['n'].str.strip('(').str.strip(')')
     clusters['og'] = clusters['og']+level
     # clusters[['cluster', 'score', 'transition', 'n', 'og', 'name']].to_csv('Eukaryota_cluster.tsv', sep='\t', index=False)
     clusters = clusters[['cluster', 'score', 'transition', 'n', 'og', 'name']]
-    return clusters
\ No newline at end of file
+    return clusters
@@ -1,34 +1,49 @@
 #!/usr/bin/env python3
 
+import io
+import argparse
 import pandas as pd
-import json, urllib
-import tqdm, sys
 
-outfile = 'external/ko_og_pathway.tsv'
-level = sys.argv[1]
+import odbfetch
 
-kegg_ko_reaction = pd.read_table('http://rest.kegg.jp/link/ko/pathway', 
-                                 header=None, names=['reaction', 'ko'])
+parser = argparse.ArgumentParser(description='Orthogroups of the KEGG orthologs of pathways (Orthodb)')
+parser.add_argument('level', help='OrthoDB level (taxid)')
+parser.add_argument('-o', '--output_file', default='external/ko_og_pathway.tsv',
+                    help='output table (default external/ko_og_pathway.tsv)')
+parser.add_argument('-p', '--pool_threads', type=int, default=odbfetch.CONCURRENCY,
+                    help=f'n. of concurrent requests (default {odbfetch.CONCURRENCY})')
+parser.add_argument('--kegg_url', default=odbfetch.KEGG, help=f'KEGG REST server (default {odbfetch.KEGG})')
+parser.add_argument('--kegg_max_age', type=float, default=odbfetch.KEGG_MAX_AGE,
+                    help=f'days a cached KEGG link list is reused (default {odbfetch.KEGG_MAX_AGE}; 0: fetch it again)')
+odbfetch.add_arguments(parser, 'https://www.orthodb.org')
+args = parser.parse_args()
 
-ko_set = {x.split(':')[1] for x in kegg_ko_reaction['ko'].to_list()}
+outfile = args.output_file
+level = args.level
 
-def get_og(ko):
+fetcher = odbfetch.from_args(args, outfile, args.pool_threads)
+kegg = fetcher.fetch([odbfetch.url(args.kegg_url, 'link/ko/pathway')], max_age=args.kegg_max_age * 86400).popitem()[1]
+if kegg is None:
+    raise SystemExit(f'{args.kegg_url}: KEGG pathway links not available')
+kegg_ko_reaction = pd.read_table(io.BytesIO(kegg), header=None, names=['reaction', 'ko'])
+
+ko_set = sorted({x.split(':')[1] for x in kegg_ko_reaction['ko'].to_list()})
+
+def get_og(ko, body):
     try:
-        j = pd.read_table(f"https://www.orthodb.org/tab?query={ko}&level={level}")
-                        
+        j = pd.read_table(io.BytesIO(body))
+
         j = j.groupby('pub_og_id')['og_name'].count().reset_index()
         j.columns = ['og', 'count']
         j['ko'] = ko
         return j[['ko', 'og', 'count']]
-    except:
+    except Exception:
         j = pd.DataFrame([[ko, None, None]])
         j. columns = ['ko', 'og', 'count']
         return j
-    
-for x in tqdm.tqdm(list(ko_set)):
-    if list(ko_set).index(x) == 0:
-        koog = get_og(x)
-        koog.to_csv(outfile, index=False, sep='\t')
-    else:
-        koog = get_og(x)
-        koog.to_csv(outfile, index=False, sep='\t', mode='a', header=False)
+
+bodies = fetcher.fetch(odbfetch.url(args.base_url, 'tab', query=ko, level=level) for ko in ko_set)
+fetcher.cache.close()
+koog = pd.concat([get_og(ko, body) for ko, body in zip(ko_set, bodies.values())])
+koog.to_csv(outfile, index=False, sep='\t')
+print(fetcher.stats)
@@ -0,0 +1,156 @@
+#!/usr/bin/env python3
+# coding: utf-8
+#
+# Benchmark of the table loaders of funcs.py (transitionstoogs, clustersfromraw,
+# clustersfromann) against the previous row-wise implementations, on synthetic
+# files with the layout of the notebook inputs: .transitions.annotated with
+# the ognames column, raw MCL clusters and annotated clusters. Times are given
+# without and with the parsed-table cache (second call); the results of the
+# two implementations are checked to be equal.
+#
+# Usage: loaders_benchmark.py [-n PAIRS] [--ogs N] [--clusters N] [-o results.json]
+#
+import argparse
+import itertools
+import json
+import os
+import sys
+import tempfile
+import time
+
+import numpy as np
+import pandas as pd
+
+import funcs
+
+LEVEL = 'at2759'
+
+
+def synthetic_files(directory, npairs, nogs, nclusters, seed=0):
+    """(transitions, raw clusters, annotated clusters) files in directory"""
+    rng = np.random.default_rng(seed)
+    ogs = np.array([f'{x}{LEVEL}' for x in rng.choice(10 * nogs, nogs, replace=False)], dtype=object)
+    names = np.array([f'{w} protein {x}' for w, x in zip(rng.choice(['Kinase', 'ABC transporter', 'Zinc finger',
+                                                                     'Ribosomal', 'Uncharacterized'], nogs),
+                                                         range(nogs))], dtype=object)
+    i, j = rng.integers(0, nogs, (2, npairs))
+    j = np.where(i == j, (j + 1) % nogs, j)
+    p = 10 ** -rng.uniform(1, 40, npairs)
+    transitions = os.path.join(directory, 'intersection.Eukaryota.raxml.RL.transitions.annotated')
+    pd.DataFrame({'Orthogroup1': ogs[i], 'Orthogroup2': ogs[j], 'orgs': 1000,
+                  't1': rng.integers(10, 200, npairs), 't2': rng.integers(10, 200, npairs),
+                  'c': rng.integers(5, 100, npairs), 'd': rng.integers(0, 20, npairs),
+                  'k': rng.integers(-20, 100, npairs), 'k_score': rng.uniform(-0.3, 1, npairs).round(5),
+                  'p': p, 'p.adj': np.minimum(1, p * npairs),
+                  'ognames': names[i] + ' --- ' + names[j]}).to_csv(transitions, sep='\t', index=False)
+    sizes = np.sort(rng.zipf(2, nclusters).clip(1, 200))[::-1]
+    members = np.split(rng.permutation(nogs)[:sizes.sum()] if sizes.sum() <= nogs
+                       else rng.integers(0, nogs, sizes.sum()), np.cumsum(sizes)[:-1])
+    raw = os.path.join(directory, 'intersection.Eukaryota.raxml.RL.clusters')
+    with open(raw, 'w') as f:
+        f.writelines('\t'.join(ogs[m]) + '\n' for m in members)
+    annotated = f'{raw}.annotated'
+    with open(annotated, 'w') as f:
+        f.writelines(f'{rng.uniform(0, 1):.5f} {rng.integers(1, 500)} ({len(m)}): '
+                     + ''.join(f'{og}:{name} ### ' for og, name in zip(ogs[m], names[m])) + '\n'
+                     for m in members if len(m) > 1)
+    return transitions, raw, annotated
+
+
+# previous implementations (row-wise), as reference
+
+def reference_transitionstoogs(transitions_file):
+    transitions = pd.read_table(transitions_file)
+    transitions['og1name'] = transitions['ognames'].apply(lambda x: x.split(' --- ')[0])
+    transitions['og2name'] = transitions['ognames'].apply(lambda x: x.split(' --- ')[1])
+    transitions = transitions.drop('ognames', axis=1)
+    ogs = pd.concat([transitions[['Orthogroup1', 'k_score', 'p', 'p.adj', 'og1name']
+                                 ].rename(columns={'Orthogroup1': 'og', 'og1name': 'ogname'}),
+                     transitions[['Orthogroup2', 'k_score', 'p', 'p.adj', 'og2name']
+                                 ].rename(columns={'Orthogroup2': 'og', 'og2name': 'ogname'})])
+    ogs['p'] = ogs['p'].astype(float)
+    ogs['k_score'] = ogs['k_score'].astype(float)
+    ogs['p.adj'] = ogs['p.adj'].astype(float)
+    ogs = ogs.sort_values('p.adj').drop_duplicates('og')
+    return ogs[ogs['k_score'] > 0]
+
+
+def reference_clustersfromraw(clusters_raw_file, transitions_file):
+    df = pd.read_table(clusters_raw_file, header=None)
+    df = pd.DataFrame(list(zip(df.index.tolist(), df.values.tolist()))).explode([1]).dropna()
+    n = dict(df.groupby(0)[1].count().reset_index().values)
+    df['n'] = df[0].apply(lambda x: n.get(x))
+    trans = reference_transitionstoogs(transitions_file)
+    ognames = dict(trans[['og', 'ogname']].values)
+    df['ogname'] = df[1].apply(lambda x: ognames.get(x))
+    df['score'] = ''
+    df['transition'] = ''
+    df.columns = ['cluster', 'og', 'n', 'name', 'score', 'transition']
+    df = df[['cluster', 'score', 'transition', 'n', 'og', 'name']]
+    return df[df['n'] > 1]
+
+
+def reference_clustersfromann(clusters_file, level):
+    clusters = pd.DataFrame(itertools.chain.from_iterable(map(
+        lambda y: list(map(lambda x: [y[0]] + x.split(f'{level}:') + [y[1].split(':')[0]],
+                           ':'.join(y[1].split(':')[1:]).strip().strip(' ###').split(' ### '))),
+        enumerate(open(clusters_file).readlines())))).dropna(subset=[3])
+    clusters.columns = ['cluster', 'og', 'name', 'feat']
+    clusters[['score', 'transition', 'n']] = clusters['feat'].str.split(' ', expand=True)
+    clusters['n'] = clusters['n'].apply(lambda x: x.strip('(').strip(')'))
+    clusters['og'] = clusters['og'] + level
+    return clusters[['cluster', 'score', 'transition', 'n', 'og', 'name']]
+
+
+def _same(a, b, by):
+    """equal tables, up to row order and index (values compared as text)"""
+    a, b = (x.astype(str).replace({'None': 'nan'}).sort_values(by).reset_index(drop=True) for x in (a, b))
+    return a.equals(b)
+
+
+def _timed(f, *args, **kwargs):
+    start = time.time()
+    out = f(*args, **kwargs)
+    return out, round(time.time() - start, 4)
+
+
+def run(npairs, nogs, nclusters, seed=0):
+    with tempfile.TemporaryDirectory() as tmp:
+        transitions, raw, annotated = synthetic_files(tmp, npairs, nogs, nclusters, seed)
+        cache = os.path.join(tmp, 'cache')
+        os.mkdir(cache)
+        cases = {'transitionstoogs': ((reference_transitionstoogs, transitions),
+                                      (funcs.transitionstoogs, transitions), ['og']),
+                 'clustersfromraw': ((reference_clustersfromraw, raw, transitions),
+                                     (funcs.clustersfromraw, raw, transitions), ['cluster', 'og']),
+                 'clustersfromann': ((reference_clustersfromann, annotated, LEVEL),
+                                     (funcs.clustersfromann, annotated, LEVEL), ['cluster', 'og'])}
+        results = {}
+        for name, (old, new, by) in cases.items():
+            expected, t_old = _timed(*old)
+            got, t_new = _timed(*new)
+            _, t_fill = _timed(*new, cache_dir=cache)
+            cached, t_cached = _timed(*new, cache_dir=cache)
+            results[name] = dict(rows=len(got), previous_s=t_old, vectorized_s=t_new, cache_fill_s=t_fill,
+                                 cached_s=t_cached, speedup=round(t_old / max(t_new, 1e-4), 1),
+                                 speedup_cached=round(t_old / max(t_cached, 1e-4), 1),
+                                 same=_same(expected, got, by) and _same(expected, cached, by))
+            print(name, results[name], file=sys.stderr)
+    return results
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Benchmark of the notebook table loaders (funcs.py)')
+    parser.add_argument('-n', '--pairs', type=int, default=1000000, help='pairs of the transitions table (default 1000000)')
+    parser.add_argument('--ogs', type=int, default=20000, help='orthogroups (default 20000)')
+    parser.add_argument('--clusters', type=int, default=3000, help='clusters (default 3000)')
+    parser.add_argument('--seed', type=int, default=0, help='random seed (default 0)')
+    parser.add_argument('-o', '--output', help='write the results as JSON')
+    args = parser.parse_args()
+
+    results = run(args.pairs, args.ogs, args.clusters, args.seed)
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(dict(pairs=args.pairs, ogs=args.ogs, clusters=args.clusters, results=results), f, indent=1)
+    if not all(r['same'] for r in results.values()):
+        sys.exit('results differ from the previous implementation')
@@ -0,0 +1,209 @@
+# coding: utf-8
+#
+# Concurrent, cached HTTP fetcher for the OrthoDB and KEGG REST APIs (oginfo.py,
+# ko2og.py). An asyncio loop schedules the requests (bounded concurrency,
+# optional rate limit, retries with exponential backoff on connection errors,
+# 429 and 5xx); each request is a blocking http.client call run in a pool of
+# worker threads, over keep-alive connections (one per host and thread), as the
+# standard library has no asynchronous HTTP client. Responses are kept in a
+# SQLite cache as soon as they arrive, so an interrupted or repeated run only
+# fetches the urls still missing (or cached longer ago than max_age).
+#
+# Standard library only; odbmock.py serves the same endpoints locally for
+# offline tests and benchmarks (--base_url).
+#
+import asyncio
+import http.client
+import itertools
+import random
+import sqlite3
+import sys
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from urllib.parse import urlencode, urlsplit
+
+ORTHODB = 'https://v101.orthodb.org'
+KEGG = 'http://rest.kegg.jp'
+CONCURRENCY = 16
+RETRIES = 4
+BACKOFF = 1.0  # seconds before the first retry, doubled at each attempt
+TIMEOUT = 60
+RETRY_STATUS = {429, 500, 502, 503, 504}
+COMMIT_EVERY = 100  # responses written to the cache per transaction
+KEGG_MAX_AGE = 7  # days a cached KEGG link list is reused (it changes with the KEGG releases)
+
+
+def url(base, path, **query):
+    """base/path?query"""
+    return f"{base.rstrip('/')}/{path.lstrip('/')}" + (f"?{urlencode(query)}" if query else '')
+
+
+class Cache:
+    """SQLite store of the responses (status, body) by url
+
+    successes and permanent failures (4xx but 429) are kept, transient ones are
+    not (retried by the next run); path None keeps nothing"""
+
+    def __init__(self, path=None):
+        self.db = sqlite3.connect(path or ':memory:')
+        self.db.execute('PRAGMA journal_mode=WAL')
+        self.db.execute('CREATE TABLE IF NOT EXISTS response '
+                        '(url TEXT PRIMARY KEY, status INTEGER, body BLOB, fetched REAL)')
+        self.pending = 0
+
+    def get(self, key, max_age=None):
+        """(status, body) of url key, None if not cached (or cached more than max_age seconds ago)"""
+        if max_age is None:
+            return self.db.execute('SELECT status, body FROM response WHERE url=?', (key,)).fetchone()
+        return self.db.execute('SELECT status, body FROM response WHERE url=? AND fetched>=?',
+                               (key, time.time() - max_age)).fetchone()
+
+    def put(self, key, status, body):
+        self.db.execute('INSERT OR REPLACE INTO response VALUES (?, ?, ?, ?)', (key, status, body, time.time()))
+        self.pending += 1
+        if self.pending >= COMMIT_EVERY:
+            self.commit()
+
+    def commit(self):
+        self.db.commit()
+        self.pending = 0
+
+    def close(self):
+        self.commit()
+        self.db.close()
+
+
+class Fetcher:
+    """fetch(urls) -> {url: body or None}, through the cache
+
+    concurrency: requests in flight (worker threads running the blocking
+    requests, each with its keep-alive connections); rate: maximum requests
+    started per second (None: no limit)"""
+
+    def __init__(self, cache=None, concurrency=CONCURRENCY, retries=RETRIES, rate=None,
+                 timeout=TIMEOUT, backoff=BACKOFF, progress=True):
+        self.cache = cache if cache is not None else Cache()
+        self.concurrency, self.retries, self.timeout, self.backoff = concurrency, retries, timeout, backoff
+        self.interval = 1 / rate if rate else 0
+        self.progress = progress
+        self.local = threading.local()
+        self.stats = dict(cached=0, fetched=0, failed=0, retries=0)
+
+    def fetch(self, urls, max_age=None):
+        """bodies of the urls (None on failure); cached responses older than
+        max_age seconds are fetched again (None: cached ones never expire)"""
+        urls = list(dict.fromkeys(urls))
+        results = {}
+        missing = []
+        for u in urls:
+            hit = self.cache.get(u, max_age)
+            if hit is None:
+                missing.append(u)
+            else:
+                results[u] = hit[1] if hit[0] == 200 else None
+        self.stats['cached'] += len(results)
+        if missing:
+            try:
+                results.update(asyncio.run(self._fetch_all(missing)))
+            finally:
+                self.cache.commit()
+        return {u: results.get(u) for u in urls}
+
+    async def _fetch_all(self, urls):
+        loop = asyncio.get_running_loop()
+        executor = ThreadPoolExecutor(self.concurrency)
+        self.next_start = time.monotonic()
+        results, pending, todo = {}, set(), iter(urls)
+        shown = 0
+
+        async def one(u):
+            return u, await self._get(loop, executor, u)
+        try:
+            while True:
+                pending.update(asyncio.ensure_future(one(u)) for u in
+                               itertools.islice(todo, self.concurrency - len(pending)))
+                if not pending:
+                    break
+                finished, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+                for task in finished:
+                    u, (status, body) = task.result()
+                    if status is not None and status not in RETRY_STATUS:
+                        self.cache.put(u, status, body)
+                    results[u] = body if status == 200 else None
+                    self.stats['fetched' if status == 200 else 'failed'] += 1
+                if self.progress and (time.time() - shown >= 1 or len(results) == len(urls)):
+                    shown = time.time()
+                    sys.stderr.write(f"\r{len(results)}/{len(urls)} fetched")
+        finally:
+            for task in pending:
+                task.cancel()
+            executor.shutdown(wait=False, cancel_futures=True)
+            if self.progress and results:
+                sys.stderr.write("\n")
+        return results
+
+    async def _get(self, loop, executor, u):
+        """(status, body) after the retries; status None when no response came"""
+        status, body = None, None
+        for attempt in range(self.retries + 1):
+            if attempt:
+                self.stats['retries'] += 1
+            await self._throttle()
+            wait = self.backoff * 2 ** attempt * (0.5 + random.random())
+            try:
+                status, headers, body = await loop.run_in_executor(executor, self._request, u)
+            except (OSError, http.client.HTTPException):
+                status = None
+            else:
+                if status not in RETRY_STATUS:
+                    return status, body
+                retry_after = headers.get('Retry-After', '')
+                wait = float(retry_after) if retry_after.isdigit() else wait
+            if attempt < self.retries:
+                await asyncio.sleep(wait)
+        return status, body
+
+    async def _throttle(self):
+        if self.interval:
+            now = time.monotonic()
+            start, self.next_start = max(now, self.next_start), max(now, self.next_start) + self.interval
+            await asyncio.sleep(start - now)
+
+    def _request(self, u):
+        """GET on the keep-alive connection of this thread to the host of u"""
+        parts = urlsplit(u)
+        conns = self.local.__dict__.setdefault('conns', {})
+        key = (parts.scheme, parts.netloc)
+        conn = conns.get(key)
+        if conn is None:
+            kind = http.client.HTTPSConnection if parts.scheme == 'https' else http.client.HTTPConnection
+            conn = conns[key] = kind(parts.netloc, timeout=self.timeout)
+        try:
+            conn.request('GET', parts.path + (f'?{parts.query}' if parts.query else ''),
+                         headers={'User-Agent': 'cotransitions', 'Accept-Encoding': 'identity'})
+            response = conn.getresponse()
+            body = response.read()
+        except (OSError, http.client.HTTPException):
+            conn.close()
+            del conns[key]
+            raise
+        if response.will_close:
+            conn.close()
+            del conns[key]
+        return response.status, response.headers, body
+
+
+def add_arguments(parser, base_url):
+    """fetcher options of the command line tools"""
+    parser.add_argument('--base_url', default=base_url, help=f'API server (default {base_url})')
+    parser.add_argument('--cache', help='SQLite cache of the responses, reused by later runs '
+                        '(default: output file + .cache.sqlite)')
+    parser.add_argument('--retries', type=int, default=RETRIES, help=f'retries of a request (default {RETRIES})')
+    parser.add_argument('--rate', type=float, help='maximum requests per second (default: no limit)')
+    parser.add_argument('--timeout', type=float, default=TIMEOUT, help=f'seconds per request (default {TIMEOUT})')
+
+
+def from_args(args, output, concurrency):
+    cache = Cache(args.cache or f'{output}.cache.sqlite')
+    return Fetcher(cache, concurrency=concurrency, retries=args.retries, rate=args.rate, timeout=args.timeout)
@@ -0,0 +1,159 @@
+#!/usr/bin/env python3
+# coding: utf-8
+#
+# Local stand-in for the OrthoDB and KEGG endpoints used by oginfo.py and
+# ko2og.py (/group, /tab, /link/ko/pathway), with deterministic made-up
+# content, added latency and random transient failures (503), to test and
+# benchmark odbfetch offline:
+#
+#   odbmock.py --port 8101 --latency 0.05 --fail 0.1     # serve until Ctrl-C
+#   oginfo.py -i ogs.list -o odb.pickle -p 50 --base_url http://127.0.0.1:8101
+#   odbmock.py --benchmark 2000                          # cold vs cached fetch
+#
+import argparse
+import hashlib
+import json
+import os
+import random
+import sys
+import tempfile
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlsplit
+
+import odbfetch
+
+
+def _number(*key):
+    return int.from_bytes(hashlib.blake2b('\t'.join(key).encode(), digest_size=4).digest(), 'little')
+
+
+def group(og):
+    """OrthoDB /group record of og: scalar fields and lists of annotations"""
+    n = _number(og)
+    return {'data': {'id': og, 'name': f'Protein family {n % 997}', 'level_name': 'Eukaryota',
+                     'evolutionary_rate': round(n % 1000 / 500, 3),
+                     'kegg': [{'id': f'K{(n + x) % 25000:05d}', 'name': f'KEGG orthology {(n + x) % 25000}',
+                               'type': 'kegg', 'count': 1 + x} for x in range(n % 3)],
+                     'interpro_domains': [{'id': f'IPR{(n >> 4) % 50000:06d}', 'name': 'domain',
+                                           'type': 'interpro', 'count': n % 40 + 1}]},
+            'url': f'/group?id={og}'}
+
+
+def tab(query, level):
+    """OrthoDB /tab rows (pub_og_id, og_name, ...) of the genes matching query"""
+    n = _number(query, level)
+    rows = ['pub_og_id\tog_name\tlevel_taxid\torganism_taxid\torganism_name\tint_prot_id\tpub_gene_id\tdescription']
+    for g in range(n % 12):
+        og = f'{(n >> 8) % 20000 + g % 3}at{level}'
+        rows.append(f'{og}\tfamily {og}\t{level}\t{9606 + g}_0\torganism {g}\t{g}_0:00{g:04x}\tgene{g}\tprotein')
+    return '\n'.join(rows) + '\n' if len(rows) > 1 else ''
+
+
+def ko_pathways(nko=500, npath=50):
+    """KEGG /link/ko/pathway table"""
+    return ''.join(f'path:map{p:05d}\tko:K{(p * 37 + k) % 25000:05d}\n'
+                   for p in range(npath) for k in range(nko // npath))
+
+
+class MockServer:
+    """threaded HTTP server on 127.0.0.1 (port 0: any free port), as a context manager
+
+    latency: seconds added to every response; fail: fraction of requests
+    answered 503 (with Retry-After 0)"""
+
+    def __init__(self, port=0, latency=0.0, fail=0.0, seed=0):
+        rng, lock = random.Random(seed), threading.Lock()
+        self.requests = 0
+        server = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = 'HTTP/1.1'  # keep-alive
+            disable_nagle_algorithm = True  # headers and body written separately
+
+            def do_GET(self):
+                with lock:
+                    server.requests += 1
+                    failed = rng.random() < fail
+                time.sleep(latency)
+                parts = urlsplit(self.path)
+                query = {k: v[0] for k, v in parse_qs(parts.query).items()}
+                status, body, kind = 200, '', 'text/plain'
+                if failed:
+                    status = 503
+                elif parts.path == '/group' and 'id' in query:
+                    body, kind = json.dumps(group(query['id'])), 'application/json'
+                elif parts.path == '/tab' and 'query' in query:
+                    body = tab(query['query'], query.get('level', ''))
+                elif parts.path == '/link/ko/pathway':
+                    body = ko_pathways()
+                else:
+                    status = 404
+                data = body.encode()
+                self.send_response(status)
+                self.send_header('Content-Type', kind)
+                self.send_header('Content-Length', str(len(data)))
+                if failed:
+                    self.send_header('Retry-After', '0')
+                self.end_headers()
+                self.wfile.write(data)
+
+            def log_message(self, *args):
+                pass
+
+        self.httpd = ThreadingHTTPServer(('127.0.0.1', port), Handler)
+        self.httpd.daemon_threads = True
+        self.url = f'http://127.0.0.1:{self.httpd.server_address[1]}'
+
+    def __enter__(self):
+        threading.Thread(target=self.httpd.serve_forever, daemon=True).start()
+        return self
+
+    def __exit__(self, *exc):
+        self.httpd.shutdown()
+        self.httpd.server_close()
+
+    def serve(self):
+        self.httpd.serve_forever()
+
+
+def benchmark(n, latency, fail, concurrency):
+    """seconds to fetch n /group records: serial, concurrent (cold cache), cached"""
+    ogs = [f'{x}at2759' for x in range(n)]
+    with MockServer(latency=latency, fail=fail) as server, tempfile.TemporaryDirectory() as tmp:
+        urls = [odbfetch.url(server.url, 'group', id=og) for og in ogs]
+        times = {}
+        for name, conc, path in (('serial', 1, None), ('concurrent', concurrency, os.path.join(tmp, 'c.sqlite')),
+                                 ('cached', concurrency, os.path.join(tmp, 'c.sqlite'))):
+            cache = odbfetch.Cache(path)
+            fetcher = odbfetch.Fetcher(cache, concurrency=conc, backoff=0.01, progress=False)
+            start = time.time()
+            bodies = fetcher.fetch(urls)
+            times[name] = round(time.time() - start, 3)
+            missing = sum(b is None for b in bodies.values())
+            cache.close()
+            print(f'{name}: {times[name]} s, {fetcher.stats}, {missing} missing', file=sys.stderr)
+        assert all(json.loads(b) == group(og) for og, b in zip(ogs, (bodies[u] for u in urls)))
+    return times
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Local OrthoDB/KEGG stand-in server')
+    parser.add_argument('--port', type=int, default=8101, help='port (default 8101)')
+    parser.add_argument('--latency', type=float, default=0.05, help='seconds added to every response')
+    parser.add_argument('--fail', type=float, default=0.0, help='fraction of responses failing with 503')
+    parser.add_argument('--benchmark', type=int, metavar='N',
+                        help='fetch N records serially, concurrently and from the cache, then exit')
+    parser.add_argument('-p', '--concurrency', type=int, default=50, help='requests in flight (benchmark)')
+    args = parser.parse_args()
+
+    if args.benchmark:
+        print(json.dumps(benchmark(args.benchmark, args.latency, args.fail, args.concurrency)))
+    else:
+        server = MockServer(args.port, args.latency, args.fail)
+        print(f'serving {server.url}', file=sys.stderr)
+        try:
+            server.serve()
+        except KeyboardInterrupt:
+            pass
@@ -1,31 +1,35 @@
 #!/usr/bin/env python3
 
-import pandas as pd
-import requests
-import tqdm
+import json
 import pickle
 import argparse
-from multiprocessing import Pool
+import pandas as pd
+
+import odbfetch
 
 parser = argparse.ArgumentParser(description='Orthogroup data download (Orthodb v101)')
 parser.add_argument('-i', '--input_file', help='orthogroups list in a table')
 parser.add_argument('-o', '--output_file', help='output (saved in pickle format)')
-parser.add_argument('-p', '--pool_threads', type=int, help='n. of parallel threads')
+parser.add_argument('-p', '--pool_threads', type=int, default=odbfetch.CONCURRENCY,
+                    help=f'n. of concurrent requests (default {odbfetch.CONCURRENCY})')
+odbfetch.add_arguments(parser, odbfetch.ORTHODB)
 args = parser.parse_args()
 
 allogs_file = args.input_file # 'external/Eukaryota.ogs.list'
 odb_file = args.output_file #'external/odbinfos.pickle'
 
-def odbinfo(og):
+def odbinfo(body):
     try:
-        r = requests.get(f"https://v101.orthodb.org/group?id={og}").json()
-        return [og, r]
-    except:
-        return [og, []]
-    
-allogs = set(pd.read_table(allogs_file)['og'])
-odinfolist = list(tqdm.tqdm(Pool(args.pool_threads).imap(odbinfo, allogs), 
-                            total=len(list(allogs))))
+        return json.loads(body)
+    except (TypeError, ValueError):
+        return []
+
+allogs = sorted(set(pd.read_table(allogs_file)['og']))
+fetcher = odbfetch.from_args(args, odb_file, args.pool_threads)
+bodies = fetcher.fetch(odbfetch.url(args.base_url, 'group', id=og) for og in allogs)
+fetcher.cache.close()
+odinfolist = [[og, odbinfo(body)] for og, body in zip(allogs, bodies.values())]
+print(fetcher.stats)
 
 with open(odb_file, 'wb') as handle:
-    pickle.dump(odinfolist, handle, protocol=pickle.HIGHEST_PROTOCOL)
\ No newline at end of file
+    pickle.dump(odinfolist, handle, protocol=pickle.HIGHEST_PROTOCOL)
@@ -1,60 +1,140 @@
+#!/usr/bin/env python3
+# coding: utf-8
+#
+# GO annotations of orthogroups: join of a GAF file (e.g. goa_uniprot_all.gaf.gz)
+# with the UniProt ids of the orthogroups (og_uni table: gene, id, db, og).
+# The GAF is streamed once (decompressed by zcat/pigz when available) by chunks
+# of lines that worker processes parse and filter against the hashed id index;
+# annotations are aggregated by (og, aspect, GO term) in rows kept sorted by
+# cotr_io.SortedRuns (spilled to disk when large), so memory stays bounded.
+#
+# Output: og, type (aspect), go, evidence (list), uni (list), len, len_set,
+# ratio (len_set over the largest len_set of the og and aspect)
+#
+# Usage: oguni2chunk.py goa_uniprot_all.gaf.gz og_uni_Eukaryota.tsv Eukaryota.transitions.annotated.unigo 20
+#
+import io
+import itertools
 import os
 import sys
-import glob
-import tqdm
+import threading
 import warnings
+from multiprocessing import get_context
+
+import numpy as np
 import pandas as pd
-from multiprocessing import Pool
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.realpath(__file__)), '..', '..'))
+import cotr_io
 
 warnings.filterwarnings('ignore')
 
-oguninfile = sys.argv[1] # 'goa_uniprot_all.gaf.gz'
-oguni = sys.argv[2] # 'og_uni_Eukaryota.tsv'
-ogunigo = sys.argv[3] # Eukaryota.raxml.RL.csv.num.transitions.annotated.unigo
-proc = sys.argv[4] # processes
+CHUNK_LINES = 500000  # GAF lines parsed at once (identical lines are counted once per chunk)
+ASPECTS = ('C', 'F', 'P')  # output order of the aspects of an og (as sorted by groupby)
+HEADER = ['og', 'type', 'go', 'evidence', 'uni', 'len', 'len_set', 'ratio']
+
+_index = None  # UniProt ids of the orthogroups (pd.Index), shared by fork with the workers
+
+
+def og_index(path):
+    """(ids, og names, og_start, og_rows): distinct og_uni rows grouped by id
 
-print(sys.argv[1:])
+    the og codes of id number x are og_rows[og_start[x]:og_start[x+1]] (one per
+    distinct gene/id/db/og row, as the rows of the merge of the GAF with og_uni)"""
+    og_uni = pd.read_table(path, dtype=str).drop_duplicates()
+    ids, id_code = np.unique(og_uni['id'].values.astype(str), return_inverse=True)
+    ogs, og_code = np.unique(og_uni['og'].values.astype(str), return_inverse=True)
+    order = np.argsort(id_code, kind='stable')
+    og_start = np.concatenate([[0], np.cumsum(np.bincount(id_code, minlength=len(ids)))])
+    return pd.Index(ids), ogs, og_start, og_code[order]
 
-abspath = os.path.dirname(os.path.abspath(oguninfile))
 
-os.chdir(abspath)
-os.mkdir('uni_go')
+def parse_chunk(chunk):
+    """(id number, GO number, aspect, evidence) of the annotations of indexed ids
+    in a chunk of GAF lines (comment lines and duplicate lines skipped)"""
+    lines = list(dict.fromkeys(chunk.split(b'\n')))  # drop_duplicates of the rows of a chunk
+    df = pd.read_table(io.BytesIO(b'\n'.join(lines)), comment='!', header=None, usecols=[1, 4, 6, 8],
+                       dtype=str, quoting=3)
+    code = _index.get_indexer(df[1])
+    df = df[code >= 0]
+    return (code[code >= 0].astype(np.int32), df[4].str[3:].astype(np.int32).to_numpy(),
+            df[8].to_numpy(dtype=object), df[6].to_numpy(dtype=object))
 
-chunk_size=500000
-os.system(f'zcat {oguninfile} | split -dl {chunk_size} - uni_go/chunk')
-og_uni = pd.read_table(os.path.basename(oguni))
 
-def merge_chunk_unigo(x):
-    df = pd.read_table(x, 
-                       comment='!', 
-                       header=None,
-                       low_memory=False)
-    ch = og_uni.merge(df, left_on='id', right_on=1)
-    ch['part'] = x
-    return ch
+def gaf_chunks(path, size=CHUNK_LINES):
+    """chunks of lines (bytes) of a GAF (cotr_io.open_compressed)"""
+    with cotr_io.open_compressed(path) as stream:
+        while True:
+            lines = list(itertools.islice(stream, size))
+            if not lines:
+                break
+            yield b''.join(lines)
 
-total = (pd.concat(list(tqdm.tqdm(Pool(int(proc)).imap(merge_chunk_unigo, 
-                                 glob.glob('uni_go/chunk*')) , 
-                                  total=len(glob.glob('uni_go/chunk*'))))
-                  ).drop_duplicates())
 
+def annotate(gaf, oguni, out, processes=1):
+    global _index
+    _index, ogs, og_start, og_rows = og_index(oguni)
+    aspect_code = {a: n for n, a in enumerate(ASPECTS)}
+    evidences = {}
+    runs = cotr_io.SortedRuns(('key', 'evidence', 'uni'), 'key')
+    slots = threading.BoundedSemaphore(2 * processes)
+    nchunks = nrows = 0
+    with get_context('fork').Pool(processes) as pool:
+        for ids, go, aspect, evidence in pool.imap(parse_chunk, cotr_io.bounded(gaf_chunks(gaf), slots)):
+            slots.release()
+            n = og_start[ids + 1] - og_start[ids]  # one row per og_uni row of the id
+            og = og_rows[np.repeat(og_start[ids] - np.cumsum(n) + n, n) + np.arange(n.sum())]
+            asp = np.array([aspect_code.get(a, len(ASPECTS)) for a in aspect], dtype=np.int64)
+            ev = np.array([evidences.setdefault(e, len(evidences)) for e in evidence], dtype=np.int16)
+            key = ((og.astype(np.int64) * (len(ASPECTS) + 1) + np.repeat(asp, n)) << 32) | np.repeat(go, n)
+            runs.add(key=key, evidence=np.repeat(ev, n), uni=np.repeat(ids, n))
+            nchunks += 1
+            nrows += len(key)
+            sys.stderr.write(f"\r{nchunks} chunks, {nrows} annotations")
+    sys.stderr.write("\n")
+    names = np.array(list(evidences), dtype=object)
+    aspects = np.array(ASPECTS + ('?',), dtype=object)
+    out.write('\t'.join(HEADER) + '\n')
+    carry = None
+    for rows in itertools.chain(runs.merge(), [None]):
+        if rows is not None and carry is not None:
+            rows = {x: np.concatenate([carry[x], rows[x]]) for x in rows}
+        rows = rows if rows is not None else carry
+        if rows is None or not len(rows['key']):
+            continue
+        block = rows['key'] >> 32  # (og, aspect): complete unless it reaches the end of the chunk
+        last = len(block) if carry is rows else int(np.searchsorted(block, block[-1]))
+        carry = {x: a[last:] for x, a in rows.items()} if last < len(block) else None
+        if last:
+            _write_groups({x: a[:last] for x, a in rows.items()}, ogs, aspects, names, _index.values, out)
+    runs.close()
+    return nrows
 
-ch_gr = pd.merge(total.groupby(['og', 8, 4])[6].apply(list).reset_index(),
-                  total.groupby(['og', 8, 4])['id'].apply(list).reset_index())
-ch_gr['len'] = ch_gr[6].apply(len)
-ch_gr['len_set'] = ch_gr['id'].apply(lambda x: len(set(x)))
 
-def listone(og):
-    d = ch_gr[ch_gr['og']==og]
-    maxs = dict(d.groupby(['og', 8]).max().reset_index()[[8, 'len_set']].values)
-    d['ratio'] = d.apply(lambda x: x['len_set']/maxs.get(x[8]), axis=1)
-    return d
-    
-totalistone = list(tqdm.tqdm(Pool(int(proc)).imap(listone, set(ch_gr['og'])), total=len(set(ch_gr['og']))))
+def _write_groups(rows, ogs, aspects, evidences, ids, out):
+    """rows of complete (og, aspect) blocks, sorted by key (og, aspect, GO)"""
+    key, uni = rows['key'], rows['uni']
+    start = np.flatnonzero(np.concatenate([[True], key[1:] != key[:-1]]))
+    size = np.diff(np.append(start, len(key)))
+    pair = np.lexsort((uni, key))  # distinct ids of each group
+    new = np.concatenate([[True], (key[pair][1:] != key[pair][:-1]) | (uni[pair][1:] != uni[pair][:-1])])
+    distinct = np.add.reduceat(new, start) if len(key) else np.empty(0, dtype=int)
+    block = key[start] >> 32
+    bstart = np.flatnonzero(np.concatenate([[True], block[1:] != block[:-1]]))
+    top = np.repeat(np.maximum.reduceat(distinct, bstart), np.diff(np.append(bstart, len(block))))
+    og, aspect = np.divmod(block, len(aspects))
+    lines = []
+    for s, n, o, a, g, d, t in zip(start.tolist(), size.tolist(), og.tolist(), aspect.tolist(),
+                                   (key[start] & 0xffffffff).tolist(), distinct.tolist(), top.tolist()):
+        lines.append(f"{ogs[o]}\t{aspects[a]}\tGO:{g:07d}\t{evidences[rows['evidence'][s:s + n]].tolist()}\t"
+                     f"{ids[uni[s:s + n]].tolist()}\t{n}\t{d}\t{d / t}\n")
+    out.write(''.join(lines))
 
 
-pd.concat(totalistone).to_csv(f"{os.path.basename(ogunigo)}", 
-                              index=False, 
-                              sep='\t', 
-                              header=['og', 'type', 'go', 'evidence', 'uni', 'len', 'len_set','ratio']
-                             )
+if __name__ == '__main__':
+    if len(sys.argv) != 5:
+        sys.exit(f'usage: {sys.argv[0]} goa_uniprot_all.gaf.gz og_uni_Eukaryota.tsv output.unigo processes')
+    gaf, oguni, output, processes = sys.argv[1:]
+    with open(output, 'w') as out:
+        n = annotate(gaf, oguni, out, int(processes))
+    sys.stderr.write(f"{n} annotations of orthogroups written in {output}\n")
@@ -1,11 +1,16 @@
 #!/usr/bin/env python3
 # coding: utf-8
 
+import os
 import sys
 import numpy as np
 import pandas as pd
 import argparse
 
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.realpath(__file__)), '..', '..'))
+import cotr_io
+import cotr_lib
+
 Min_t = 4 # minimum number of transitions
 
 ap = argparse.ArgumentParser()
@@ -18,52 +23,30 @@ args = ap.parse_args()
 #args = ap.parse_args("~/Ricerca/OrthoDBv10/Eukaryota.csv.sel.csv.ord.num ~/Ricerca/OrthoDBv10/HogProf/pyprofiler/notebooks/my_humanopt.csv".split())
 #args = ap.parse_args("~/Ricerca/OrthoDBv10/Eukaryota.csv.sel.csv.ord.num ~/Ricerca/OrthoDBv10/Validation_ROC/yeastw_opt_trans.csv".split())
 
-csv1 = pd.read_table(args.csv1, header=None, index_col=0, comment='#')
+ogs, tr, _ = cotr_io.load_transitions(args.csv1, args.count_consecutive, cotr_io.cache_dir())
+index = pd.Index(ogs)
 
-ngenes, norgs = len(csv1.index), len(csv1.columns)
+ngenes, norgs = tr.shape
 
 csv2 = pd.read_table(args.csv2,  comment='#', sep='\t')
 
-tr = csv1.diff(axis=1) #iterative difference
-tr = tr.applymap(lambda x: 1 if x>1 else -1 if x<-1 else x) #increasing (1) or decreasing (-1) only
-tr_l = tr.values.tolist()
-
-if not args.count_consecutive: #count only once consecutive state transitions (-1,1)
-        for r in tr_l:
-                for i in range(len(r)-1):
-                        if (r[i]+r[i+1]==0):
-                                r[i+1]=0
-
-
-t01 = [set(np.nonzero(row > 0)[0]) for row in np.array(tr_l)] # 0->1 transitons
-t10 = [set(np.nonzero(row < 0)[0]) for row in np.array(tr_l)] # 1->0 transitons
-tt = [len(a | b) for a,b in zip(t01,t10)] #total transitions
+engine = cotr_lib.prepare(*cotr_lib.transition_matrices(tr))
+tt = np.count_nonzero(tr, axis=1) #total transitions
 
 sys.stderr.write("done transitions\n")
 
-print('G1','G2','orgs','t1','t2','c','d','k', sep="\t")
-counter = 0
-for og1,og2 in zip(csv2.og1,csv2.og2):
-	try:
-		i =  tr.index.get_loc(og1)
-	except:
+i, j = index.get_indexer(csv2.og1.astype(str)), index.get_indexer(csv2.og2.astype(str))
+for og1, og2, a, b in zip(csv2.og1, csv2.og2, i, j):
+	if a < 0:
 		sys.stderr.write(str(og1)  +" missing\n")
-		continue
-	else:
-		try:
-			j =  tr.index.get_loc(og2)
-		except:
-			sys.stderr.write(str(og2)  +" missing\n")
-			continue
-		else:
-			concordant = len(t01[i] & t01[j]) + len(t10[i] & t10[j])
-			discordant = len(t10[i] & t01[j]) + len(t01[i] & t10[j])
-			k = concordant - discordant
-			if abs(k) >= -1:
-				t1 = len(t01[i] | t10[i])
-				t2 = len(t01[j] | t10[j])
-				print(tr.index[i],tr.index[j], norgs, t1, t2, concordant, discordant, k, sep='\t')
-				counter += 1
+	elif b < 0:
+		sys.stderr.write(str(og2)  +" missing\n")
+found = (i >= 0) & (j >= 0)
+pairs = cotr_lib.list_pairs(engine, i[found], j[found])
+
+print('G1','G2','orgs','t1','t2','c','d','k', sep="\t")
+sys.stdout.write(cotr_lib.format_pairs(ogs, norgs, tt, *pairs[:5]))
+counter = pairs.tested
 
 # All done:
 sys.stderr.write("done concordance\n")
@@ -1,159 +1,316 @@
 #!/usr/bin/env python3
 # coding: utf-8
+#
+# OMA HOGs as OrthoDB-like tables (HOGs_{level}_{database}_OG2genes.tab.gz,
+# _OGs.tab.gz). The orthoXML is streamed from the .gz: the gene section is read
+# into arrays, then chunks of top-level HOGs are parsed by worker processes,
+# which emit the genes of each HOG (root level). The HOGs at an OMA level need
+# the species tree: they are taken from pyham.Ham on the whole orthoXML, as
+# before. Utilities/OMA_translator_check.py compares the HOGs with those of
+# pyham on the whole orthoXML.
+#
+# Usage: OMA_translator.py -t Eukaryota -d ncbi
+#        OMA_translator.py -t Mammalia -d oma
+#
 
 import warnings
 warnings.simplefilter("ignore")
 
 import pandas as pd
 import numpy as np
-from Bio import Entrez
 
 import argparse
 import itertools
 import requests
 import gzip
+import re
 import shutil
-import tqdm
-
-import omadb
-import pyham
+import threading
+import xml.etree.ElementTree as ET
+from multiprocessing import get_context
 
 import sys
 import os
 
-import sys
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.realpath(__file__)), '..'))
+import cotr_io
 
-ap = argparse.ArgumentParser()
-ap.add_argument('-d', '--taxonomy_database', default='ncbi',
-               help='Taxonomy database ("oma" for oma level, "ncbi" to filter species based on taxid)') 
-ap.add_argument('-t','--taxonomy_level',default='root',
-               help='Taxonomy level (e.g. root, Eukaryota, Mammalia)')
-ap.add_argument('-n','--newick_path',default='speciestree.nwk')
-ap.add_argument('-o','--orthoxml_path',default='oma-hogs.orthoXML')
-args = ap.parse_args()
-
-def HOG_data(hog):
-    
-    return hog.hog_id, [(gene.unique_id, gene.prot_id, 
-                         gene.genome.taxid) 
-             for gene in hog.get_all_descendant_genes()]
-
-def HOGs_at_root_level(hogs):
-    
-    return [HOG_data(hog) for hog in hogs]
-
-def HOGs_at_level(hogs, taxonomy_level):
-    
-    hogs_data = []
-    for hog in tqdm.tqdm(hogs):
-        
-        descendant_levels = [i.name for i in 
-            hog.get_all_descendant_hog_levels()]
-
-        if taxonomy_level not in descendant_levels:
-            continue
-            
-        if descendant_levels.index(taxonomy_level) == 0:
-            hogs_data.append(HOG_data(hog))
+ORTHOXML = '{http://orthoXML.org/2011/}'
+BLOCK = 1 << 24  # bytes read at once from the orthoXML
+CHUNK = 1 << 23  # bytes of top-level HOGs parsed at once by a worker
+ROWS = 1 << 20  # rows written at once
+
+_genes = None  # gene section of the orthoXML (Genes), shared by fork with the workers
+_head = None  # orthoXML root start tag
+
+
+class Genes:
+    """genes of the orthoXML species: id, protId and species number of each gene"""
 
+    def __init__(self, species, ids, prots, spec):
+        self.names = [s[0] for s in species]
+        self.taxids = [s[1] for s in species]
+        self.prots, self.species = prots, spec
+        try:
+            ids = ids.astype(np.int64)
+            self.order = np.argsort(ids, kind='stable')
+            self.sorted, self.index = ids[self.order], None
+        except ValueError:
+            self.sorted, self.index = None, pd.Index(ids)
+
+    def __len__(self):
+        return len(self.species)
+
+    def lookup(self, refs):
+        """gene numbers of the geneRef ids"""
+        if self.index is not None:
+            found = self.index.get_indexer(refs)
         else:
-            genome = hamutil.get_ancestral_genome_by_name(taxonomy_level)
-            for hog2 in hog.get_at_level(genome):
-                hogs_data.append((hog.hog_id, HOG_data(hog2)[1]))
-    
-    return hogs_data
+            x = np.array(refs, dtype=np.int64)
+            pos = np.minimum(np.searchsorted(self.sorted, x), max(len(self.sorted) - 1, 0))
+            found = np.where(self.sorted[pos] == x, self.order[pos], -1) if len(x) else pos
+        if (found < 0).any():
+            raise KeyError(f'geneRef not in the orthoXML genes: {refs[int(np.argmin(found))]}')
+        return found
+
+
+def read_blocks(path, size=BLOCK):
+    """blocks of bytes of the orthoXML (cotr_io.open_compressed)"""
+    with cotr_io.open_compressed(path, size) as stream:
+        for block in iter(lambda: stream.read(size), b''):
+            yield block
+
+
+def read_genes(blocks):
+    """(Genes, root start tag, blocks of the groups section) of the orthoXML blocks"""
+    parser = ET.XMLPullParser(events=('start', 'end'))
+    species, ids, prots, spec = [], [], [], []
+    current = ([], [])
+    head, tail = None, b''
+
+    def collect():
+        for event, elem in parser.read_events():
+            if event == 'start' and elem.tag == ORTHOXML + 'species':
+                species.append((elem.get('name'), elem.get('NCBITaxId')))
+            elif event == 'end' and elem.tag == ORTHOXML + 'gene':
+                current[0].append(elem.get('id'))
+                current[1].append(elem.get('protId'))
+            elif event == 'end' and elem.tag == ORTHOXML + 'species':
+                ids.append(np.array(current[0], dtype=str))
+                prots.append(np.char.encode(np.array(current[1], dtype=str), 'utf-8'))
+                spec.append(np.full(len(current[0]), len(species) - 1, dtype=np.int32))
+                current[0].clear(), current[1].clear()
+                elem.clear()
+            elif event == 'end' and elem.tag == ORTHOXML + 'genes':
+                elem.clear()
+
+    for block in blocks:
+        data = tail + block
+        if head is None:
+            found = re.search(rb'<orthoXML\b[^>]*>', data)
+            head = found.group(0) if found else None
+        start = data.find(b'<groups')
+        end = data.find(b'>', start) if start >= 0 else -1
+        if end < 0:
+            keep = len(data) - len(b'<groups>') if start < 0 else start
+            parser.feed(data[:keep])
+            tail = data[keep:]
+            collect()
+            continue
+        parser.feed(data[:start])
+        parser.feed(b'</orthoXML>')
+        collect()
+        parser.close()
+        genes = Genes(species, np.concatenate(ids or [np.empty(0, str)]),
+                      np.concatenate(prots or [np.empty(0, 'S1')]),
+                      np.concatenate(spec or [np.empty(0, np.int32)]))
+        return genes, head, itertools.chain([data[end + 1:]], blocks)
+    raise ValueError('no groups section in the orthoXML')
+
+
+_HOG_TAG = re.compile(rb'<(/?)orthologGroup\b[^>]*?(/?)>')
+
+
+def hog_chunks(blocks, size=CHUNK):
+    """chunks of text (bytes) of whole top-level orthologGroup elements of the groups section"""
+    buf, pos, depth, last = b'', 0, 0, 0
+    for block in blocks:
+        buf += block
+        for m in _HOG_TAG.finditer(buf, pos):
+            if m.group(1):
+                depth -= 1
+            elif not m.group(2):
+                depth += 1
+            if depth == 0:
+                last = m.end()
+            pos = m.end()
+        if last >= size:
+            yield buf[:last]
+            buf, pos, last = buf[last:], pos - last, 0
+    if last:
+        yield buf[:last]
+
+
+def HOGs_data(chunk):
+    """(hog ids, number of genes of each, gene numbers) of a chunk of top-level HOGs"""
+    close = b'</' + re.match(rb'<([^\s>]+)', _head).group(1) + b'>'
+    groups = ET.fromstring(_head + b'<groups>' + chunk + b'</groups>' + close)[0]
+    data = [(hog.get('id'), [g.get('id') for g in hog.iter(ORTHOXML + 'geneRef')]) for hog in groups]
+    return hog_arrays(data)
+
+
+def hog_arrays(data):
+    """(hog ids, number of genes of each, gene numbers) of (hog id, gene ids) pairs"""
+    sizes = np.array([len(x[1]) for x in data], dtype=np.int64)
+    members = _genes.lookup(list(itertools.chain.from_iterable(x[1] for x in data)))
+    return [x[0] for x in data], sizes, members.astype(np.int32)
+
+
+def HOGs_at_level(path, newick_path, level):
+    """(hog id, gene ids) of the HOGs at the OMA level of each top-level HOG, by
+    pyham on the whole orthoXML (the ancestral genome is looked up once)"""
+    import pyham
+    ham = pyham.Ham(newick_path, path, tree_format='newick', use_internal_name=True, species_resolve_mode='OMA')
+    genome = ham.get_ancestral_genome_by_name(level)
+    data = []
+    for hog in ham.get_list_top_level_hogs():
+        hogs = [h for h in hog.get_all_descendant_hogs() if h.genome == genome]
+        if hogs and hogs[0] is hog:
+            hogs = [hog]
+        data += [(hog.hog_id, [gene.unique_id for gene in h.get_all_descendant_genes()]) for h in hogs]
+    return data
+
+
+def extract_hogs(path, level='root', newick_path=None, workers=os.cpu_count()):
+    """(Genes, hog ids, number of genes of each, gene numbers) of the top-level HOGs
+    of the orthoXML (root) or of their HOGs at the OMA level (species tree needed)"""
+    global _genes, _head
+    raw = read_blocks(path)
+    _genes, _head, blocks = read_genes(raw)
+    if level != 'root':
+        raw.close()
+        hog_ids, sizes, members = hog_arrays(HOGs_at_level(path, newick_path, level))
+        return _genes, hog_ids, sizes, members
+    hog_ids, sizes, members = [], [], []
+    slots = threading.BoundedSemaphore(2 * workers)
+    with get_context('fork').Pool(workers) as pool:
+        for ids, n, genes in pool.imap(HOGs_data, cotr_io.bounded(hog_chunks(blocks), slots)):
+            slots.release()
+            hog_ids += ids
+            sizes.append(n)
+            members.append(genes)
+    return (_genes, hog_ids, np.concatenate(sizes or [np.empty(0, np.int64)]),
+            np.concatenate(members or [np.empty(0, np.int32)]))
+
 
 def getlineage(taxidlist):
-    
+    from Bio import Entrez
+
     Entrez.email = "A.N.Other@example.com"
     handle = Entrez.efetch(db="Taxonomy", id=taxidlist, retmode="xml")
     taxDf = pd.json_normalize(Entrez.read(handle))
-    return [(row[0], row[5].split('; ')) 
+    return [(row[0], row[5].split('; '))
             for row in taxDf.values.tolist()]
 
 def taxidlevel(taxidlist):
-    
-    return Entrez.read(Entrez.esearch(db="Taxonomy", 
+    from Bio import Entrez
+
+    return Entrez.read(Entrez.esearch(db="Taxonomy",
             term=taxidlist, retmode="xml"))['IdList'][0]
 
-taxonomy_level = args.taxonomy_level
-taxonomy_database = args.taxonomy_database 
-newick_path = args.newick_path
-orthoxml_path = args.orthoxml_path
-    
-taxonomy_level_oma = 'root' if taxonomy_database == 'ncbi' else taxonomy_level
-
-print(f'OMA TRANSLATOR', file=sys.stderr)
-print(f'Translation at level {taxonomy_level}, database {taxonomy_database}', file=sys.stderr)
-print(f'Download {newick_path} and {orthoxml_path}', file=sys.stderr)
-
-r = requests.get(f'https://omabrowser.org/All/{orthoxml_path}.gz')
-open(f'{orthoxml_path}.gz' , 'wb').write(r.content)
-
-with gzip.open(f'{orthoxml_path}.gz', 'rb') as f_in:
-    with open(orthoxml_path, 'wb') as f_out:
-        shutil.copyfileobj(f_in, f_out)
-
-r = requests.get(f'https://omabrowser.org/All/{newick_path}')
-open(newick_path , 'wb').write(r.content)
-
-hamutil = pyham.Ham(newick_path, orthoxml_path, tree_format="newick", 
-                    use_internal_name=True, species_resolve_mode="OMA")
-
-os.remove(orthoxml_path)
-
-print(f'Extracting HOGs data from {orthoxml_path}', file=sys.stderr)
-
-hogs = hamutil.get_list_top_level_hogs()
-
-allhogs = (HOGs_at_root_level(hogs) if taxonomy_level_oma == 'root' 
-           else HOGs_at_level(hogs, taxonomy_level_oma))
-allhogs_df = pd.DataFrame([(hog[0], [f"{i[2]}_x:{i[1]}" 
-                for i in hog[1]]) for hog in allhogs])
-
-print(f'Downloading HOGs descriptions', file=sys.stderr)
-
-HOGS_descriptions = omadb.OMARestAPI.HOGs(omadb.Client()).list().as_dataframe()
-HOGS_descriptions.to_csv('HOGs_list.tsv', sep='\t', index=None)
-HOGS_descriptions = dict(HOGS_descriptions[['roothog_id',
-                    'description']].values.tolist())
-
-allhogs_df[2] = allhogs_df[0].apply(lambda x: HOGS_descriptions.get(int(x)))
-allhogs_df[0] = allhogs_df[0].apply(lambda x: f'HOG:C{str(x).zfill(7)}')
-allhogs_df[3] = taxidlevel(taxonomy_level)
-
-ogs = allhogs_df[[0,3,2]]
-og2genes = allhogs_df.explode(1)[[0,1]]
-
-print(f"\t- Orthogroups found: {len(ogs)}", file=sys.stderr)
-print(f"\t- Genes found: {len(og2genes)}", file=sys.stderr)
-print(f"\t- Genomes found: {len(set(og2genes[1].apply(lambda x: x.split('_')[0])))}", file=sys.stderr)
-
-if taxonomy_database == 'ncbi':
-    
-    print(f'Filtering taxids', file=sys.stderr)
-    
-    taxis = list(set([int(i.split('_')[0]) for i in og2genes[1].tolist()]))
-    taxis_lineage = [getlineage(t.tolist()) 
-                     for t in np.array_split(taxis, int(len(taxis)/400)+1)]
-    taxis_lineage = list(itertools.chain(*taxis_lineage))
-
-    taxonomy_df = pd.DataFrame([(t[0],';'.join(t[1])) for t in taxis_lineage])
-    taxonomy_df.to_csv('HOGs_lineage.tsv', sep='\t', index=False, header=None)
-    
-    taxids = list(set(taxonomy_df[taxonomy_df[1].str.contains(
-        taxonomy_level)][0].tolist()))
-
-    og2genes[2] = og2genes[1].apply(lambda x: int(x.split('_')[0]))
-    og2genes = og2genes[og2genes[2].astype(str).isin(taxids)]
-    
-    print(f"\t\t- Orthogroups found: {len(ogs[ogs[0].isin(set(og2genes[0].tolist()))])}", file=sys.stderr)
-    print(f"\t\t- Genes found: {len(og2genes)}", file=sys.stderr)
-    print(f"\t\t- Genomes found: {len(set(og2genes[1].apply(lambda x: x.split('_')[0])))}", file=sys.stderr)
-    
-outfile = f'HOGs_{taxonomy_level}_{taxonomy_database}'
-print(f'Saving files at {outfile}_*', file=sys.stderr)
-og2genes[[0,1]].to_csv(f'{outfile}_OG2genes.tab.gz', 
-                    sep='\t', index=False, header=None, compression='gzip')
-ogs[ogs[0].isin(set(og2genes[0].tolist()))].to_csv(f'{outfile}_OGs.tab.gz', 
-                    sep='\t', index=False, header=None, compression='gzip')
\ No newline at end of file
+def download(url, path):
+    with requests.get(url, stream=True) as r:
+        r.raise_for_status()
+        with open(f'{path}.part', 'wb') as f:
+            shutil.copyfileobj(r.raw, f, 1 << 20)
+    os.replace(f'{path}.part', path)
+
+if __name__ == '__main__':
+    import omadb  # web clients of the translation only (not of extract_hogs)
+
+    ap = argparse.ArgumentParser()
+    ap.add_argument('-d', '--taxonomy_database', default='ncbi',
+                   help='Taxonomy database ("oma" for oma level, "ncbi" to filter species based on taxid)')
+    ap.add_argument('-t','--taxonomy_level',default='root',
+                   help='Taxonomy level (e.g. root, Eukaryota, Mammalia)')
+    ap.add_argument('-n','--newick_path',default='speciestree.nwk')
+    ap.add_argument('-o','--orthoxml_path',default='oma-hogs.orthoXML')
+    ap.add_argument('-w','--workers', type=int, default=os.cpu_count(),
+                   help='processes parsing the HOGs (default: all CPUs)')
+    args = ap.parse_args()
+
+    taxonomy_level = args.taxonomy_level
+    taxonomy_database = args.taxonomy_database
+    newick_path = args.newick_path
+    orthoxml_path = args.orthoxml_path
+
+    taxonomy_level_oma = 'root' if taxonomy_database == 'ncbi' else taxonomy_level
+
+    print(f'OMA TRANSLATOR', file=sys.stderr)
+    print(f'Translation at level {taxonomy_level}, database {taxonomy_database}', file=sys.stderr)
+    print(f'Download {newick_path} and {orthoxml_path}', file=sys.stderr)
+
+    if not os.path.exists(f'{orthoxml_path}.gz'):
+        download(f'https://omabrowser.org/All/{orthoxml_path}.gz', f'{orthoxml_path}.gz')
+
+    if taxonomy_level_oma != 'root' and not os.path.exists(newick_path):
+        download(f'https://omabrowser.org/All/{newick_path}', newick_path)
+
+    print(f'Extracting HOGs data from {orthoxml_path}', file=sys.stderr)
+
+    _genes, hog_ids, sizes, members = extract_hogs(f'{orthoxml_path}.gz', taxonomy_level_oma, newick_path, args.workers)
+    print(f"\t- Genes in the orthoXML: {len(_genes)}", file=sys.stderr)
+    group = np.repeat(np.arange(len(hog_ids)), sizes)
+    species_taxid = np.array([int(t) for t in _genes.taxids], dtype=np.int64)
+    taxid = species_taxid[_genes.species[members]]
+
+    print(f'Downloading HOGs descriptions', file=sys.stderr)
+
+    HOGS_descriptions = omadb.OMARestAPI.HOGs(omadb.Client()).list().as_dataframe()
+    HOGS_descriptions.to_csv('HOGs_list.tsv', sep='\t', index=None)
+    HOGS_descriptions = HOGS_descriptions.drop_duplicates('roothog_id', keep='last'
+                        ).set_index('roothog_id')['description']
+
+    ogs = pd.DataFrame({0: [f'HOG:C{str(x).zfill(7)}' for x in hog_ids]})
+    ogs[3] = taxidlevel(taxonomy_level)
+    ogs[2] = pd.Series(hog_ids, dtype=object).astype(int).map(HOGS_descriptions).values
+    ogs = ogs[[0,3,2]]
+    keep = np.ones(len(members), dtype=bool)
+
+    print(f"\t- Orthogroups found: {len(ogs)}", file=sys.stderr)
+    print(f"\t- Genes found: {len(members)}", file=sys.stderr)
+    print(f"\t- Genomes found: {len(np.unique(taxid))}", file=sys.stderr)
+
+    if taxonomy_database == 'ncbi':
+
+        print(f'Filtering taxids', file=sys.stderr)
+
+        taxis = np.unique(taxid).tolist()
+        taxis_lineage = [getlineage(t.tolist())
+                         for t in np.array_split(taxis, int(len(taxis)/400)+1)]
+        taxis_lineage = list(itertools.chain(*taxis_lineage))
+
+        taxonomy_df = pd.DataFrame([(t[0],';'.join(t[1])) for t in taxis_lineage])
+        taxonomy_df.to_csv('HOGs_lineage.tsv', sep='\t', index=False, header=None)
+
+        taxids = taxonomy_df[taxonomy_df[1].str.contains(taxonomy_level)][0].astype(np.int64).unique()
+
+        keep = np.isin(taxid, taxids)
+        kept = ogs[0].isin(set(ogs[0].values[np.unique(group[keep])]))
+
+        print(f"\t\t- Orthogroups found: {kept.sum()}", file=sys.stderr)
+        print(f"\t\t- Genes found: {keep.sum()}", file=sys.stderr)
+        print(f"\t\t- Genomes found: {len(np.unique(taxid[keep]))}", file=sys.stderr)
+
+    outfile = f'HOGs_{taxonomy_level}_{taxonomy_database}'
+    print(f'Saving files at {outfile}_*', file=sys.stderr)
+    labels = ogs[0].values
+    prefix = [f'{t}_x:' for t in _genes.taxids]
+    rows = np.flatnonzero(keep)
+    with gzip.open(f'{outfile}_OG2genes.tab.gz', 'wt', compresslevel=6) as f:
+        for s in range(0, len(rows), ROWS):
+            r = rows[s:s + ROWS]
+            f.write(''.join(f'{a}\t{prefix[b]}{c.decode()}\n' for a, b, c in
+                            zip(labels[group[r]], _genes.species[members[r]].tolist(), _genes.prots[members[r]])))
+    ogs[ogs[0].isin(set(labels[np.unique(group[keep])]))].to_csv(f'{outfile}_OGs.tab.gz',
+                        sep='\t', index=False, header=None, compression='gzip')
@@ -0,0 +1,167 @@
+#!/usr/bin/env python3
+# coding: utf-8
+#
+# Check of the HOG extraction of OMA_translator.py (extract_hogs: streamed
+# orthoXML at the root, one pyham.Ham on the whole orthoXML at OMA levels)
+# against the previous implementation (pyham.Ham on the whole orthoXML, the
+# genome of the level looked up for every HOG), on a synthetic orthoXML
+# with random species tree, paralog groups and skipped levels. The HOGs (in
+# order) and their genes (as the OG2genes table: taxid_x:protId) must be the
+# same at the root and at the given OMA levels; at the root the genes of a
+# HOG are in document order (pyham: by its HOG tree), so they are compared
+# sorted. Times are reported.
+#
+# Usage: OMA_translator_check.py [-n HOGS] [-l root N1 N3 ...] [-w WORKERS] [-o results.json]
+#
+import argparse
+import gzip
+import json
+import os
+import random
+import sys
+import tempfile
+import time
+
+import OMA_translator
+
+
+def synthetic_orthoxml(directory, nhogs, seed=0):
+    """(orthoxml.gz, newick, internal node names) in directory: species tree with
+    internal nodes N1.. and leaves SPEC1.., HOGs of random subtrees"""
+    rng = random.Random(seed)
+    count = {'n': 0, 'l': 0}
+
+    def tree(depth):
+        if depth == 0 or (depth < 4 and rng.random() < 0.25):
+            count['l'] += 1
+            return (f"SPEC{count['l']}", [])
+        count['n'] += 1
+        return (f"N{count['n']}", [tree(depth - 1) for _ in range(rng.choice([2, 2, 3]))])
+
+    def newick(n):
+        return n[0] if not n[1] else '(' + ','.join(newick(c) for c in n[1]) + ')' + n[0]
+
+    def nodes(n):
+        yield n
+        for c in n[1]:
+            yield from nodes(c)
+
+    root = tree(6)
+    leaves = [n[0] for n in nodes(root) if not n[1]]
+    internal = [n for n in nodes(root) if n[1]]
+    genes, last = {s: [] for s in leaves}, [0]
+
+    def gene(species):
+        last[0] += 1
+        genes[species].append(10 + 3 * last[0])
+        return f'<geneRef id="{genes[species][-1]}"/>'
+
+    def sub(n):
+        """orthoXML elements of the genes of the subtree of n (maybe none)"""
+        if not n[1]:
+            return ['<paralogGroup>' + gene(n[0]) + gene(n[0]) + '</paralogGroup>'] if rng.random() < 0.1 \
+                else [gene(n[0])]
+        parts = []
+        for c in n[1]:
+            r = rng.random()
+            if r < 0.15: # lost
+                continue
+            if r < 0.25: # duplicated
+                a, b = sub(c), sub(c)
+                parts += ['<paralogGroup>' + ''.join(a) + ''.join(b) + '</paralogGroup>'] if a and b else a + b
+                continue
+            parts += sub(c)
+        if len(parts) < 2 or (rng.random() < 0.15 and n is not root): # skipped level
+            return parts
+        return [f'<orthologGroup><property name="TaxRange" value="{n[0]}"/>' + ''.join(parts) + '</orthologGroup>']
+
+    hogs = []
+    while len(hogs) < nhogs:
+        p = sub(rng.choice(internal[:max(3, len(internal) // 3)]))
+        if len(p) == 1 and p[0].startswith('<orthologGroup>'):
+            hogs.append(p[0].replace('<orthologGroup>', f'<orthologGroup id="{len(hogs) + 1}">', 1))
+    path, tree_path = os.path.join(directory, 'oma-hogs.orthoXML.gz'), os.path.join(directory, 'speciestree.nwk')
+    with open(tree_path, 'w') as f:
+        f.write(newick(root) + ';\n')
+    with gzip.open(path, 'wt') as f:
+        f.write('<?xml version="1.0" encoding="utf-8"?>\n<orthoXML xmlns="http://orthoXML.org/2011/" '
+                'origin="OMA" originVersion="test" version="0.3">\n')
+        for n, s in enumerate(leaves):
+            f.write(f'<species name="{s}" NCBITaxId="{1000 + n}">\n<database name="OMA" version="x">\n<genes>\n')
+            f.writelines(f'<gene id="{g}" protId="{s[:3].upper()}{g:05d}" geneId="g{g}"/>\n' for g in genes[s])
+            f.write('</genes>\n</database>\n</species>\n')
+        f.write('<groups>\n' + ''.join(x + '\n' for x in hogs) + '</groups>\n</orthoXML>\n')
+    return path, tree_path, [n[0] for n in internal]
+
+
+# previous implementation (pyham on the whole orthoXML), as reference
+
+def reference_hogs(path, tree_path, level):
+    import pyham
+    ham = pyham.Ham(tree_path, path, tree_format='newick', use_internal_name=True, species_resolve_mode='OMA')
+
+    def genes(hog):
+        return [f'{gene.genome.taxid}_x:{gene.prot_id}' for gene in hog.get_all_descendant_genes()]
+
+    out = []
+    for hog in ham.get_list_top_level_hogs():
+        if level == 'root':
+            out.append((hog.hog_id, genes(hog)))
+            continue
+        descendant_levels = [i.name for i in hog.get_all_descendant_hog_levels()]
+        if level not in descendant_levels:
+            continue
+        if descendant_levels.index(level) == 0:
+            out.append((hog.hog_id, genes(hog)))
+        else:
+            out += [(hog.hog_id, genes(hog2)) for hog2 in hog.get_at_level(ham.get_ancestral_genome_by_name(level))]
+    return out
+
+
+def streamed_hogs(path, tree_path, level, workers):
+    genes, hog_ids, sizes, members = OMA_translator.extract_hogs(path, level, tree_path, workers)
+    names = [f'{taxid}_x:{prot.decode()}' for taxid, prot in
+             zip((genes.taxids[s] for s in genes.species[members].tolist()), genes.prots[members])]
+    out, start = [], 0
+    for hog, n in zip(hog_ids, sizes.tolist()):
+        out.append((hog, names[start:start + n]))
+        start += n
+    return out
+
+
+def run(nhogs, levels, workers, seed=0):
+    with tempfile.TemporaryDirectory() as tmp:
+        path, tree_path, internal = synthetic_orthoxml(tmp, nhogs, seed)
+        print(f'{nhogs} HOGs, internal nodes: {" ".join(internal[:8])} ...', file=sys.stderr)
+        results = {}
+        for level in levels:
+            start = time.time()
+            expected = reference_hogs(path, tree_path, level)
+            t_ref = time.time() - start
+            start = time.time()
+            got = streamed_hogs(path, tree_path, level, workers)
+            t_new = time.time() - start
+            if level == 'root':
+                expected, got = ([(hog, sorted(genes)) for hog, genes in x] for x in (expected, got))
+            results[level] = dict(hogs=len(got), genes=sum(len(x[1]) for x in got), previous_s=round(t_ref, 3),
+                                  streamed_s=round(t_new, 3), same=expected == got)
+            print(level, results[level], file=sys.stderr)
+    return results
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Check of the HOG extraction of OMA_translator.py against pyham')
+    parser.add_argument('-n', '--hogs', type=int, default=5000, help='top-level HOGs (default 5000)')
+    parser.add_argument('-l', '--levels', nargs='+', default=['root', 'N1', 'N2', 'N3'],
+                        help='OMA levels (root or internal nodes N1.. of the synthetic tree; default root N1 N2 N3)')
+    parser.add_argument('-w', '--workers', type=int, default=os.cpu_count(), help='processes (default: all CPUs)')
+    parser.add_argument('--seed', type=int, default=0, help='random seed (default 0)')
+    parser.add_argument('-o', '--output', help='write the results as JSON')
+    args = parser.parse_args()
+
+    results = run(args.hogs, args.levels, args.workers, args.seed)
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(dict(hogs=args.hogs, results=results), f, indent=1)
+    if not all(r['same'] for r in results.values()):
+        sys.exit('HOGs differ from the pyham implementation')
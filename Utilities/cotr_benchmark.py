@@ -0,0 +1,308 @@
+#!/usr/bin/env python3
+# coding: utf-8
+#
+# Benchmark of the transition scorer on synthetic presence/absence tables:
+# time and traced peak memory of the stages of cotr_transitions.py (parse,
+# diff/penalty, encode, pair scoring, output) and of the Fisher step, for
+# every backend, with checks that all backends give the same pairs as the
+# reference (set-based) implementation. Results are written as JSON, and
+# compared with an earlier result file to spot regressions.
+#
+# Usage: cotr_benchmark.py [-s toy small medium large | -s 5000x800] [-o bench.json] [--compare old.json]
+#        cotr_benchmark.py --generate 10000x1000 > synthetic.csv.num
+#
+import argparse
+import contextlib
+import hashlib
+import json
+import os
+import platform
+import subprocess
+import sys
+import tempfile
+import time
+import tracemalloc
+
+import numpy as np
+import pandas as pd
+
+ROOT = os.path.join(os.path.dirname(os.path.realpath(__file__)), '..')
+sys.path.insert(0, ROOT)
+import cotr_io
+import cotr_lib
+import cotr_stats
+
+SIZES = {  # genes x organisms
+    'small': (2000, 500),
+    'medium': (10000, 1000),
+    'large': (50000, 2000),
+}
+TOY = [os.path.join(ROOT, 'Figures', 'Figure1B', f'Figure1B_Case{x}.csv.num') for x in (1, 2)]
+
+REFERENCE_PAIRS = 1 << 21  # pairs checked against the reference implementation
+REFERENCE_ROWS = 2000  # rows checked against the reference transitions
+
+
+def synthetic_table(ngenes, norgs, seed=0, module_fraction=0.2, module_size=8):
+    """(names, values) of a synthetic gene occurrence table (uint8 0/1)
+
+    organisms are tree-ordered blocks (clades of uneven size); each gene has a
+    prevalence from a U-shaped Beta distribution (many rare and many nearly
+    universal orthogroups), is present in whole clades with that probability
+    and lost or gained in single organisms with a small rate. A fraction of
+    the genes forms co-evolving modules, sharing the clade pattern of the
+    first gene of the module (with the same noise), so significant pairs exist"""
+    rng = np.random.default_rng(seed)
+    nclades = max(1, int(round(np.sqrt(norgs))))
+    sizes = np.maximum(1, np.round(rng.dirichlet(np.full(nclades, 0.8)) * norgs)).astype(int)
+    sizes[-1] += norgs - sizes.sum()
+    while sizes[-1] < 1: # rounding took too many
+        big = np.argmax(sizes[:-1])
+        sizes[big] -= 1
+        sizes[-1] += 1
+    clade = np.repeat(np.arange(nclades), sizes)
+    prevalence = rng.beta(0.5, 0.7, ngenes)
+    pattern = rng.random((ngenes, nclades)) < prevalence[:, None]
+    leaders = rng.random(ngenes) < module_fraction / module_size
+    modules = rng.random(ngenes) < module_fraction
+    leader = np.maximum.accumulate(np.where(leaders, np.arange(ngenes), 0))
+    pattern[modules] = pattern[leader[modules]]
+    values = pattern[:, clade]
+    loss = rng.random((ngenes, norgs)) < 0.03
+    gain = rng.random((ngenes, norgs)) < 0.005
+    values = (values & ~loss) | gain
+    return [f'{x}at0' for x in range(ngenes)], values.astype(np.uint8)
+
+
+def write_table(names, values, out):
+    """write a 0/1 table as .csv.num (OG, then a value per organism, tab-separated)"""
+    for s in range(0, len(values), 4096):
+        block = values[s:s + 4096]
+        cells = np.full((len(block), 2 * block.shape[1]), ord('\t'), dtype=np.uint8)
+        cells[:, 1::2] = block + ord('0')
+        out.writelines(f'{x}{row.tobytes().decode()}\n' for x, row in zip(names[s:s + 4096], cells))
+
+
+def reference_transitions(values, count_consecutive=False):
+    """signed transitions as the original per-row loop of cotr_transitions.py"""
+    tr = np.sign(np.diff(np.asarray(values, dtype=int), axis=1)).tolist()
+    if not count_consecutive:
+        for r in tr:
+            for i in range(len(r) - 1):
+                if r[i] + r[i + 1] == 0:
+                    r[i + 1] = 0
+    return np.column_stack([np.zeros(len(tr), dtype=int), np.array(tr, dtype=int).reshape(len(tr), -1)])
+
+
+def reference_pairs(tr, i, j):
+    """concordant and discordant counts of the pairs (i[n], j[n]) by sets of positions"""
+    t01 = [set(np.flatnonzero(row > 0)) for row in tr]
+    t10 = [set(np.flatnonzero(row < 0)) for row in tr]
+    c = [len(t01[a] & t01[b]) + len(t10[a] & t10[b]) for a, b in zip(i, j)]
+    d = [len(t10[a] & t01[b]) + len(t01[a] & t10[b]) for a, b in zip(i, j)]
+    return np.array(c, dtype=int), np.array(d, dtype=int)
+
+
+@contextlib.contextmanager
+def measure(record):
+    """wall seconds and traced peak memory (MB) of the block, added to record
+    (peak_mb is 0 when tracemalloc is not tracing)"""
+    tracemalloc.reset_peak()
+    base = tracemalloc.get_traced_memory()[0]
+    start = time.perf_counter()
+    try:
+        yield record
+    finally:
+        record['seconds'] = round(record.get('seconds', 0) + time.perf_counter() - start, 4)
+        peak = (tracemalloc.get_traced_memory()[1] - base) / (1 << 20)
+        record['peak_mb'] = round(max(record.get('peak_mb', 0), peak), 2)
+
+
+def run_case(name, path, backends, min_transitions=4, p_cutoff=1e-3, seed=0):
+    """stage measures and checks of one table"""
+    case = dict(name=name, path=os.path.basename(path), min_transitions=min_transitions, stages={}, checks={})
+    stages, checks = case['stages'], case['checks']
+    with measure(stages.setdefault('parse', {})):
+        names, values = [], []
+        for ogs, v in cotr_io.iter_table(path):
+            names += ogs
+            values.append(v)
+        values = np.concatenate(values)
+    ngenes, norgs = values.shape
+    case.update(ngenes=ngenes, norgs=norgs)
+    with measure(stages.setdefault('transitions', {})):
+        tr = cotr_lib.transitions(values)
+        tt = np.count_nonzero(tr, axis=1)
+    case['density'] = round(float(tt.sum()) / max(1, tr.size), 5)
+    case['auto_backend'] = cotr_lib.choose_backend(tr > 0, tr < 0)
+    rng = np.random.default_rng(seed)
+    rows = np.sort(rng.choice(ngenes, min(ngenes, REFERENCE_ROWS), replace=False))
+    checks['transitions'] = bool(np.array_equal(reference_transitions(values[rows]), tr[rows]))
+    del values
+
+    npairs = ngenes * (ngenes - 1) // 2
+    if npairs <= REFERENCE_PAIRS: # all pairs, else pairs of random rows with all the others
+        ri, rj = np.triu_indices(ngenes, 1)
+    else:
+        ri = np.repeat(rng.choice(ngenes, max(1, REFERENCE_PAIRS // ngenes), replace=False), ngenes)
+        rj = np.tile(np.arange(ngenes), len(ri) // ngenes)
+        ri, rj = ri[ri != rj], rj[ri != rj]
+    rc, rd = reference_pairs(tr, ri, rj)
+    checks['reference_pairs'] = int(len(ri))
+
+    fisher_table = None
+    reference = None
+    for backend in backends:
+        with measure(stages.setdefault('encode', {}).setdefault(backend, {})):
+            engine = cotr_lib.prepare(*cotr_lib.transition_matrices(tr), backend)
+        c, d = cotr_lib.pair_concordance(engine, ri, rj)
+        checks.setdefault('reference', {})[backend] = bool(np.array_equal(c, rc) and np.array_equal(d, rd))
+        score = stages.setdefault('score', {}).setdefault(backend, {})
+        digest, found = hashlib.blake2b(digest_size=16), 0
+        first = reference is None # output and Fisher stages timed with the first backend
+        if first:
+            output, fisher = stages.setdefault('output', {}), stages.setdefault('fisher', {})
+            with measure(fisher):
+                fisher_table = cotr_stats.PValueTable(norgs, int(tt.max(initial=0)))
+            kept, tested = [], 0
+        tiles = cotr_lib.iter_pairs(engine, ngenes, min_transitions=min_transitions)
+        while True:
+            with measure(score):
+                pairs = next(tiles, None)
+            if pairs is None:
+                break
+            for a in pairs[:4]:
+                digest.update(np.ascontiguousarray(a, dtype=np.int64).tobytes())
+            found += len(pairs.i)
+            if first:
+                with measure(output), open(os.devnull, 'w') as null:
+                    null.write(cotr_lib.format_pairs(names, norgs, tt, *pairs[:5]))
+                with measure(fisher):
+                    p = fisher_table(pairs.k, tt[pairs.i], tt[pairs.j])
+                    kept.append(p[p <= p_cutoff])
+                    tested += pairs.tested
+        score['pairs'] = found
+        if first:
+            with measure(fisher):
+                padj = cotr_stats.holm(np.concatenate(kept) if kept else np.empty(0), tested)
+            fisher['significant'] = int(np.count_nonzero(padj <= p_cutoff))
+            reference = digest.hexdigest()
+        checks.setdefault('backends', {})[backend] = digest.hexdigest() == reference
+        del engine
+    case['pairs'] = found
+    return case
+
+
+def environment():
+    try:
+        version = subprocess.run(['git', '-C', ROOT, 'describe', '--always', '--dirty'], capture_output=True,
+                                 text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        version = None
+    return dict(version=version, date=time.strftime('%Y-%m-%dT%H:%M:%S'), python=platform.python_version(),
+                numpy=np.__version__, pandas=pd.__version__, machine=platform.machine(),
+                processor=platform.processor(), cpus=os.cpu_count())
+
+
+def stage_times(case):
+    """{stage or stage/backend: seconds}"""
+    out = {}
+    for stage, rec in case['stages'].items():
+        if 'seconds' in rec:
+            out[stage] = rec['seconds']
+        else:
+            out.update({f'{stage}/{b}': r['seconds'] for b, r in rec.items()})
+    return out
+
+
+def compare(result, previous, threshold=1.2, out=sys.stderr):
+    """print the time ratio of each stage to an earlier result; True if none is above threshold"""
+    old = {c['name']: stage_times(c) for c in previous['cases']}
+    ok = True
+    out.write(f"compared with {previous.get('version')} ({previous.get('date')})\n")
+    for case in result['cases']:
+        for stage, seconds in stage_times(case).items():
+            before = old.get(case['name'], {}).get(stage)
+            if not before:
+                continue
+            ratio = seconds / before
+            slow = ratio > threshold and seconds - before > 0.05
+            ok &= not slow
+            out.write(f"{case['name']}\t{stage}\t{before:.3f}\t{seconds:.3f}\t{ratio:.2f}x"
+                      + ("\tREGRESSION\n" if slow else "\n"))
+    return ok
+
+
+def parse_size(text):
+    if text in SIZES:
+        return text, SIZES[text]
+    try:
+        ngenes, norgs = (int(x) for x in text.lower().split('x'))
+    except ValueError:
+        raise argparse.ArgumentTypeError(f'{text}: expected toy, {", ".join(SIZES)} or GENESxORGANISMS')
+    return text, (ngenes, norgs)
+
+
+if __name__ == '__main__':
+    ap = argparse.ArgumentParser(description='Benchmark of the transition scorer on synthetic tables')
+    ap.add_argument('-s', '--sizes', nargs='+', default=['toy', 'small'],
+                    help=f'Cases: toy (Figure1B), {", ".join(f"{k} ({a}x{b})" for k, (a, b) in SIZES.items())} '
+                    'or GENESxORGANISMS')
+    ap.add_argument('-b', '--backends', nargs='+', default=list(cotr_lib.BACKENDS), choices=cotr_lib.BACKENDS,
+                    help='Backends timed and checked (the first is the reference of the others)')
+    ap.add_argument('-m', '--min_transitions', default=4, type=int,
+                    help='Minimum number of co-evolutionary transitions of the scored pairs (as the pipeline)')
+    ap.add_argument('--seed', default=0, type=int, help='Seed of the synthetic tables')
+    ap.add_argument('-o', '--output', default=None, help='Write the results to this JSON file (default: STDOUT)')
+    ap.add_argument('--compare', default=None, help='Earlier JSON result: print the time ratio of every stage')
+    ap.add_argument('--threshold', default=1.2, type=float, help='Time ratio reported as a regression')
+    ap.add_argument('--no_memory', action='store_true',
+                    help='Do not trace memory (tracing slows down the stages written in Python)')
+    ap.add_argument('--generate', default=None, type=parse_size,
+                    help='Only write a synthetic table of this size to STDOUT')
+    args = ap.parse_args()
+
+    if args.generate:
+        write_table(*synthetic_table(*args.generate[1], seed=args.seed), sys.stdout)
+        sys.exit(0)
+    cases = []
+    for size in args.sizes:
+        if size == 'toy':
+            cases += [(os.path.basename(f).split('.')[0], f) for f in TOY]
+        else:
+            try:
+                cases.append(parse_size(size))
+            except argparse.ArgumentTypeError as e:
+                ap.error(str(e))
+    result = dict(environment(), backends=args.backends, memory=not args.no_memory, cases=[])
+    if not args.no_memory:
+        tracemalloc.start()
+    with tempfile.TemporaryDirectory(prefix='cotr.bench.') as tmp:
+        for name, spec in cases:
+            path = spec
+            generate = {}
+            if not isinstance(spec, str):
+                path = os.path.join(tmp, f'{name}.csv.num')
+                with measure(generate), open(path, 'w') as f:
+                    write_table(*synthetic_table(*spec, seed=args.seed), f)
+            sys.stderr.write(f"{name}: ")
+            case = run_case(name, path, args.backends, args.min_transitions, seed=args.seed)
+            if generate:
+                case['stages'] = dict(generate=generate, **case['stages'])
+                os.remove(path)
+            result['cases'].append(case)
+            passed = case['checks']['transitions'] and all(case['checks']['reference'].values()) \
+                and all(case['checks']['backends'].values())
+            sys.stderr.write(f"{case['ngenes']}x{case['norgs']}, {case['pairs']} pairs, "
+                             f"checks {'ok' if passed else 'FAILED'}\n")
+    if not args.no_memory:
+        tracemalloc.stop()
+    with (open(args.output, 'w') if args.output else contextlib.nullcontext(sys.stdout)) as out:
+        json.dump(result, out, indent=1)
+        out.write('\n')
+    ok = all(c['checks']['transitions'] and all(c['checks']['reference'].values())
+             and all(c['checks']['backends'].values()) for c in result['cases'])
+    if args.compare:
+        with open(args.compare) as f:
+            ok &= compare(result, json.load(f), args.threshold)
+    sys.exit(0 if ok else 1)
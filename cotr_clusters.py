@@ -0,0 +1,260 @@
+#!/usr/bin/env python3
+# coding: utf-8
+#
+# Clusters of co-evolving orthogroups (MCL of significant pairs), as
+# Utilities/procedure_mcl_clusters.pl without the mcl input and output files:
+# the graph (-log10 p.adj weights, pairs with negative k_score skipped) is built
+# from a .transitions.annotated table, a binary pair table (cotr_io.py) or
+# pair arrays in memory, and clustered by a sparse MCL in numpy, so several
+# inflation values cost one graph.
+#
+# Usage: cotr_clusters.py level.raxml.RL.csv intersection.level.raxml.RL.transitions.annotated
+#        (writes intersection.level.raxml.RL.clusters.annotated)
+#
+import argparse
+import os
+import re
+import sys
+from collections import namedtuple
+
+import numpy as np
+import pandas as pd
+
+import cotr_io
+import cotr_log
+from cotr_lib import expand_ranges, spans
+
+CUT_OFF = 1e-3  # max p.adj of clustered pairs
+INFLATION = 2.5
+MIN_P = 1e-300  # p.adj floor (weight 300)
+
+PRUNE = 1 / 4000  # mcl -P: entries below this are dropped after expansion
+SELECT = 500  # mcl -S: largest entries kept per column
+EXPAND_CELLS = 1 << 22  # products summed at once in the expansion
+
+Graph = namedtuple('Graph', 'labels a b w key score')
+
+
+def pair_graph(names, i, j, ks, padj, cutoff=CUT_OFF, skip_negatives=True):
+    """weighted graph of the pairs with p.adj < cutoff (and k_score >= 0)
+
+    nodes are numbered by first appearance (as mcl --abc labels); edges a < b
+    are weighted -log10(p.adj) (max of repeated pairs), key/score give the
+    k_score of each pair in both directions (sorted by a*n+b)"""
+    names = np.asarray(names, dtype=object)
+    i, j = np.asarray(i), np.asarray(j)
+    ks, padj = np.asarray(ks, dtype=float), np.asarray(padj, dtype=float)
+    keep = np.isfinite(ks) & (padj < cutoff)
+    if skip_negatives:
+        keep &= ks >= 0
+    i, j, ks, padj = i[keep], j[keep], ks[keep], padj[keep]
+    seen = np.column_stack([i, j]).ravel()
+    ids, first, node = np.unique(seen, return_index=True, return_inverse=True)
+    rank = np.empty(len(ids), dtype=np.int64)
+    rank[np.argsort(first, kind='stable')] = np.arange(len(ids))
+    node = rank[node].reshape(-1, 2)
+    labels = names[ids[np.argsort(rank)]]
+    n = len(labels)
+    x, y = node.min(axis=1), node.max(axis=1)
+    w = -np.log10(np.maximum(padj, MIN_P))
+    edge = x * n + y
+    order = np.lexsort((-w, edge))
+    first = np.ones(len(order), dtype=bool)
+    first[1:] = edge[order][1:] != edge[order][:-1]
+    e = order[first & (x[order] != y[order])]
+    key = np.column_stack([node[:, 0] * n + node[:, 1], node[:, 1] * n + node[:, 0]]).ravel()
+    order = np.argsort(key, kind='stable')  # later pairs override earlier ones, as the perl hash
+    last = np.ones(len(order), dtype=bool)
+    last[:-1] = key[order][1:] != key[order][:-1]
+    score = np.repeat(ks, 2)[order[last]]
+    return Graph(labels, x[e], y[e], w[e], key[order[last]], score)
+
+
+def read_graph(path, cutoff=CUT_OFF, skip_negatives=True):
+    """pair_graph of a .transitions.annotated table (k_score and p.adj in
+    columns 9 and 11, lines without numbers skipped) or of a binary pair table"""
+    if os.path.isdir(path):
+        meta, ogs, arrays = cotr_io.read_pairs(path, ['i', 'j', 'k_score', 'p.adj'])
+        return pair_graph(ogs, arrays['i'], arrays['j'], arrays['k_score'], arrays['p.adj'],
+                          cutoff, skip_negatives)
+    df = pd.read_table(path, header=None, usecols=[0, 1, 8, 10], dtype=str)
+    ks, padj = (pd.to_numeric(df[c], errors='coerce').values for c in (8, 10))
+    names = pd.concat([df[0], df[1]])
+    cats = pd.Index(names.unique())
+    return pair_graph(cats.values, cats.get_indexer(df[0]), cats.get_indexer(df[1]),
+                      ks, np.where(np.isnan(padj), np.inf, padj), cutoff, skip_negatives)
+
+
+def _columns(n, col, row, val):
+    """CSC arrays (indptr, row, val) of entries sorted by column, then row"""
+    return np.concatenate([[0], np.cumsum(np.bincount(col, minlength=n))]), row, val
+
+
+def _stochastic(n, col, val):
+    return val / np.bincount(col, weights=val, minlength=n)[col]
+
+
+def _expand_prune(n, m, inflation, cells=EXPAND_CELLS):
+    """columns of m*m, pruned (PRUNE, SELECT) and inflated, and their chaos"""
+    indptr, row, val = m
+    nnz = np.diff(indptr)
+    col = np.repeat(np.arange(n), nnz)
+    work = np.bincount(col, weights=nnz[row], minlength=n).astype(np.int64)
+    parts, chaos = [], 0.0
+    for a, b in spans(work, cells):
+        s, t = indptr[a], indptr[b]
+        cnt = nnz[row[s:t]]
+        src = expand_ranges(indptr[row[s:t]], cnt)
+        key = np.repeat(col[s:t].astype(np.int64), cnt) * n + row[src]
+        key, inv = np.unique(key, return_inverse=True)
+        v = np.bincount(inv, weights=val[src] * np.repeat(val[s:t], cnt))
+        c, r = key // n, key % n
+        top = np.zeros(n)
+        np.maximum.at(top, c, v)
+        keep = v >= np.minimum(PRUNE, top[c])
+        c, r, v = c[keep], r[keep], v[keep]
+        order = np.lexsort((-v, c))
+        start = np.searchsorted(c[order], c[order], 'left')
+        keep = np.sort(order[np.arange(len(order)) - start < SELECT])
+        c, r, v = c[keep], r[keep], v[keep] ** inflation
+        v = _stochastic(n, c, v)
+        top = np.zeros(n)
+        np.maximum.at(top, c, v)
+        sq = np.bincount(c, weights=v * v, minlength=n)
+        cols = np.unique(c)
+        chaos = max(chaos, float((top[cols] / sq[cols] - 1).max(initial=0)))
+        parts.append((c, r, v))
+    c, r, v = (np.concatenate(x) for x in zip(*parts))
+    return _columns(n, c, r, v), chaos
+
+
+def mcl(graph, inflation=INFLATION, max_iter=100, chaos=1e-4):
+    """clusters of the graph by Markov clustering (mcl -I inflation --abc)
+
+    the symmetric graph with loops (max edge weight of the node) is made
+    column-stochastic and alternately expanded (squared) and inflated until
+    the chaos of the columns vanishes; clusters are the attractor systems with
+    the nodes flowing to them, by decreasing size, nodes in label order"""
+    n = len(graph.labels)
+    if not n:
+        return []
+    loop = np.zeros(n)
+    np.maximum.at(loop, graph.a, graph.w)
+    np.maximum.at(loop, graph.b, graph.w)
+    nodes = np.arange(n)
+    col = np.concatenate([graph.a, graph.b, nodes])
+    row = np.concatenate([graph.b, graph.a, nodes])
+    val = np.concatenate([graph.w, graph.w, loop])
+    order = np.lexsort((row, col))
+    col, row, val = col[order], row[order], val[order]
+    m = _columns(n, col, row, _stochastic(n, col, val))
+    for _ in range(max_iter):
+        m, ch = _expand_prune(n, m, inflation)
+        if ch < chaos:
+            break
+    indptr, row, val = m
+    col = np.repeat(nodes, np.diff(indptr))
+    attractor = np.zeros(n, dtype=bool)
+    attractor[row[(row == col) & (val > 0)]] = True
+    link = attractor[row]
+    a, b = col[link], row[link]  # node -> its attractors
+    comp = nodes.copy()
+    while True:  # connected components by label propagation
+        before = comp.copy()
+        np.minimum.at(comp, a, comp[b])
+        np.minimum.at(comp, b, comp[a])
+        comp = comp[comp]
+        if (comp == before).all():
+            break
+    size = np.bincount(comp, minlength=n)
+    order = np.lexsort((nodes, comp, -size[comp]))
+    bounds = np.flatnonzero(np.diff(comp[order])) + 1
+    return np.split(order, bounds)
+
+
+def cluster_scores(graph, cluster, missing=0.1):
+    """mean k_score of the pairs of a cluster (missing pairs count 0.1)"""
+    n = len(graph.labels)
+    x, y = np.triu_indices(len(cluster), 1)
+    q = cluster[x].astype(np.int64) * n + cluster[y]
+    hit = np.minimum(np.searchsorted(graph.key, q), max(0, len(graph.key) - 1))
+    found = graph.key[hit] == q if len(graph.key) else np.zeros(len(q), dtype=bool)
+    return np.where(found, graph.score[hit] if len(graph.key) else 0, missing).sum() / len(q)
+
+
+def read_descriptions(path, wanted):
+    """{og: (description, number of genes)} of the orthogroups in wanted,
+    from the tab-separated .csv table (og, description, genes by organism)
+    or a binary presence table (organisms with the orthogroup)"""
+    if os.path.isdir(path):
+        meta, ogs, descriptions, bits = cotr_io.read_table(path)
+        rows = [n for n, og in enumerate(ogs) if og in wanted]
+        counts = np.unpackbits(bits[rows], axis=1, count=len(meta['organisms'])).sum(axis=1)
+        return {ogs[n]: ((descriptions or [''] * len(ogs))[n], int(c)) for n, c in zip(rows, counts)}
+    out = {}
+    with open(path) as f:
+        for line in f:
+            og, _, rest = line.partition('\t')
+            if og in wanted:
+                fields = rest.rstrip('\n').split('\t')
+                out[og] = (fields[0], sum(1 for x in fields[1:] if x.strip()))
+    return out
+
+
+def write_clusters(graph, clusters, descriptions, out):
+    """annotated clusters (of 2 or more orthogroups) as procedure_mcl_clusters.pl:
+    mean k_score, genes of the first orthogroup (size): og:description ### ..."""
+    count = 0
+    for cluster in clusters:
+        if len(cluster) < 2:
+            continue
+        count += 1
+        labels = graph.labels[cluster]
+        genes = descriptions.get(labels[0], ('', ''))[1]
+        out.write(f'{cluster_scores(graph, cluster):.5f} {genes} ({len(cluster)}): '
+                  + ''.join(f'{x}:{descriptions.get(x, ("",))[0]} ### ' for x in labels) + '\n')
+    return count
+
+
+if __name__ == '__main__':
+    ap = argparse.ArgumentParser(description='MCL clusters of significant orthogroup pairs')
+    ap.add_argument('csv', help='tab-separated table of orthogroups (id, description, genes by organism) '
+                    'or binary presence table (cotr_tables.py)')
+    ap.add_argument('transitions', help='.transitions.annotated table (cotr_Fisher.r, cotr_transitions.py --fisher) '
+                    'or binary pair table directory (cotr_transitions.py --fisher -o)')
+    ap.add_argument('-I', '--inflation', default=[INFLATION], type=lambda x: [float(v) for v in x.split(',')],
+                    help='MCL inflation; with several comma-separated values (e.g. 1.4,2.5,4), '
+                    'one output per value (.I25 for 2.5)')
+    ap.add_argument('-pa', '--padj.cutoff', dest='padj_cutoff', default=CUT_OFF, type=float,
+                    help='p.adj cutoff of the clustered pairs')
+    ap.add_argument('--keep_negatives', action='store_true', help='Cluster also pairs with negative k_score')
+    ap.add_argument('-o', '--out', default=None,
+                    help='Output prefix (default: the transitions file without .transitions*annotated)')
+    ap.add_argument('--log', default=None, help='Append JSON-lines records of the stages (wall time, peak RSS) to this file')
+    ap.add_argument('--profile', default=None,
+                    help='Profile the run into this file: cProfile stats, or pyinstrument report for .html')
+    args = ap.parse_args()
+    prefix = args.out
+    if prefix is None:
+        found = re.match(r'(\S+)\.transitions.*annotated', args.transitions)
+        if not found and not os.path.isdir(args.transitions):
+            ap.error('not a .transitions.annotated file (use --out)')
+        prefix = found.group(1) if found else os.path.normpath(args.transitions)
+
+    if args.profile:
+        cotr_log.profile(args.profile)
+    runlog = cotr_log.RunLog(args.log, transitions=args.transitions, inflation=args.inflation)
+    runlog.stage('graph')
+    graph = read_graph(args.transitions, args.padj_cutoff, not args.keep_negatives)
+    runlog.stage('descriptions', nodes=len(graph.labels), edges=len(graph.a))
+    descriptions = read_descriptions(args.csv, set(graph.labels))
+    for inflation in args.inflation:
+        runlog.stage(f'mcl -I {inflation:g}')
+        clusters = mcl(graph, inflation)
+        name = f'{prefix}.clusters.annotated' if len(args.inflation) == 1 else \
+            f'{prefix}.I' + f'{inflation:.1f}'.replace('.', '') + '.clusters.annotated'
+        with open(name, 'w') as out:
+            count = write_clusters(graph, clusters, descriptions, out)
+        sys.stderr.write(f"written {count} modules in {name}\n")
+        runlog.stage(None, clusters=len(clusters), modules=count)
+    runlog.close()
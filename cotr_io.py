@@ -0,0 +1,644 @@
+#!/usr/bin/env python3
+# coding: utf-8
+#
+# Binary pair tables: a directory with one .npy file per column (memory-mappable),
+# the orthogroup dictionary (ogs.txt, row index order) and meta.json.
+# Pairs are stored as int32 row indices into the dictionary, in i<j order
+# (sorted by p, as the TSV output, for --fisher tables).
+#
+# Transition caches: the OG names, signed int8 transition matrix and total
+# transitions of a .csv.num table, stored in the user cache directory
+# ($XDG_CACHE_HOME/cotransitions, keyed by table name, file hash and
+# --count_consecutive) and memory-mapped by later runs. Tables are read by
+# chunks of rows, so only the int8 transitions of the whole table are kept.
+#
+# Presence tables (cotr_tables.py): a directory with the orthogroups (ogs.txt)
+# and their descriptions, the organisms (columns, in meta.json) and the
+# bit-packed 0/1 rows (bits.npy); read as a .csv.num table by iter_table and
+# load_transitions (so by cotr_transitions.py), without text parsing.
+#
+# Usage (TSV export): cotr_io.py pairs_dir > pairs.tsv
+#
+import contextlib
+import glob
+import gzip
+import hashlib
+import json
+import os
+import shutil
+import struct
+import subprocess
+import sys
+import tempfile
+
+import numpy as np
+import pandas as pd
+
+import cotr_lib
+
+FORMAT = 'cotr-pairs'
+TABLE_FORMAT = 'cotr-table'
+TABLE_FILES = ('meta.json', 'ogs.txt', 'bits.npy')  # content of a presence table (file_key)
+
+# column dtypes (orientation columns, e.g. p.adj.LL, use the dtype of their base name)
+DTYPES = {
+    'i': np.int32, 'j': np.int32,
+    't1': np.uint16, 't2': np.uint16, 'c': np.uint16, 'd': np.uint16, 'k': np.int16,
+    'k_score': np.float32,
+    'p': np.float64, 'p.adj': np.float64,  # float32 underflows below 1e-45
+}
+
+CHUNK_CELLS = 1 << 21  # table cells parsed and encoded at once
+
+SPILL_ROWS = 1 << 23  # rows kept in memory by SortedRuns before writing a run to disk
+
+PAIR_COLUMNS = ('i', 'j', 't1', 't2', 'c', 'd', 'k')
+FISHER_COLUMNS = PAIR_COLUMNS + ('k_score', 'p', 'p.adj')
+
+
+def column_dtype(column):
+    base = max((x for x in DTYPES if column == x or column.startswith(x + '.')), key=len)
+    return np.dtype(DTYPES[base])
+
+
+class _NpyColumn:
+    """append-only .npy file of rows of shape (fixed-size header rewritten on close)"""
+    HEADER = 128
+
+    def __init__(self, path, dtype, shape=()):
+        self.file = open(path, 'wb')
+        self.dtype = np.dtype(dtype)
+        self.shape = tuple(shape)
+        self.rows = 0
+        self._header()
+
+    def _header(self):
+        header = repr({'descr': np.lib.format.dtype_to_descr(self.dtype),
+                       'fortran_order': False, 'shape': (self.rows,) + self.shape}).encode('latin1')
+        size = self.HEADER - 10
+        self.file.seek(0)
+        self.file.write(np.lib.format.magic(1, 0) + struct.pack('<H', size)
+                        + header.ljust(size - 1) + b'\n')
+        self.file.seek(0, os.SEEK_END)
+
+    def append(self, a):
+        self.file.write(np.ascontiguousarray(a, dtype=self.dtype).tobytes())
+        self.rows += len(a)
+
+    def close(self):
+        self._header()
+        self.file.close()
+
+
+class PairWriter:
+    """stream gene pairs (column arrays) to a binary pair table"""
+
+    def __init__(self, path, names, norgs, columns=PAIR_COLUMNS, **meta):
+        os.makedirs(path, exist_ok=True)
+        self.path = path
+        self.meta = dict(format=FORMAT, version=1, orgs=int(norgs), rows=0,
+                         columns=list(columns), **meta)
+        if names is not None: # else indices into a dictionary kept elsewhere
+            with open(os.path.join(path, 'ogs.txt'), 'w') as f:
+                f.writelines(f'{x}\n' for x in names)
+        self.columns = {c: _NpyColumn(os.path.join(path, f'{c}.npy'), column_dtype(c))
+                        for c in columns}
+
+    def write(self, **arrays):
+        n = {len(arrays[c]) for c in self.columns}
+        if len(n) != 1:
+            raise ValueError('columns of different length')
+        for c, col in self.columns.items():
+            col.append(arrays[c])
+        self.meta['rows'] += n.pop()
+
+    def close(self):
+        for col in self.columns.values():
+            col.close()
+        with open(os.path.join(self.path, 'meta.json'), 'w') as f:
+            json.dump(self.meta, f, indent=1)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+def read_pairs(path, columns=None, mmap_mode='r'):
+    """(meta, ogs, {column: array}) of a binary pair table"""
+    with open(os.path.join(path, 'meta.json')) as f:
+        meta = json.load(f)
+    if meta.get('format') != FORMAT:
+        raise ValueError(f'{path}: not a {FORMAT} table')
+    ogs = None
+    if os.path.isfile(os.path.join(path, 'ogs.txt')):
+        with open(os.path.join(path, 'ogs.txt')) as f:
+            ogs = np.array(f.read().splitlines(), dtype=object)
+    arrays = {c: np.load(os.path.join(path, f'{c}.npy'), mmap_mode=mmap_mode)
+              for c in (columns or meta['columns'])}
+    return meta, ogs, arrays
+
+
+def pairs_frame(path, columns=None):
+    """pandas DataFrame of a binary pair table, with the columns of the TSV output
+
+    orthogroup names are categorical (codes are the stored row indices)"""
+    meta, ogs, arrays = read_pairs(path, columns)
+    cats = pd.Index(ogs)
+    df = pd.DataFrame({
+        'Orthogroup1': pd.Categorical.from_codes(arrays.pop('i', np.empty(0, np.int32)), cats),
+        'Orthogroup2': pd.Categorical.from_codes(arrays.pop('j', np.empty(0, np.int32)), cats),
+        'orgs': np.full(meta['rows'], meta['orgs'], dtype=np.uint16),
+    })
+    for c, a in arrays.items():
+        df[c] = a
+    return df
+
+
+def write_tsv(path, out=sys.stdout, chunk=1 << 20):
+    """export a binary pair table as tab-separated text"""
+    import cotr_stats
+    meta, ogs, arrays = read_pairs(path)
+    columns = [c for c in meta['columns'] if c not in ('i', 'j')]
+    out.write('\t'.join(['Orthogroup1', 'Orthogroup2', 'orgs'] + columns) + '\n')
+    orgs = str(meta['orgs'])
+    specs = {c: None for c in columns if arrays[c].dtype.kind not in 'iu'}
+    for s in range(0, meta['rows'], chunk): # one notation per column, as the direct TSV output
+        for c in specs:
+            specs[c] = cotr_stats.format_r_spec(arrays[c][s:s + chunk], spec=specs[c])
+    for s in range(0, meta['rows'], chunk):
+        sl = slice(s, s + chunk)
+        values = [ogs[arrays['i'][sl]].tolist(), ogs[arrays['j'][sl]].tolist(), [orgs] * len(arrays['i'][sl])]
+        values += [cotr_stats.format_r(arrays[c][sl], spec=specs[c]) if c in specs
+                   else arrays[c][sl].tolist() for c in columns]
+        out.write(''.join('\t'.join(map(str, row)) + '\n' for row in zip(*values)))
+
+
+class TableWriter:
+    """stream rows (orthogroups) of a 0/1 presence table to a binary presence table"""
+
+    def __init__(self, path, organisms, **meta):
+        os.makedirs(path, exist_ok=True)
+        self.path = path
+        self.meta = dict(format=TABLE_FORMAT, version=1, rows=0, organisms=list(organisms), **meta)
+        self.ogs = open(os.path.join(path, 'ogs.txt'), 'w')
+        self.descriptions = open(os.path.join(path, 'descriptions.txt'), 'w')
+        self.bits = _NpyColumn(os.path.join(path, 'bits.npy'), np.uint8, ((len(organisms) + 7) // 8,))
+
+    def write(self, names, values, descriptions=None):
+        """names, 0/1 (or gene count) rows in organism order and descriptions of orthogroups"""
+        values = np.asarray(values)
+        if values.shape != (len(names), len(self.meta['organisms'])):
+            raise ValueError('rows do not match the names and organisms')
+        self.bits.append(np.packbits(values > 0, axis=1))
+        self.ogs.writelines(f'{x}\n' for x in names)
+        self.descriptions.writelines(f"{str(x).replace(chr(9), ' ').replace(chr(10), ' ')}\n"
+                                     for x in (descriptions if descriptions is not None else [''] * len(names)))
+        self.meta['rows'] += len(names)
+
+    def close(self):
+        self.bits.close()
+        self.ogs.close()
+        self.descriptions.close()
+        with open(os.path.join(self.path, 'meta.json'), 'w') as f:
+            json.dump(self.meta, f, indent=1)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+def read_table(path, mmap_mode='r'):
+    """(meta, ogs, descriptions, bits) of a binary presence table (bits: packed rows, np.unpackbits
+    with count=len(meta['organisms']))"""
+    with open(os.path.join(path, 'meta.json')) as f:
+        meta = json.load(f)
+    if meta.get('format') != TABLE_FORMAT:
+        raise ValueError(f'{path}: not a {TABLE_FORMAT} table')
+    with open(os.path.join(path, 'ogs.txt')) as f:
+        ogs = f.read().splitlines()
+    descriptions = None
+    if os.path.isfile(os.path.join(path, 'descriptions.txt')):
+        with open(os.path.join(path, 'descriptions.txt')) as f:
+            descriptions = f.read().splitlines()
+    return meta, ogs, descriptions, np.load(os.path.join(path, 'bits.npy'), mmap_mode=mmap_mode)
+
+
+def row_hashes(tr, rows=1 << 16):
+    """64-bit content hash of each row of a transition matrix"""
+    out = np.empty(len(tr), dtype=np.uint64)
+    for s in range(0, len(tr), rows):
+        block = np.ascontiguousarray(tr[s:s + rows])
+        out[s:s + len(block)] = np.frombuffer(b''.join(hashlib.blake2b(r.tobytes(), digest_size=8).digest()
+                                                       for r in block), dtype='<u8')
+    return out
+
+
+def file_key(path, chunk=1 << 20):
+    """hash of the file content (of the table files of a presence table directory)"""
+    h = hashlib.blake2b(digest_size=8)
+    for name in (TABLE_FILES if os.path.isdir(path) else ('',)):
+        with open(os.path.join(path, name) if name else path, 'rb') as f:
+            for block in iter(lambda: f.read(chunk), b''):
+                h.update(block)
+    return h.hexdigest()
+
+
+def iter_table(path, cells=CHUNK_CELLS):
+    """(OG names, values) of a tab-separated gene occurrence table (or of a binary
+    presence table), by chunks of rows"""
+    if os.path.isdir(path):
+        meta, ogs, _, bits = read_table(path)
+        norgs = len(meta['organisms'])
+        rows = max(1, cells // max(1, norgs))
+        for s in range(0, len(ogs), rows):
+            yield ogs[s:s + rows], np.unpackbits(bits[s:s + rows], axis=1, count=norgs)
+        return
+    with open(path) as f:
+        ncols = next((line.count('\t') for line in f if not line.startswith('#')), 0)
+    for chunk in pd.read_table(path, header=None, index_col=0, comment='#',
+                               chunksize=max(1, cells // max(1, ncols))):
+        yield [str(x) for x in chunk.index], chunk.values
+
+
+def cache_dir(option=None):
+    """cache directory of a --cache/--ptable option: the given directory, None for
+    "none", else $XDG_CACHE_HOME/cotransitions (~/.cache/cotransitions)"""
+    if option == 'none':
+        return None
+    return option or os.path.join(os.environ.get('XDG_CACHE_HOME') or os.path.join(os.path.expanduser('~'), '.cache'),
+                                  'cotransitions')
+
+
+def load_transitions(path, count_consecutive=False, cache_dir=None, cells=CHUNK_CELLS):
+    """(ogs, tr, tt) of a gene occurrence table: OG names, signed int8 transitions
+    (cotr_lib.transitions) and total transitions per OG
+
+    the table is read and encoded by chunks of rows; with cache_dir the chunks
+    are streamed to a directory in it named by the table, its hash and
+    count_consecutive, which is memory-mapped (and reused when it exists)"""
+    if cache_dir is None:
+        ogs, trs = [], []
+        for names, values in iter_table(path, cells):
+            ogs += names
+            trs.append(cotr_lib.transitions(values, count_consecutive))
+        tr = np.concatenate(trs) if trs else np.zeros((0, 0), dtype=np.int8)
+        return ogs, tr, np.count_nonzero(tr, axis=1)
+    mode = 'c' if count_consecutive else 'p'
+    prefix = os.path.join(cache_dir, os.path.basename(path))
+    sidecar = f'{prefix}.{file_key(path)}.{mode}.cotr'
+    if not os.path.isfile(os.path.join(sidecar, 'ogs.txt')):
+        try:
+            _save_transitions(sidecar, path, count_consecutive, cells)
+        except OSError as e: # read-only directory: run without the cache
+            sys.stderr.write(f"transition cache not written: {e}\n")
+            return load_transitions(path, count_consecutive, None, cells)
+        for stale in glob.glob(f'{glob.escape(prefix)}.*.{mode}.cotr'):
+            if stale != sidecar:
+                shutil.rmtree(stale, ignore_errors=True)
+    with open(os.path.join(sidecar, 'ogs.txt')) as f:
+        ogs = f.read().splitlines()
+    return (ogs, np.load(os.path.join(sidecar, 'tr.npy'), mmap_mode='r'),
+            np.load(os.path.join(sidecar, 'tt.npy'), mmap_mode='r'))
+
+
+def _save_transitions(sidecar, path, count_consecutive, cells):
+    tmp = f'{sidecar}.{os.getpid()}.tmp'
+    os.makedirs(tmp, exist_ok=True)
+    tr_file, tt_file = None, _NpyColumn(os.path.join(tmp, 'tt.npy'), np.int32)
+    with open(os.path.join(tmp, 'ogs.part'), 'w') as f:
+        for names, values in iter_table(path, cells):
+            tr = cotr_lib.transitions(values, count_consecutive)
+            if tr_file is None:
+                tr_file = _NpyColumn(os.path.join(tmp, 'tr.npy'), np.int8, tr.shape[1:])
+            tr_file.append(tr)
+            tt_file.append(np.count_nonzero(tr, axis=1))
+            f.writelines(f'{x}\n' for x in names)
+    for col in (tr_file or _NpyColumn(os.path.join(tmp, 'tr.npy'), np.int8, (0,)), tt_file):
+        col.close()
+    os.rename(os.path.join(tmp, 'ogs.part'), os.path.join(tmp, 'ogs.txt')) # marks a complete cache
+    try:
+        os.rename(tmp, sidecar)
+    except OSError: # written meanwhile by another run
+        shutil.rmtree(tmp, ignore_errors=True)
+
+
+@contextlib.contextmanager
+def open_compressed(path, bufsize=1 << 20):
+    """binary stream of a file (a .gz is decompressed by a pigz/zcat process if found)"""
+    tool = path.endswith('.gz') and (shutil.which('pigz') or shutil.which('zcat'))
+    if tool:
+        proc = subprocess.Popen([tool, '-dc', path], stdout=subprocess.PIPE, bufsize=bufsize)
+        stream = proc.stdout
+    else:
+        proc, stream = None, gzip.open(path, 'rb') if path.endswith('.gz') else open(path, 'rb')
+    try:
+        yield stream
+    finally:
+        stream.close()
+        if proc is not None:
+            proc.wait()
+
+
+def bounded(chunks, slots):
+    """chunks handed over only while fewer than the slots are waiting to be merged
+    (pool.imap reads its input eagerly); release a slot for each result used"""
+    for chunk in chunks:
+        slots.acquire()
+        yield chunk
+
+
+class SortedRuns:
+    """rows (column arrays) merged back in order of a key column, with bounded memory
+
+    rows are buffered and, above max_rows, sorted by key and written as a run of
+    .npy files to a temporary directory; merge() streams all the rows by key,
+    ties in order of addition"""
+
+    def __init__(self, columns, key, max_rows=None, directory=None):
+        self.columns, self.key = list(columns), key
+        self.max_rows, self.directory = max_rows or SPILL_ROWS, directory
+        self.buffer, self.buffered, self.runs, self.rows = [], 0, [], 0
+        self.tmp = None
+
+    def __len__(self):
+        return self.rows
+
+    def add(self, **arrays):
+        n = len(arrays[self.key])
+        self.buffer.append({c: np.asarray(arrays[c]) for c in self.columns})
+        self.buffered += n
+        self.rows += n
+        if self.buffered > self.max_rows:
+            self._spill()
+
+    def _sorted_buffer(self):
+        rows = {c: np.concatenate([b[c] for b in self.buffer]) for c in self.columns}
+        order = np.argsort(rows[self.key], kind='stable')
+        self.buffer, self.buffered = [], 0
+        return {c: a[order] for c, a in rows.items()}
+
+    def _spill(self):
+        if self.tmp is None:
+            self.tmp = tempfile.mkdtemp(prefix='cotr.runs.', dir=self.directory)
+        path = os.path.join(self.tmp, f'run.{len(self.runs):05d}')
+        os.makedirs(path)
+        rows = self._sorted_buffer()
+        for c, a in rows.items():
+            np.save(os.path.join(path, f'{c}.npy'), a)
+        self.runs.append({c: np.load(os.path.join(path, f'{c}.npy'), mmap_mode='r') for c in self.columns})
+
+    def merge(self, chunk=1 << 20):
+        """dicts of column arrays with all the rows, in key order"""
+        if self.runs and self.buffered:
+            self._spill()
+        if self.runs:
+            runs = self.runs
+        else: # all in memory, kept sorted for another merge
+            runs = [self._sorted_buffer()] if self.buffered else []
+            self.buffer, self.buffered = runs[:], self.rows
+        pos = [0] * len(runs)
+        size = [len(r[self.key]) for r in runs]
+        while True:
+            live = [n for n in range(len(runs)) if pos[n] < size[n]]
+            if not live:
+                return
+            # rows below the smallest key ending a chunk (of runs with more rows) are complete
+            limit = min((runs[n][self.key][pos[n] + chunk - 1] for n in live
+                         if pos[n] + chunk < size[n]), default=np.inf)
+            take = []
+            for n in live:
+                head = runs[n][self.key][pos[n]:pos[n] + chunk]
+                take.append((n, pos[n] + int(np.searchsorted(head, limit, 'left' if limit < np.inf else 'right'))))
+            if all(stop == pos[n] for n, stop in take): # ties at the limit: each run in turn
+                for n in live:
+                    while pos[n] < size[n] and runs[n][self.key][pos[n]] == limit:
+                        head = runs[n][self.key][pos[n]:pos[n] + chunk]
+                        stop = pos[n] + int(np.searchsorted(head, limit, 'right'))
+                        yield {c: np.asarray(runs[n][c][pos[n]:stop]) for c in self.columns}
+                        pos[n] = stop
+                continue
+            parts = {c: np.concatenate([runs[n][c][pos[n]:stop] for n, stop in take]) for c in self.columns}
+            for n, stop in take:
+                pos[n] = stop
+            order = np.argsort(parts[self.key], kind='stable')
+            yield {c: a[order] for c, a in parts.items()}
+
+    def array(self, dtype=float):
+        """an array with a value for each row (memory-mapped next to spilled runs)"""
+        if self.tmp is None:
+            return np.empty(self.rows, dtype=dtype)
+        return np.lib.format.open_memmap(os.path.join(self.tmp, f'array.{len(os.listdir(self.tmp))}.npy'),
+                                         mode='w+', dtype=dtype, shape=(self.rows,))
+
+    def close(self):
+        self.runs, self.buffer = [], []
+        if self.tmp is not None:
+            shutil.rmtree(self.tmp, ignore_errors=True)
+            self.tmp = None
+
+
+class Checkpoint:
+    """row blocks of an all-pairs run saved in a directory, to resume or merge a run
+
+    manifest.json records the inputs (file hashes), the parameters that change
+    the stored pairs and the row blocks; each finished block is a directory
+    block.NNNNN with one binary pair table per orientation (renamed into place
+    when complete, so several processes can share the directory); matrix/ keeps
+    the OG names and transition matrix of every orientation, with row hashes,
+    for incremental updates of the run (--update)"""
+
+    def __init__(self, directory, manifest, blocks, resume=False):
+        self.directory = directory
+        path = os.path.join(directory, 'manifest.json')
+        manifest = dict(format='cotr-checkpoint', version=1, **manifest)
+        if os.path.isfile(path):
+            with open(path) as f:
+                saved = json.load(f)
+            if not resume:
+                raise ValueError(f'{directory}: checkpoint exists (use --resume)')
+            blocks = saved.pop('blocks')
+            if saved != json.loads(json.dumps(manifest)):
+                raise ValueError(f'{directory}: checkpoint made with other inputs or parameters')
+        else:
+            os.makedirs(directory, exist_ok=True)
+            tmp = f'{path}.{os.getpid()}.tmp'
+            with open(tmp, 'w') as f:
+                json.dump(dict(manifest, blocks=[[int(a), int(b)] for a, b in blocks]), f, indent=1)
+            os.replace(tmp, path)
+        self.blocks = [tuple(b) for b in blocks]
+        self.norgs = manifest.get('orgs', 0)
+
+    @classmethod
+    def open(cls, directory):
+        """an existing checkpoint, with its manifest (checkpoint.manifest)"""
+        with open(os.path.join(directory, 'manifest.json')) as f:
+            saved = json.load(f)
+        if saved.get('format') != 'cotr-checkpoint':
+            raise ValueError(f'{directory}: not a checkpoint')
+        saved.pop('format'), saved.pop('version')
+        blocks = saved.pop('blocks')
+        checkpoint = cls(directory, saved, blocks, resume=True)
+        checkpoint.manifest = saved
+        return checkpoint
+
+    def save_matrix(self, names, trs):
+        """keep the OG names and transition matrices (one per orientation, same rows)"""
+        path = os.path.join(self.directory, 'matrix')
+        if os.path.isdir(path):
+            return
+        tmp = f'{path}.{os.getpid()}.tmp'
+        os.makedirs(tmp, exist_ok=True)
+        with open(os.path.join(tmp, 'ogs.txt'), 'w') as f:
+            f.writelines(f'{x}\n' for x in names)
+        for o, tr in enumerate(trs):
+            col = _NpyColumn(os.path.join(tmp, f'tr.{o}.npy'), np.int8, tr.shape[1:])
+            for s in range(0, len(tr), 1 << 16):
+                col.append(tr[s:s + (1 << 16)])
+            col.close()
+            np.save(os.path.join(tmp, f'rows.{o}.npy'), row_hashes(tr))
+        try:
+            os.rename(tmp, path)
+        except OSError: # saved meanwhile by another process
+            shutil.rmtree(tmp, ignore_errors=True)
+
+    def matrix(self):
+        """(ogs, transition matrices, row hashes) saved by save_matrix (memory-mapped)"""
+        path = os.path.join(self.directory, 'matrix')
+        if not os.path.isfile(os.path.join(path, 'ogs.txt')):
+            raise ValueError(f'{self.directory}: no transition matrix saved in the checkpoint')
+        with open(os.path.join(path, 'ogs.txt')) as f:
+            ogs = f.read().splitlines()
+        n = len(glob.glob(os.path.join(path, 'tr.*.npy')))
+        return (ogs, [np.load(os.path.join(path, f'tr.{o}.npy'), mmap_mode='r') for o in range(n)],
+                [np.load(os.path.join(path, f'rows.{o}.npy')) for o in range(n)])
+
+    def block_path(self, n):
+        return os.path.join(self.directory, f'block.{n:05d}')
+
+    def pending(self):
+        """numbers of the blocks not done yet"""
+        return [n for n in range(len(self.blocks)) if not os.path.isdir(self.block_path(n))]
+
+    def write(self, n, tile):
+        tmp = f'{self.block_path(n)}.{os.getpid()}.tmp'
+        for o, pairs in enumerate(tile):
+            with PairWriter(os.path.join(tmp, str(o)), None, self.norgs, ('i', 'j', 'c', 'd', 'k'),
+                            tested=int(pairs.tested), evaluated=int(pairs.evaluated)) as out:
+                out.write(i=pairs.i, j=pairs.j, c=pairs.c, d=pairs.d, k=pairs.k)
+        try:
+            os.rename(tmp, self.block_path(n))
+        except OSError: # done meanwhile by another process
+            shutil.rmtree(tmp, ignore_errors=True)
+
+    def read(self, n):
+        """Pairs of every orientation of block n (as cotr_lib.iter_multi_pairs)"""
+        tile, o = [], 0
+        while os.path.isdir(os.path.join(self.block_path(n), str(o))):
+            meta, _, a = read_pairs(os.path.join(self.block_path(n), str(o)))
+            c, d = a['c'].astype(np.int32), a['d'].astype(np.int32)
+            tile.append(cotr_lib.Pairs(a['i'].astype(np.intp), a['j'].astype(np.intp), c, d, c - d,
+                                       meta['tested'], meta['evaluated']))
+            o += 1
+        return tile
+
+    def store(self, pending, computed):
+        """save the computed tiles of the pending blocks (in order) as they come"""
+        for n, tile in zip(pending, computed):
+            self.write(n, tile)
+            yield n, tile
+
+    def update(self, old, names, hashes, engines, cutoffs, backend='auto'):
+        """fill all the blocks from an earlier run of the same parameters (old checkpoint)
+
+        pairs of unchanged rows (same OG and row hash in every orientation) are
+        copied, the pairs of new or changed rows are scored (cutoffs as
+        block_pairs); the tested count of pairs of old rows changed or removed
+        is scored on the old matrix and taken off (with min_transitions > 0).
+        The tested pairs not stored (below a p cutoff) are counted in the first
+        block, with the evaluated pairs: those scored, and the pairs of unchanged
+        rows that the transition bounds (cutoffs feasible table) do not skip.
+        Returns the row indices scored"""
+        ngenes = len(names)
+        old_ogs, old_trs, old_hashes = old.matrix()
+        pos = pd.Index(old_ogs).get_indexer(names)
+        same = pos >= 0
+        for h, oh in zip(hashes, old_hashes):
+            same &= oh[np.maximum(pos, 0)] == h
+        remap = np.full(len(old_ogs), -1, dtype=np.int64)
+        remap[pos[same]] = np.flatnonzero(same)
+        changed, stale = np.flatnonzero(~same), np.flatnonzero(remap < 0)
+        streams, tested, evaluated = [], [], []
+        for o, (engine, cut) in enumerate(zip(engines, cutoffs)):
+            m = cut.get('min_transitions', 0)
+            runs, count = SortedRuns(('key', 'c', 'd'), 'key'), 0
+            for n in range(len(old.blocks)):
+                meta, _, a = read_pairs(os.path.join(old.block_path(n), str(o)))
+                count += meta['tested']
+                i, j = remap[a['i']], remap[a['j']]
+                keep = (i >= 0) & (j >= 0)
+                runs.add(key=np.minimum(i, j)[keep] * ngenes + np.maximum(i, j)[keep],
+                         c=a['c'][keep].astype(np.int32), d=a['d'][keep].astype(np.int32))
+            new = cotr_lib.query_pairs(engine, changed, ngenes, m)
+            keep = np.abs(new.k) >= (cut['kmin'][cut['tt'][new.i], cut['tt'][new.j]] if 'kmin' in cut else 0)
+            runs.add(key=np.minimum(new.i, new.j)[keep].astype(np.int64) * ngenes + np.maximum(new.i, new.j)[keep],
+                     c=new.c[keep], d=new.d[keep])
+            if m > 0 and len(stale): # tested pairs of the old rows, scored on the old matrix
+                t01, t10 = cotr_lib.transition_matrices(old_trs[o])
+                count -= cotr_lib.query_pairs(cotr_lib.prepare(t01, t10, backend), stale, len(old_ogs), m).tested
+            tested.append(count + new.tested)
+            if 'feasible' in cut: # unchanged pairs by total transitions (t1, t2)
+                h = np.bincount(cut['tt'][same], minlength=len(cut['feasible']))
+                f = cut['feasible'].astype(np.int64)
+                evaluated.append(new.evaluated + int(h @ f @ h - np.diag(f) @ h) // 2)
+            else:
+                evaluated.append(new.evaluated + int(same.sum()) * (int(same.sum()) - 1) // 2)
+            streams.append((runs, self._blocks(runs, ngenes)))
+        for n, parts in enumerate(zip(*(s for _, s in streams))):
+            start, stop = self.blocks[n]
+            tile = []
+            for o, (i, j, c, d) in enumerate(parts):
+                if cutoffs[o].get('min_transitions', 0) <= 0: # every pair is tested
+                    count = (stop - start) * (2 * ngenes - start - stop - 1) // 2
+                else: # first block: also the tested pairs not stored
+                    count = len(i) + (tested[o] - len(streams[o][0]) if n == 0 else 0)
+                tile.append(cotr_lib.Pairs(i, j, c, d, c - d, count, evaluated[o] if n == 0 else 0))
+            self.write(n, tile)
+        for runs, _ in streams:
+            runs.close()
+        return changed
+
+    def _blocks(self, runs, ngenes):
+        """(i, j, c, d) of the rows of each block, from runs keyed by i*ngenes+j"""
+        chunks, rest = runs.merge(), None
+        for _, stop in self.blocks:
+            parts = []
+            while True:
+                rest = rest if rest is not None else next(chunks, None)
+                if rest is None:
+                    break
+                cut = int(np.searchsorted(rest['key'], stop * ngenes))
+                parts.append({x: a[:cut] for x, a in rest.items()})
+                if cut < len(rest['key']):
+                    rest = {x: a[cut:] for x, a in rest.items()}
+                    break
+                rest = None
+            key, c, d = ((np.concatenate([p[x] for p in parts]) if parts else np.empty(0, dtype=np.int64))
+                         for x in ('key', 'c', 'd'))
+            yield key // ngenes, key % ngenes, c, d
+
+    def tiles(self, pending, computed):
+        """tiles of all blocks in order: saved ones read back, pending ones computed"""
+        stored = self.store(pending, computed)
+        pending = set(pending)
+        for n in range(len(self.blocks)):
+            yield next(stored)[1] if n in pending else self.read(n)
+
+
+if __name__ == '__main__':
+    if len(sys.argv) != 2:
+        sys.exit(f'usage: {sys.argv[0]} pairs_dir > pairs.tsv')
+    write_tsv(sys.argv[1])
@@ -0,0 +1,495 @@
+# coding: utf-8
+#
+# Concordance engine for cotr_transitions.py
+#
+# Transitions are encoded as two boolean matrices (genes by positions):
+# t01 (0->1) and t10 (1->0). For a block of gene pairs the concordant and
+# discordant counts are obtained with matrix products instead of set
+# intersections:
+#   c = T01.T01' + T10.T10'    d = T10.T01' + T01.T10'
+# computed through the signed (S = T01-T10) and total (P = T01|T10) matrices:
+#   S.S' = c - d = k           P.P' = c + d
+# or, for sparse matrices, by walking only the co-occurring transitions
+# through an inverted index (genes by position).
+#
+import multiprocessing
+import os
+from collections import namedtuple
+from multiprocessing import shared_memory
+
+import numpy as np
+
+import cotr_stats
+
+BACKENDS = ('dense', 'bitset', 'sparse')
+
+SPARSE_DENSITY = 0.02  # auto backend: sparse below this fraction of transitions
+
+BLOCK_CELLS = 1 << 24  # pair cells computed at once (rows x columns per block)
+
+
+def transitions(values, count_consecutive=False):
+    """signed transition matrix (int8) from a genes x organisms table
+
+    1 for increasing (0->1), -1 for decreasing (1->0) transitions, 0 otherwise;
+    the first column is never a transition. Unless count_consecutive is set,
+    the second of two consecutive opposite transitions (e.g. 101) is dropped."""
+    values = np.asarray(values)
+    if values.dtype.kind in 'ub':  # no wrap-around in diff
+        values = values.astype(np.int16)
+    tr = np.zeros(values.shape, dtype=np.int8, order='F')  # column-major for the scan below
+    if values.shape[1] > 1:
+        tr[:, 1:] = np.sign(np.diff(values, axis=1))  # increasing (1) or decreasing (-1) only
+    if not count_consecutive:  # count only once consecutive state transitions (-1,1)
+        for j in range(2, tr.shape[1]):
+            col = tr[:, j]
+            col[tr[:, j-1] == -col] = 0
+    return np.ascontiguousarray(tr)
+
+
+def transition_matrices(tr):
+    """0->1 and 1->0 boolean matrices from a signed transition matrix"""
+    tr = np.asarray(tr)
+    return tr > 0, tr < 0
+
+
+## dense backend: float32 BLAS products (exact for counts < 2**24)
+
+def _dense_operands(t01, t10):
+    s = t01.astype(np.float32) - t10.astype(np.float32)
+    p = (t01 | t10).astype(np.float32)
+    return s, p
+
+
+def _dense_block(ops, rows, cols):
+    s, p = ops
+    k = s[rows] @ s[cols].T
+    cd = p[rows] @ p[cols].T
+    k = np.rint(k).astype(np.int32)
+    cd = np.rint(cd).astype(np.int32)
+    return (cd + k) // 2, (cd - k) // 2
+
+
+def _dense_pairs(ops, i, j):
+    s, p = ops
+    k = np.rint(np.einsum('ij,ij->i', s[i], s[j])).astype(np.int32)
+    cd = np.rint(np.einsum('ij,ij->i', p[i], p[j])).astype(np.int32)
+    return (cd + k) // 2, (cd - k) // 2
+
+
+## bitset backend: transitions packed in uint64 words, counts by popcount
+
+_POPCOUNT8 = np.array([bin(x).count('1') for x in range(256)], dtype=np.uint8)
+
+
+def _popcount(words):
+    if hasattr(np, 'bitwise_count'):  # numpy >= 2.0
+        return np.bitwise_count(words).sum(axis=-1, dtype=np.int32)
+    nbytes = words.shape[-1] * 8
+    return _POPCOUNT8[words.view(np.uint8).reshape(words.shape[:-1] + (nbytes,))
+                      ].sum(axis=-1, dtype=np.int32)
+
+
+def pack_bits(m):
+    """pack a boolean matrix by rows into uint64 words"""
+    packed = np.packbits(m, axis=1)
+    pad = -packed.shape[1] % 8
+    if pad or not packed.shape[1]:
+        packed = np.pad(packed, ((0, 0), (0, pad or 8)))
+    return np.ascontiguousarray(packed).view(np.uint64)
+
+
+def _bitset_operands(t01, t10):
+    return pack_bits(t01), pack_bits(t10)
+
+
+def _bitset_block(ops, rows, cols, chunk=256):
+    b01, b10 = ops
+    r01, r10 = b01[rows][:, None, :], b10[rows][:, None, :]
+    c = np.empty((len(rows), len(cols)), dtype=np.int32)
+    d = np.empty_like(c)
+    for s in range(0, len(cols), chunk):
+        c01, c10 = b01[cols[s:s+chunk]][None], b10[cols[s:s+chunk]][None]
+        c[:, s:s+chunk] = _popcount(r01 & c01) + _popcount(r10 & c10)
+        d[:, s:s+chunk] = _popcount(r10 & c01) + _popcount(r01 & c10)
+    return c, d
+
+
+def _bitset_pairs(ops, i, j):
+    b01, b10 = ops
+    c = _popcount(b01[i] & b01[j]) + _popcount(b10[i] & b10[j])
+    d = _popcount(b10[i] & b01[j]) + _popcount(b01[i] & b10[j])
+    return c, d
+
+
+## sparse backend: transition positions by gene (CSR) and genes by position
+## (inverted index); counts accumulate over co-occurring transitions only
+
+def expand_ranges(starts, counts):
+    """concatenated ranges starts[x] .. starts[x]+counts[x]-1"""
+    ends = np.cumsum(counts)
+    return np.repeat(starts - ends + counts, counts) + np.arange(ends[-1] if len(ends) else 0)
+
+
+def spans(sizes, cells):
+    """(a, b) runs of consecutive items adding up to about cells"""
+    total = np.cumsum(sizes)
+    a = 0
+    while a < len(sizes):
+        b = max(a + 1, int(np.searchsorted(total, (total[a-1] if a else 0) + cells, 'right')))
+        yield a, b
+        a = b
+
+
+def _sparse_operands(t01, t10):
+    s = np.asarray(t01, dtype=np.int8) - np.asarray(t10, dtype=np.int8)
+    genes, pos = np.nonzero(s)  # by gene, then position
+    sign = s[genes, pos]
+    indptr = np.concatenate([[0], np.cumsum(np.bincount(genes, minlength=s.shape[0]))])
+    cindptr = np.concatenate([[0], np.cumsum(np.bincount(pos, minlength=s.shape[1]))])
+    inverted = np.argsort(pos, kind='stable')  # by position, then gene
+    return (indptr, pos.astype(np.int32), sign,
+            cindptr, genes[inverted].astype(np.int32), sign[inverted])
+
+
+def _sparse_block(ops, rows, cols, cells=BLOCK_CELLS):
+    indptr, pos, sign, cindptr, cgenes, csign = ops
+    local = np.full(len(indptr) - 1, -1, dtype=np.intp)
+    local[cols] = np.arange(len(cols))
+    size = len(rows) * len(cols)
+    c, d = np.zeros(size, dtype=np.int32), np.zeros(size, dtype=np.int32)
+    n = indptr[rows + 1] - indptr[rows]
+    r = np.repeat(np.arange(len(rows)), n)  # transitions of the rows
+    e = expand_ranges(indptr[rows], n)
+    q, sq = pos[e], sign[e]
+    deg = cindptr[q + 1] - cindptr[q]  # genes sharing each transition position
+    for a, b in spans(deg, cells):
+        g = expand_ranges(cindptr[q[a:b]], deg[a:b])
+        col = local[cgenes[g]]
+        hit = col >= 0
+        cell = np.repeat(r[a:b], deg[a:b])[hit] * len(cols) + col[hit]
+        same = (np.repeat(sq[a:b], deg[a:b]) == csign[g])[hit]
+        c += np.bincount(cell[same], minlength=size).astype(np.int32)
+        d += np.bincount(cell[~same], minlength=size).astype(np.int32)
+    return c.reshape(len(rows), len(cols)), d.reshape(len(rows), len(cols))
+
+
+def _sparse_pairs(ops, i, j, cells=BLOCK_CELLS):
+    indptr, pos, sign, cindptr, _, _ = ops
+    norgs = len(cindptr) - 1
+    key = np.repeat(np.arange(len(indptr) - 1, dtype=np.int64), np.diff(indptr)) * norgs + pos
+    c, d = np.zeros(len(i), dtype=np.int32), np.zeros(len(i), dtype=np.int32)
+    if not len(key):
+        return c, d
+    n = indptr[i + 1] - indptr[i]
+    for a, b in spans(n, cells):  # transitions of i looked up in j
+        p = np.repeat(np.arange(b - a), n[a:b])
+        e = expand_ranges(indptr[i[a:b]], n[a:b])
+        q = j[a:b][p].astype(np.int64) * norgs + pos[e]
+        hit = np.minimum(np.searchsorted(key, q), len(key) - 1)
+        found = key[hit] == q
+        same = sign[e] == sign[hit]
+        c[a:b] += np.bincount(p[found & same], minlength=b - a).astype(np.int32)
+        d[a:b] += np.bincount(p[found & ~same], minlength=b - a).astype(np.int32)
+    return c, d
+
+
+_ENGINES = {  # operands, rows x cols block, list of pairs
+    'dense': (_dense_operands, _dense_block, _dense_pairs),
+    'bitset': (_bitset_operands, _bitset_block, _bitset_pairs),
+    'sparse': (_sparse_operands, _sparse_block, _sparse_pairs),
+}
+
+
+def choose_backend(t01, t10):
+    """sparse for matrices with few transitions, dense otherwise"""
+    cells = max(1, np.asarray(t01).size)
+    density = (np.count_nonzero(t01) + np.count_nonzero(t10)) / cells
+    return 'sparse' if density < SPARSE_DENSITY else 'dense'
+
+
+def prepare(t01, t10, backend='dense'):
+    """backend operands for concordance() (backend 'auto': choose_backend)"""
+    if backend == 'auto':
+        backend = choose_backend(t01, t10)
+    if backend not in _ENGINES:
+        raise ValueError(f"unknown backend {backend!r} (choose from auto, {', '.join(BACKENDS)})")
+    return backend, _ENGINES[backend][0](t01, t10)
+
+
+def concordance(engine, rows, cols):
+    """concordant and discordant counts of rows x cols (index arrays)"""
+    backend, ops = engine
+    return _ENGINES[backend][1](ops, np.asarray(rows), np.asarray(cols))
+
+
+def pair_concordance(engine, i, j):
+    """concordant and discordant counts of the pairs (i[n], j[n])"""
+    backend, ops = engine
+    i, j = np.asarray(i, dtype=np.intp), np.asarray(j, dtype=np.intp)
+    # sparse kernels bound their own memory
+    step = max(1, BLOCK_CELLS // max(1, ops[0].shape[1])) if ops[0].ndim == 2 else max(1, len(i))
+    c, d = np.empty(len(i), dtype=np.int32), np.empty(len(i), dtype=np.int32)
+    for s in range(0, len(i), step):
+        c[s:s+step], d[s:s+step] = _ENGINES[backend][2](ops, i[s:s+step], j[s:s+step])
+    return c, d
+
+
+def row_blocks(ngenes, block_size=None, workers=1):
+    """consecutive (start, stop) row ranges covering the upper triangle"""
+    if not block_size:
+        block_size = max(1, min(4096, BLOCK_CELLS // max(ngenes, 1)))
+        if workers > 1:  # several tiles per worker for load balance
+            block_size = max(1, min(block_size, ngenes // (8 * workers)))
+    return [(s, min(s + block_size, ngenes - 1)) for s in range(0, ngenes - 1, block_size)]
+
+
+Pairs = namedtuple('Pairs', 'i j c d k tested evaluated', defaults=(0,))
+
+
+def shard_blocks(blocks, ngenes, shard, nshards):
+    """numbers of the row blocks of shard (0-based) out of nshards
+
+    contiguous runs of blocks with about equal numbers of i<j pairs (rows near
+    the top of the matrix have more partners), the same for every shard"""
+    work = np.array([(b - a) * (2 * ngenes - a - b - 1) // 2 for a, b in blocks], dtype=float)
+    middle = np.cumsum(work) - work / 2
+    owner = np.minimum((middle * nshards / max(1, work.sum())).astype(int), nshards - 1)
+    return np.flatnonzero(owner == shard).tolist()
+
+
+def feasible_pairs(tmax, min_transitions=0, kmin=None):
+    """which (t1, t2) total transitions can give a pair passing the cutoffs
+
+    |k| <= min(t1, t2), so pairs below min_transitions (and the kmin table of
+    a p cutoff) can be skipped unscored; with min_transitions > 0 the kmin
+    bound would hide pairs counted as tested, so pass kmin only with 0"""
+    t = np.arange(tmax + 1)
+    bound = np.minimum.outer(t, t)
+    ok = bound >= min_transitions
+    if kmin is not None:
+        ok &= bound >= kmin[:tmax + 1, :tmax + 1]
+    return ok
+
+
+def block_pairs(engine, start, stop, ngenes, min_transitions=0, tt=None, kmin=None,
+                feasible=None, buckets=8):
+    """gene pairs i<j with i in [start,stop) and |k| >= min_transitions
+
+    with total transitions tt and a kmin table (cotr_stats.PValueTable.kmin)
+    pairs with |k| < kmin[t1,t2] (p above the cutoff) are counted as tested
+    but dropped. With a feasible table (feasible_pairs) rows are bucketed by
+    total transitions and each bucket is scored only against the columns that
+    can reach the cutoffs with it. Returns Pairs arrays in i<j order (as the
+    serial loop), with the number of pairs scored as evaluated"""
+    rows = np.arange(start, stop)
+    cols = np.arange(start + 1, ngenes)
+    if feasible is None:
+        groups = [(rows, cols)]
+    else:
+        rows = rows[feasible[tt[rows]].any(axis=1)]
+        cols = cols[feasible[tt[cols]].any(axis=1)]
+        groups = []
+        for b in np.array_split(np.argsort(tt[rows], kind='stable'), min(buckets, max(1, len(rows)))):
+            r = rows[np.sort(b)]
+            groups.append((r, cols[feasible[np.unique(tt[r])][:, tt[cols]].any(axis=0)]))
+    found, tested, evaluated = [], 0, 0
+    for rows, cols in groups:
+        if not len(rows) or not len(cols):
+            continue
+        c, d = concordance(engine, rows, cols)
+        k = np.abs(c - d)
+        upper = cols[None, :] > rows[:, None]
+        keep = (k >= min_transitions) & upper
+        tested += int(np.count_nonzero(keep))
+        evaluated += int(np.count_nonzero(upper))
+        if kmin is not None:
+            keep &= k >= kmin[tt[rows][:, None], tt[cols][None, :]]
+        ii, jj = np.nonzero(keep)
+        found.append((rows[ii], cols[jj], c[ii, jj], d[ii, jj]))
+    if min_transitions <= 0: # every pair is tested, scored or not
+        tested = (stop - start) * (2 * ngenes - start - stop - 1) // 2
+    i, j, c, d = (np.concatenate(x) for x in zip(*found)) if found else [np.empty(0, dtype=int)] * 4
+    if len(found) > 1:
+        order = np.lexsort((j, i))
+        i, j, c, d = i[order], j[order], c[order], d[order]
+    return Pairs(i, j, c, d, c - d, tested, evaluated)
+
+
+def query_pairs(engine, queries, ngenes, min_transitions=0):
+    """pairs of each query gene (row index) with every other gene, |k| >= min_transitions
+
+    a pair of two queries is reported once, for the first of them;
+    Pairs are in query order, then j order"""
+    queries = np.asarray(queries, dtype=np.intp)
+    queries = queries[np.sort(np.unique(queries, return_index=True)[1])]
+    qpos = np.full(ngenes, len(queries))
+    qpos[queries] = np.arange(len(queries))
+    cols = np.arange(ngenes)
+    step = max(1, BLOCK_CELLS // max(1, ngenes))
+    found, evaluated = [], 0
+    for s in range(0, len(queries), step):
+        rows = queries[s:s+step]
+        c, d = concordance(engine, rows, cols)
+        later = qpos[None, :] > np.arange(s, s + len(rows))[:, None]  # not self or earlier queries
+        keep = (np.abs(c - d) >= min_transitions) & later
+        evaluated += int(np.count_nonzero(later))
+        ii, jj = np.nonzero(keep)
+        found.append((rows[ii], cols[jj], c[ii, jj], d[ii, jj]))
+    i, j, c, d = (np.concatenate(x) for x in zip(*found)) if found else [np.empty(0, dtype=int)] * 4
+    return Pairs(i, j, c, d, c - d, len(i), evaluated)
+
+
+def list_pairs(engine, i, j, min_transitions=0):
+    """the given pairs (i[n], j[n]) with |k| >= min_transitions, in input order"""
+    i, j = np.asarray(i, dtype=np.intp), np.asarray(j, dtype=np.intp)
+    c, d = pair_concordance(engine, i, j)
+    keep = np.flatnonzero(np.abs(c - d) >= min_transitions)
+    return Pairs(i[keep], j[keep], c[keep], d[keep], c[keep] - d[keep], len(keep), len(i))
+
+
+class TopK:
+    """the n best partners of each gene (largest score, then smallest index)
+
+    a fixed ngenes x n table merged with each tile of scored pairs"""
+
+    def __init__(self, ngenes, n):
+        self.score = np.full((ngenes, n), -np.inf)
+        self.partner = np.full((ngenes, n), -1, dtype=np.intp)
+
+    def add(self, i, j, score):
+        owner, partner = np.concatenate([i, j]), np.concatenate([j, i])
+        score = np.concatenate([score, score]).astype(float)
+        worst, last = self.score[owner, -1], self.partner[owner, -1]
+        keep = (score > worst) | ((score == worst) & (partner < last))
+        if not keep.any():
+            return
+        owner, partner, score = owner[keep], partner[keep], score[keep]
+        owners = np.unique(owner)
+        n = self.score.shape[1]
+        owner = np.concatenate([np.repeat(owners, n), owner])
+        partner = np.concatenate([self.partner[owners].ravel(), partner])
+        score = np.concatenate([self.score[owners].ravel(), score])
+        order = np.lexsort((partner, -score, owner))
+        owner, partner, score = owner[order], partner[order], score[order]
+        rank = np.arange(len(owner)) - np.searchsorted(owner, owner)
+        best = rank < n
+        self.score[owner[best], rank[best]] = score[best]
+        self.partner[owner[best], rank[best]] = partner[best]
+
+    def pairs(self):
+        """(i, j) of the kept pairs, once each, in i<j order"""
+        n = self.score.shape[1]
+        i = np.repeat(np.arange(len(self.partner)), n)
+        j = self.partner.ravel()
+        i, j = i[j >= 0], j[j >= 0]
+        key = np.unique(np.minimum(i, j).astype(np.int64) * len(self.partner) + np.maximum(i, j))
+        return key // len(self.partner), key % len(self.partner)
+
+
+def iter_pairs(engine, ngenes, block_size=None, workers=1, **cutoffs):
+    """scored pairs by row tiles (block_pairs() with cutoffs), in i<j order"""
+    for pairs, in iter_multi_pairs([engine], ngenes, block_size, workers, [cutoffs]):
+        yield pairs
+
+
+def iter_multi_pairs(engines, ngenes, block_size=None, workers=1, cutoffs=None, tiles=None):
+    """scored pairs of several engines over the same genes (e.g. ladder orientations)
+
+    yields, for each row tile (row_blocks, or the given (start, stop) tiles),
+    a list with the block_pairs() of every engine (with the matching dict of cutoffs)"""
+    cutoffs = cutoffs or [{} for _ in engines]
+    if tiles is None:
+        tiles = row_blocks(ngenes, block_size, workers)
+    if not len(tiles):
+        return
+    if workers <= 1:
+        for start, stop in tiles:
+            yield [block_pairs(e, start, stop, ngenes, **cut) for e, cut in zip(engines, cutoffs)]
+        return
+    blocks, specs = [], []
+    for backend, ops in engines:
+        b, sp = _share(ops)
+        blocks += b
+        specs.append((backend, sp))
+    try:
+        # fork: the calling scripts are not import-safe (spawn would re-run them)
+        ctx = multiprocessing.get_context('fork')
+        with ctx.Pool(workers, _init_worker, (specs, ngenes, cutoffs)) as pool:
+            yield from pool.imap(_score_tile, tiles)  # ordered as the tiles
+    finally:
+        for shm in blocks:
+            shm.close()
+            shm.unlink()
+
+
+## multi-process scoring: backend operands in shared memory, one copy for all workers
+
+_worker = {}
+
+
+def _share(arrays):
+    blocks, specs = [], []
+    for a in arrays:
+        shm = shared_memory.SharedMemory(create=True, size=max(a.nbytes, 1))
+        np.ndarray(a.shape, a.dtype, buffer=shm.buf)[...] = a
+        blocks.append(shm)
+        specs.append((shm.name, a.shape, a.dtype.str))
+    return blocks, specs
+
+
+def _init_worker(specs, ngenes, cutoffs):
+    blocks, engines = [], []
+    for backend, arrays in specs:
+        shms = [shared_memory.SharedMemory(name=name) for name, _, _ in arrays]
+        ops = tuple(np.ndarray(shape, dtype, buffer=shm.buf)
+                    for shm, (_, shape, dtype) in zip(shms, arrays))
+        blocks += shms
+        engines.append((backend, ops))
+    _worker.update(blocks=blocks, engines=engines, ngenes=ngenes, cutoffs=cutoffs)
+
+
+def _score_tile(tile):
+    start, stop = tile
+    return [block_pairs(e, start, stop, _worker['ngenes'], **cut)
+            for e, cut in zip(_worker['engines'], _worker['cutoffs'])]
+
+
+def ladder_labels(files):
+    """distinct dot-separated part of file names (e.g. RL, LL, NL)"""
+    names = [os.path.basename(f).split('.') for f in files]
+    lead = len(os.path.commonprefix(names))
+    trail = len(os.path.commonprefix([n[::-1] for n in names]))
+    labels = ['.'.join(n[lead:len(n)-trail]) for n in names]
+    return labels if all(labels) and len(set(labels)) == len(labels) else [
+        str(x + 1) for x in range(len(files))]
+
+
+def format_pairs(names, norgs, tt, i, j, c, d, k):
+    """tab-separated lines as printed by cotr_transitions.py"""
+    orgs = str(norgs)
+    return ''.join(f"{names[a]}\t{names[b]}\t{orgs}\t{x1}\t{x2}\t{x}\t{y}\t{z}\n"
+                   for a, b, x1, x2, x, y, z in zip(i.tolist(), j.tolist(), tt[i].tolist(),
+                                                    tt[j].tolist(), c.tolist(), d.tolist(), k.tolist()))
+
+
+FISHER_HEADER = ('Orthogroup1', 'Orthogroup2', 'orgs', 't1', 't2', 'c', 'd', 'k',
+                 'k_score', 'p', 'p.adj')
+
+
+def format_fisher(names, norgs, tt, i, j, c, d, k, ks, p, padj, *extra, specs=None):
+    """tab-separated lines as written by cotr_Fisher.r (numbers with 5 digits)
+
+    extra: further columns (integer arrays or float arrays formatted as R);
+    specs: format_r specs of ks, p and padj for a table written in chunks"""
+    orgs = str(norgs)
+    ks, p, padj = (cotr_stats.format_r(x, spec=sp) for x, sp in zip((ks, p, padj), specs or (None,) * 3))
+    extra = [x.tolist() if x.dtype.kind in 'iu' else cotr_stats.format_r(x) for x in extra]
+    rows = zip(i.tolist(), j.tolist(), tt[i].tolist(), tt[j].tolist(),
+               c.tolist(), d.tolist(), k.tolist(), ks, p, padj)
+    if not extra:
+        return ''.join(f"{names[a]}\t{names[b]}\t{orgs}\t{x1}\t{x2}\t{x}\t{y}\t{z}\t{s}\t{q}\t{r}\n"
+                       for a, b, x1, x2, x, y, z, s, q, r in rows)
+    return ''.join(f"{names[a]}\t{names[b]}\t{orgs}\t{x1}\t{x2}\t{x}\t{y}\t{z}\t{s}\t{q}\t{r}\t"
+                   + '\t'.join(map(str, more)) + '\n'
+                   for (a, b, x1, x2, x, y, z, s, q, r), *more in zip(rows, *extra))
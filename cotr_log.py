@@ -0,0 +1,128 @@
+# coding: utf-8
+#
+# Run instrumentation: JSON-lines log of the stages of a run (wall time, peak
+# RSS) and of the progress of the pair loop (pairs/s, ETA, pairs emitted and
+# pruned), written periodically to size cluster jobs; optional profiler.
+#
+import atexit
+import json
+import os
+import resource
+import socket
+import sys
+import time
+
+INTERVAL = 30  # seconds between progress records
+
+
+def peak_rss_mb():
+    """peak resident memory (MB) of the process and of its largest finished child (workers)"""
+    return max(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+               resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss) // 1024
+
+
+def rss_mb():
+    """current resident memory (MB), 0 where /proc is not available"""
+    try:
+        with open('/proc/self/statm') as f:
+            return int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE') >> 20
+    except (OSError, ValueError):
+        return 0
+
+
+class RunLog:
+    """JSON-lines records of a run: start, end of every stage, progress, end
+
+    stages are sequential: stage(name) ends the current one; with no path
+    nothing is written (the calls cost nothing)"""
+
+    def __init__(self, path=None, interval=INTERVAL, **run):
+        self.file = open(path, 'a', buffering=1) if path else None
+        self.interval = interval
+        self.start = self.stage_start = self.last = time.time()
+        self.current = None
+        self.write('start', argv=sys.argv, host=socket.gethostname(), pid=os.getpid(), **run)
+
+    def write(self, event, **fields):
+        if self.file is None:
+            return
+        now = time.time()
+        record = dict(time=time.strftime('%Y-%m-%dT%H:%M:%S', time.localtime(now)), event=event,
+                      elapsed=round(now - self.start, 3))
+        if self.current and event != 'start':
+            record['stage'] = self.current
+        record.update(fields)
+        self.file.write(json.dumps(record) + '\n')
+
+    def stage(self, name=None, **fields):
+        """end the current stage (with fields) and start stage name"""
+        if self.current:
+            self.write('stage', seconds=round(time.time() - self.stage_start, 3),
+                       peak_rss_mb=peak_rss_mb(), rss_mb=rss_mb(), **fields)
+        self.current, self.stage_start = name, time.time()
+
+    def track(self, tiles, sizes=None, total=None):
+        """yield the tiles (lists of cotr_lib.Pairs) recording progress
+
+        sizes: pairs covered by each tile (row blocks), for the rate and ETA;
+        pairs emitted, tested and evaluated are those of the first orientation"""
+        sizes = iter(sizes) if sizes is not None else None
+        done = emitted = evaluated = tested = 0
+        started, written = time.time(), False
+        for tile in tiles:
+            yield tile
+            done += next(sizes, 0) if sizes is not None else 0
+            emitted += len(tile[0].i)
+            evaluated += tile[0].evaluated
+            tested += tile[0].tested
+            now = time.time()
+            written = self.file is not None and now - self.last >= self.interval
+            if written:
+                self.last = now
+                self._progress(started, done, total, emitted, evaluated, tested)
+        if self.file is not None and not written: # the last tile
+            self._progress(started, done, total, emitted, evaluated, tested)
+
+    def _progress(self, started, done, total, emitted, evaluated, tested):
+        seconds = max(time.time() - started, 1e-9)
+        fields = dict(pairs_done=done, pairs_total=total, pairs_emitted=emitted, pairs_tested=tested,
+                      pairs_evaluated=evaluated, pairs_pruned=max(0, done - evaluated) if done else None,
+                      pairs_per_s=round(done / seconds) if done else None)
+        if done and total:
+            fields.update(fraction=round(done / total, 4), eta_s=round(seconds * (total - done) / done))
+        self.write('progress', peak_rss_mb=peak_rss_mb(), rss_mb=rss_mb(), **fields)
+
+    def close(self, **summary):
+        """end the last stage and the run"""
+        self.stage()
+        self.write('end', seconds=round(time.time() - self.start, 3), peak_rss_mb=peak_rss_mb(), **summary)
+        if self.file is not None:
+            self.file.close()
+            self.file = None
+
+
+def profile(path):
+    """profile the rest of the run into path, written at exit: pyinstrument
+    HTML report for a .html path (when installed), else cProfile stats
+    (pstats / snakeviz); worker processes are not profiled"""
+    if path.endswith('.html'):
+        try:
+            import pyinstrument
+        except ImportError:
+            sys.exit('--profile: pyinstrument is not installed (use a .prof file for cProfile)')
+        profiler = pyinstrument.Profiler()
+        profiler.start()
+
+        def save():
+            profiler.stop()
+            with open(path, 'w') as f:
+                f.write(profiler.output_html())
+    else:
+        import cProfile
+        profiler = cProfile.Profile()
+        profiler.enable()
+
+        def save():
+            profiler.disable()
+            profiler.dump_stats(path)
+    atexit.register(save)
@@ -31,7 +31,7 @@ cd ${level}_HOGs_${date}_${n}
 curl https://v101.orthodb.org/download/odb10v1_levels.tab.gz -o HOGs_${level}_${taxonomy_database}_levels.tab.gz 2>>log.txt
 ${cwd}/Utilities/OMA_translator.py -t ${level} -d ${taxonomy_database} 2>>log.txt
 
-${cwd}/Utilities/procedure_Orthodb_read_tables.r -l $level -m 1 --odb HOGs_${level}_${taxonomy_database} 2>>log.txt
+${cwd}/cotr_tables.py read -l $level -m 1 --odb HOGs_${level}_${taxonomy_database} 2>>log.txt
 
 #taxonomy-constrained tree with RaxML 
 if [ $tree == 'raxml' ] 
@@ -39,22 +39,12 @@ then
 	raxmlHPC-PTHREADS -g $level.phylip.tree -s $level.phylip.data -n $level -m BINCAT -p 33 -T $ncores 2>>log.txt
 fi
 
-#order tables by trees
-for d in ${ladder[@]}; do
-    ${cwd}/Utilities/procedure_Orthodb_order_by_tree.r $level.RData -t $tree -d $d -o Viridiplantae 2>>log.txt &
-done
-wait
-
+#order tables by trees (binary presence tables, text tables of the first orientation)
+${cwd}/cotr_tables.py order $level.tables -t $tree -d ${ladder[@]} -o Viridiplantae --text ${ladder[0]} --log cotr.log.jsonl 2>>log.txt
 
-#cotr analysis
-for d in ${ladder[@]}; do
-    ${cwd}/cotr_transitions.py -m 4 $level.$tree.$d.csv.num 2>>log.txt| ${cwd}/cotr_Fisher.r -pa 1 -p 1e-3 - > $level.$tree.$d.transitions.annotated 2>>log.txt &
-done
-wait
 
-#results intersections
-cat $level.$tree.*.transitions.annotated | perl -anE 'print if ($F[7]>0 and $F[10]<1e-3 or $F[0]=~"Orthogroup")' | cut -f1,2 | sort | uniq -dc| grep -w ${#ladder[@]} | cut -b9- > $level.common.txt 
-grep -w -f $level.common.txt $level.$tree.${ladder[0]}.transitions.annotated > intersection.$level.$tree.${ladder[0]}.transitions.annotated
+#cotr analysis (all ladder orientations in one pass: pairs significant in all of them, p <= 1e-3 and p.adj <= 1e-3)
+${cwd}/cotr_transitions.py -m 4 -w $ncores --fisher -p 1e-3 -pa 1e-3 --log cotr.log.jsonl $(printf "$level.$tree.%s.presence " ${ladder[@]}) > intersection.$level.$tree.${ladder[0]}.transitions.annotated 2>>log.txt
 
-#cluster with mcl
-${cwd}/Utilities/procedure_mcl_clusters.pl $level.$tree.${ladder[0]}.csv intersection.$level.$tree.${ladder[0]}.transitions.annotated 2>>log.txt
+#cluster with mcl (sparse MCL in python; -I 1.4,2,4 for several inflations)
+${cwd}/cotr_clusters.py --log cotr.log.jsonl $level.$tree.${ladder[0]}.presence intersection.$level.$tree.${ladder[0]}.transitions.annotated 2>>log.txt
@@ -0,0 +1,203 @@
+# coding: utf-8
+#
+# Fisher probability, cotr score and multiple-test correction of gene pairs
+# (same statistics as cotr_Fisher.r, vectorized over numpy arrays)
+#
+import glob
+import math
+import os
+
+import numpy as np
+
+
+def k_score(k, t1, t2):
+    """Morandin formula"""
+    with np.errstate(divide='ignore', invalid='ignore'):
+        return k / (t1 + t2 - np.abs(k))
+
+
+def log_factorials(n):
+    """log(x!) for x in 0..n"""
+    return np.array([math.lgamma(x + 1) for x in range(n + 1)])
+
+
+class PValueTable:
+    """Fisher p-values of every (t1, t2, k) up to tmax transitions, for orgs organisms
+
+    p-values are symmetric in t1, t2 and stored by (t1 <= t2) rows of k = 0..t1;
+    with a directory the table is saved as .npy files named by orgs and tmax,
+    memory-mapped by later runs and rebuilt only when a larger tmax is needed"""
+
+    def __init__(self, orgs, tmax, directory=None):
+        self.orgs = orgs
+        tmax = min(tmax, orgs)
+        saved = sorted(glob.glob(os.path.join(directory, f'cotr_pvalues.{orgs}.*.offsets.npy'))
+                       if directory else [], key=lambda f: int(f.split('.')[-3]))
+        if saved and int(saved[-1].split('.')[-3]) >= tmax:
+            base = saved[-1][:-len('.offsets.npy')]
+            self.offsets = np.load(base + '.offsets.npy', mmap_mode='r')
+            self.values = np.load(base + '.values.npy', mmap_mode='r')
+            return
+        self.offsets, self.values = _pvalue_table(orgs, tmax)
+        if directory: # immutable files, one per (orgs, tmax)
+            os.makedirs(directory, exist_ok=True)
+            base = os.path.join(directory, f'cotr_pvalues.{orgs}.{tmax}')
+            for name, a in (('values', self.values), ('offsets', self.offsets)):
+                tmp = f'{base}.{os.getpid()}.tmp.npy'
+                np.save(tmp, a)
+                os.replace(tmp, f'{base}.{name}.npy') # values first: offsets mark a complete table
+
+    @property
+    def tmax(self):
+        return len(self.offsets) - 1
+
+    def __call__(self, k, t1, t2):
+        return self.values[self.offsets[t1, t2] + np.abs(k)]
+
+    def kmin(self, cutoff):
+        """smallest |k| with p <= cutoff for each (t1, t2); min(t1,t2)+1 if none"""
+        a, b = np.triu_indices(len(self.offsets))
+        above = np.add.reduceat(np.asarray(self.values > cutoff, dtype=np.int32),
+                                self.offsets[a, b])
+        kmin = np.empty(self.offsets.shape, dtype=np.int32)
+        kmin[a, b] = kmin[b, a] = above  # p decreases with k: count of k with p > cutoff
+        return kmin
+
+
+def _pvalue_table(orgs, tmax):
+    lf = log_factorials(orgs)
+    a_idx, b_idx = np.triu_indices(tmax + 1)
+    sizes = a_idx + 1
+    starts = np.concatenate([[0], np.cumsum(sizes)[:-1]])
+    offsets = np.zeros((tmax + 1, tmax + 1), dtype=np.int64)
+    offsets[a_idx, b_idx] = offsets[b_idx, a_idx] = starts
+    values = np.ones(sizes.sum())
+    for a in range(1, tmax + 1):
+        b = np.arange(a, tmax + 1)[:, None]
+        x = np.arange(a + 1)[None, :]
+        low = orgs - a - b + x
+        lterm = (lf[a] + lf[orgs - a] + lf[b] + lf[orgs - b] - lf[orgs]
+                 - (lf[x] + lf[a - x] + lf[b - x] + lf[np.maximum(low, 0)]))
+        pmf = np.where(low >= 0, np.exp(lterm), 0)
+        sf = np.cumsum(pmf[:, ::-1], axis=1)[:, ::-1] # P(X >= k), smallest terms first
+        valid = (x > 0) & (a + b - x <= orgs) # fisher.pval errors (p = 1 in cotr_Fisher.r)
+        start = offsets[a, a]
+        values[start:start + sf.size] = np.where(valid, np.minimum(sf, 1), 1).ravel()
+    return offsets, values
+
+
+def holm(p, m=None):
+    """Holm adjusted p-values, as p.adjust(p, method="holm")
+
+    m is the total number of tests when p holds only the smallest of them
+    (all p-values not passed must be larger than those in p)"""
+    p = np.asarray(p, dtype=float)
+    m = len(p) if m is None else m
+    order = np.argsort(p, kind='stable')
+    adj = np.empty_like(p)
+    adj[order] = np.minimum(1, np.maximum.accumulate((m - np.arange(len(p))) * p[order]))
+    return adj
+
+
+def bh(p, m=None):
+    """Benjamini-Hochberg adjusted p-values, as p.adjust(p, method="BH")
+
+    with m larger than len(p) (p holds only the smallest p-values), values
+    are exact for the pairs whose adjusted p is below the smallest p not passed"""
+    p = np.asarray(p, dtype=float)
+    m = len(p) if m is None else m
+    order = np.argsort(p, kind='stable')
+    q = m * p[order] / np.arange(1, len(p) + 1)
+    adj = np.empty_like(p)
+    adj[order] = np.minimum(1, np.minimum.accumulate(q[::-1])[::-1])
+    return adj
+
+
+ADJUST = {'holm': holm, 'BH': bh}
+
+
+class SortedAdjust:
+    """adjusted p-values of p-values streamed in ascending order, chunk by chunk
+
+    holm is computed on the fly; BH needs the running minimum from the largest
+    p-value: chunks return m*p/rank and finish() applies it to the whole array"""
+
+    def __init__(self, m, method='holm'):
+        if method not in ADJUST:
+            raise ValueError(f"unknown method {method!r} (choose from {', '.join(ADJUST)})")
+        self.m, self.method = m, method
+        self.rank, self.last = 0, 0.0
+
+    def __call__(self, p):
+        p = np.asarray(p, dtype=float)
+        rank = self.rank + np.arange(len(p))
+        self.rank += len(p)
+        if self.method == 'BH':
+            return self.m * p / (rank + 1)
+        adj = np.maximum.accumulate(np.concatenate([[self.last], (self.m - rank) * p]))[1:]
+        self.last = adj[-1] if len(adj) else self.last
+        return np.minimum(1, adj)
+
+    def finish(self, q, chunk=1 << 20):
+        """BH: running minimum from the end over all the chunk values (in place)"""
+        if self.method != 'BH':
+            return q
+        low = 1.0
+        for stop in range(len(q), 0, -chunk):
+            part = np.minimum(low, np.minimum.accumulate(q[max(0, stop - chunk):stop][::-1])[::-1])
+            q[max(0, stop - chunk):stop] = part
+            low = part[0]
+        return q
+
+
+def format_r_spec(x, digits=5, spec=None):
+    """notation summary of a numeric column for format_r, combined with spec
+    (the summary of other chunks of the same column)"""
+    x = np.asarray(x, dtype=float)
+    v = np.abs(x[np.isfinite(x)])
+    nz = v > 0
+    e10 = np.zeros(len(v), dtype=int)
+    e10[nz] = np.floor(np.log10(v[nz])).astype(int)
+    mant = np.zeros(len(v), dtype=np.int64)
+    mant[nz] = np.rint(v[nz] / 10.0 ** e10[nz] * 10 ** (digits - 1)).astype(np.int64)
+    carry = mant >= 10 ** digits
+    mant[carry] //= 10
+    e10[carry] += 1
+    sig = np.full(len(v), digits)
+    for _ in range(digits - 1):  # drop trailing zeros
+        trailing = (mant % 10 == 0) & (sig > 1)
+        mant[trailing] //= 10
+        sig[trailing] -= 1
+    sig[~nz] = 1
+    new = None
+    if len(v):
+        new = dict(neg=bool((x[np.isfinite(x)] < 0).any()), rgt=int((sig - e10 - 1).max()),
+                   emax=int(e10.max()), emin=int(e10.min()), sig=int(sig.max()))
+    if spec is None or new is None:
+        return spec or new
+    return dict(neg=spec['neg'] or new['neg'], rgt=max(spec['rgt'], new['rgt']),
+                emax=max(spec['emax'], new['emax']), emin=min(spec['emin'], new['emin']),
+                sig=max(spec['sig'], new['sig']))
+
+
+def format_r(x, digits=5, spec=None):
+    """format a numeric column as R format(x, digits=digits), without padding
+
+    all values share fixed or scientific notation and the number of
+    decimals needed to show the most precise one with `digits` significant digits;
+    a column formatted by chunks passes the spec (format_r_spec) of all of them"""
+    x = np.asarray(x, dtype=float)
+    fin = np.isfinite(x)
+    out = np.where(np.isnan(x), 'NaN', np.where(x > 0, 'Inf', '-Inf')).astype(object)
+    spec = spec or format_r_spec(x, digits)
+    if not fin.any() or spec is None:
+        return out.tolist()
+    neg = int(spec['neg'])
+    rgt = max(0, spec['rgt'])
+    width_fixed = neg + max(1, spec['emax'] + 1) + rgt + (rgt > 0)
+    dec = spec['sig'] - 1
+    wide_exp = spec['emax'] >= 100 or spec['emin'] <= -99
+    width_sci = neg + (dec > 0) + dec + 4 + (2 if wide_exp else 1)
+    fmt = f'{{:.{rgt}f}}' if width_fixed <= width_sci else f'{{:.{dec}e}}'
+    out[fin] = [fmt.format(a) for a in x[fin].tolist()]
+    return out.tolist()
@@ -0,0 +1,585 @@
+#!/usr/bin/env python3
+# coding: utf-8
+#
+# Orthogroup x genome tables of a taxonomic level from the OrthoDB tables (or
+# the HOGs tables of Utilities/OMA_translator.py), as
+# Utilities/procedure_Orthodb_read_tables.r and procedure_Orthodb_order_by_tree.r
+# without R:
+#
+#   read:  one streaming pass over {odb}_OG2genes.tab.gz keeps the genes of the
+#          orthogroups of the level as a sparse orthogroup x genome matrix (gene
+#          lists and counts); genomes of duplicated taxids (fewer orthogroups)
+#          and without NCBI classification are dropped, orthogroups in <=
+#          --min_percent of the genomes too. The matrix and the taxonomy tree of
+#          the genomes (NCBI taxdump) are saved in {level}.tables, with the
+#          RAxML input ({level}.phylip.tree, {level}.phylip.data).
+#   order: the genomes are ordered by the ncbi, raxml (RAxML_bestTree.{level})
+#          or random tree, rooted at --out_root, for each ladder orientation
+#          (RL LL NL): each ordering is a permutation of the columns of the same
+#          matrix, written as a binary presence table for cotr_transitions.py
+#          ({level}.{tree}.{ladder}.presence, see cotr_io.py; its transitions are
+#          cached for the scorer) with the ordered tree (BEAST .nexus, as the R
+#          procedure); --text adds its .csv, .csv.num and .csv.num_m tables.
+#
+# Usage: cotr_tables.py read -l Eukaryota
+#        raxmlHPC-PTHREADS -g Eukaryota.phylip.tree -s Eukaryota.phylip.data -n Eukaryota -m BINCAT -p 33
+#        cotr_tables.py order Eukaryota.tables -t raxml -d RL LL NL -o Viridiplantae
+#
+import argparse
+import itertools
+import json
+import os
+import re
+import shutil
+import sys
+import tarfile
+import urllib.request
+from urllib.parse import urlsplit
+
+import numpy as np
+import pandas as pd
+
+import cotr_io
+import cotr_log
+
+ODB = 'https://v101.orthodb.org/download/odb10v1'
+TAXDUMP = 'https://ftp.ncbi.nlm.nih.gov/pub/taxonomy/taxdump.tar.gz'
+FORMAT = 'cotr-ogtables'
+
+READ_ROWS = 1 << 21  # rows of the OG2genes table parsed at once
+JOIN_GENES = 1 << 20  # genes joined at once into the cells of genes.txt
+
+
+# tables
+
+def local(path):
+    """local copy of a url (downloaded to the current directory if missing), or path"""
+    if not re.match(r'(https?|ftp)://', path):
+        return path
+    name = os.path.basename(urlsplit(path).path)
+    if not os.path.exists(name):
+        sys.stderr.write(f"downloading {path}\n")
+        with urllib.request.urlopen(path) as r, open(f'{name}.part', 'wb') as f:
+            shutil.copyfileobj(r, f, 1 << 20)
+        os.replace(f'{name}.part', name)
+    return name
+
+
+def open_table(path):
+    """binary stream of a table (cotr_io.open_compressed), downloaded first if an URL"""
+    return cotr_io.open_compressed(local(path))
+
+
+def read_tab(path, usecols, **kwargs):
+    with open_table(path) as f:
+        return pd.read_table(f, header=None, usecols=usecols, dtype=str, quoting=3,
+                             keep_default_na=False, **kwargs)
+
+
+def level_ogs(odb, level):
+    """(orthogroups, descriptions) of the level (by name in {odb}_levels.tab.gz)"""
+    lev = read_tab(f'{odb}_levels.tab.gz', [0, 1])
+    taxids = set(lev[0][lev[1] == level])
+    ogs = read_tab(f'{odb}_OGs.tab.gz', [0, 1, 2])
+    ogs = ogs[ogs[1].isin(taxids)].drop_duplicates(0)
+    return pd.Index(ogs[0].to_numpy(dtype=object)), ogs[2].to_numpy(dtype=object)
+
+
+def _bytes(values):
+    values = np.asarray(values, dtype=str)
+    try:
+        return values.astype('S')
+    except UnicodeEncodeError:
+        return np.char.encode(values, 'utf-8')
+
+
+def read_genes(path, ogs, rows=READ_ROWS):
+    """(og, genome, gene, genomes): orthogroup (index in ogs) and genome (index in
+    genomes: part of the gene id before ':', by first appearance) of each gene
+    of the orthogroups ogs, in the order of the OG2genes table"""
+    genomes, og, genome, genes = {}, [], [], []
+    with open_table(path) as f:
+        for chunk in pd.read_table(f, header=None, usecols=[0, 1], dtype=str, quoting=3,
+                                   keep_default_na=False, chunksize=rows):
+            found = ogs.get_indexer(chunk[0])
+            keep = found >= 0
+            if not keep.any():
+                continue
+            ids = chunk[1][keep].tolist()
+            codes, uniques = pd.factorize(np.array([x.partition(':')[0] for x in ids], dtype=object))
+            for g in uniques:
+                genomes.setdefault(g, len(genomes))
+            og.append(found[keep].astype(np.int32))
+            genome.append(np.array([genomes[g] for g in uniques], dtype=np.int32)[codes])
+            genes.append(_bytes(ids))
+    if not og:
+        return np.empty(0, np.int32), np.empty(0, np.int32), np.empty(0, 'S1'), []
+    return np.concatenate(og), np.concatenate(genome), np.concatenate(genes), list(genomes)
+
+
+# taxonomy
+
+def read_taxdump(path):
+    """(parent, names, ranks, merged) of the NCBI taxonomy: parent taxid by taxid
+    (array), scientific names, ranks and merged taxids (Series by taxid)"""
+    with tarfile.open(local(path)) as tar:
+        def dmp(name, usecols):
+            return pd.read_table(tar.extractfile(name), header=None, usecols=usecols, quoting=3,
+                                 dtype=str, keep_default_na=False)
+        nodes = dmp('nodes.dmp', [0, 2, 4])
+        names = dmp('names.dmp', [0, 2, 6])
+        merged = dmp('merged.dmp', [0, 2])
+    taxid = nodes[0].astype(np.int64).to_numpy()
+    parent = np.full(taxid.max(initial=0) + 1, -1, dtype=np.int64)
+    parent[taxid] = nodes[2].astype(np.int64).to_numpy()
+    names = names[names[6] == 'scientific name']
+    return (parent, pd.Series(names[2].to_numpy(dtype=object), index=names[0].astype(np.int64).to_numpy()),
+            pd.Series(nodes[4].to_numpy(dtype=object), index=taxid),
+            pd.Series(merged[2].astype(np.int64).to_numpy(), index=merged[0].astype(np.int64).to_numpy()))
+
+
+def lineage(taxid, parent):
+    """taxids from the top of the taxonomy (root excluded) to taxid, None if unknown"""
+    if not 0 < taxid < len(parent) or parent[taxid] < 0:
+        return None
+    out = [taxid]
+    while out[-1] != 1 and parent[out[-1]] != out[-1]:
+        out.append(int(parent[out[-1]]))
+    return out[-2::-1] if out[-1] == 1 else out[::-1]
+
+
+class Node:
+    """node of a rooted tree (a tip without children)"""
+    __slots__ = ('name', 'children')
+
+    def __init__(self, name='', children=None):
+        self.name = name
+        self.children = children if children is not None else []
+
+
+def preorder(tree):
+    out, stack = [], [tree]
+    while stack:
+        node = stack.pop()
+        out.append(node)
+        stack.extend(reversed(node.children))
+    return out
+
+
+def tip_names(tree):
+    """tip labels in tree order"""
+    return [x.name for x in preorder(tree) if not x.children]
+
+
+def taxonomy_tree(genomes, lineages, names):
+    """tree of the genomes (tips) by their lineages, with the nodes of one child
+    removed, internal nodes named by the deepest taxon of their tips (as taxize::class2tree)"""
+    top, nodes = Node(), {}
+    for g, taxa in zip(genomes, lineages):
+        parent = top
+        for t in taxa:
+            node = nodes.get(t)
+            if node is None:
+                node = nodes[t] = Node(names.get(t, str(t)))
+                parent.children.append(node)
+            parent = node
+        parent.children.append(Node(g))
+    for node in reversed(preorder(top)):
+        node.children = [c.children[0] if len(c.children) == 1 else c for c in node.children]
+    return top.children[0] if len(top.children) == 1 else top
+
+
+_LENGTH = re.compile(r'\s*[^,();\s]*')
+_QUOTED = re.compile(r"'((?:[^']|'')*)'")
+_LABEL = re.compile(r"[^,();:\s\[\]']+")
+
+
+def parse_newick(text):
+    """tree of a newick string (tip and internal node labels; lengths and comments dropped)"""
+    text = re.sub(r'\[[^\]]*\]', '', text)
+    tree = current = Node()
+    stack, pos = [], 0
+    while pos < len(text):
+        ch = text[pos]
+        if ch == '(':
+            stack.append(current)
+            current = Node()
+            stack[-1].children.append(current)
+        elif ch == ',':
+            current = Node()
+            stack[-1].children.append(current)
+        elif ch == ')':
+            current = stack.pop()
+        elif ch == ':':
+            pos = _LENGTH.match(text, pos + 1).end()
+            continue
+        elif ch == ';':
+            break
+        elif ch == "'":
+            found = _QUOTED.match(text, pos)
+            current.name = found.group(1).replace("''", "'")
+            pos = found.end()
+            continue
+        elif not ch.isspace():
+            found = _LABEL.match(text, pos)
+            current.name = found.group(0)
+            pos = found.end()
+            continue
+        pos += 1
+    return tree
+
+
+def _label(name):
+    return "'" + name.replace("'", "''") + "'" if re.search(r"[\s(),:;'\[\]]", name) else name
+
+
+def write_newick(tree, internal=True, label=None):
+    """newick string of the tree (internal node labels unless internal is False;
+    label: text of each node, in place of its label)"""
+    if label is None:
+        def label(node):
+            return _label(node.name) if node.name and (internal or not node.children) else ''
+    out, stack = [], [tree]
+    while stack:
+        node = stack.pop()
+        if isinstance(node, str):
+            out.append(node)
+        elif node.children:
+            stack.append(')' + label(node))
+            for n, child in enumerate(reversed(node.children)):
+                if n:
+                    stack.append(',')
+                stack.append(child)
+            stack.append('(')
+        else:
+            out.append(label(node))
+    return ''.join(out) + ';\n'
+
+
+def write_nexus(tree, taxa, ranks, tree_name='Species_tree'):
+    """BEAST nexus of the tree (as treeio::write.beast): tips numbered in tree
+    order, nodes annotated with their taxon (species of the tips) and rank"""
+    tips = tip_names(tree)
+    number = {x: str(n) for n, x in enumerate(tips, 1)}
+
+    def label(node):
+        taxon = re.sub(r'[^0-9A-Za-z \t-]', '_', taxa.get(node.name, node.name))
+        fields = [f'Taxa="{taxon}"'] if taxon else []
+        fields += [f'Rank="{ranks[node.name]}"'] if node.name in ranks else []
+        note = '[&' + ','.join(fields) + ']' if fields else ''
+        return (number[node.name] if not node.children else '') + note
+
+    return ''.join(['#NEXUS\n[cotr_tables.py]\n\nBEGIN TAXA;\n', f'\tDIMENSIONS NTAX = {len(tips)};\n',
+                    '\tTAXLABELS\n', ''.join(f'\t\t{_label(x)}\n' for x in tips), '\t;\nEND;\n',
+                    'BEGIN TREES;\n\tTRANSLATE\n',
+                    ',\n'.join(f'\t\t{number[x]}\t{_label(x)}' for x in tips), '\n\t;\n',
+                    f'TREE * {tree_name} = [&R] ', write_newick(tree, label=label), 'END;\n'])
+
+
+def name_clades(tree, reference):
+    """internal nodes of tree named as the nodes of reference with the same tips
+    (as ape::makeNodeLabel md5sum matching), others unnamed"""
+    def clades(t):
+        tips = {}
+        for node in reversed(preorder(t)):
+            tips[node] = frozenset().union(*(tips[c] for c in node.children)) if node.children \
+                else frozenset([node.name])
+        return tips
+    names = {tips: node.name for node, tips in clades(reference).items() if node.children}
+    for node, tips in clades(tree).items():
+        if node.children:
+            node.name = names.get(tips, '')
+    return tree
+
+
+def root_at(tree, target):
+    """tree rerooted at its node target (ape::root with node): the path to the
+    former root is a new child of target"""
+    parent = {c: node for node in preorder(tree) for c in node.children}
+    path = [target]
+    while path[-1] is not tree:
+        path.append(parent[path[-1]])
+    up = None
+    for below, node in zip(path[-2::-1], path[:0:-1]):
+        children = [c for c in node.children if c is not below] + ([up] if up is not None else [])
+        up = children[0] if len(children) == 1 else Node(node.name, children)
+    return Node(target.name, list(target.children) + ([up] if up is not None else []))
+
+
+def ladderize(tree, ladder='NL'):
+    """copy of the tree, children ordered by number of tips, larger first (RL,
+    ape::ladderize right=TRUE), smaller first (LL) or unchanged (NL); ties kept"""
+    size, copy = {}, {}
+    for node in reversed(preorder(tree)):
+        children = [copy[c] for c in node.children]
+        size[node] = sum(size[c] for c in node.children) if node.children else 1
+        if ladder != 'NL':
+            sign = -1 if ladder == 'RL' else 1
+            order = sorted(range(len(children)), key=lambda n: sign * size[node.children[n]])
+            children = [children[n] for n in order]
+        copy[node] = Node(node.name, children)
+    return copy[tree]
+
+
+# read stage
+
+def read_stage(args, runlog):
+    sys.stderr.write(f"reading data from: {args.odb}\n")
+    ogs, descriptions = level_ogs(args.odb, args.level)
+    runlog.stage('OG2genes', level_ogs=len(ogs))
+    og, genome, genes, genomes = read_genes(f'{args.odb}_OG2genes.tab.gz', ogs)
+    ngenomes = len(genomes)
+    cell = og.astype(np.int64) * max(ngenomes, 1) + genome
+    cells = np.unique(cell)
+    og_genomes = np.bincount(cells // max(ngenomes, 1), minlength=len(ogs)) # genomes by orthogroup
+    genome_ogs = np.bincount(cells % max(ngenomes, 1), minlength=ngenomes) # orthogroups by genome
+    sys.stderr.write(f"Ortogroups: {np.count_nonzero(og_genomes)} Genomes: {ngenomes} Genes: {len(og)}\n")
+
+    # one genome by taxid (most orthogroups), classified in the NCBI taxonomy
+    runlog.stage('taxonomy', genomes=ngenomes, genes=len(og))
+    taxid = np.array([g.split('_')[0] for g in genomes], dtype=object)
+    order = np.lexsort((-genome_ogs, taxid.astype(str)))
+    first = np.ones(len(order), dtype=bool)
+    first[1:] = taxid[order][1:] != taxid[order][:-1]
+    sys.stderr.write(f"Removed duplicated Taxid: {' '.join(genomes[x] for x in order[~first])}\n")
+    order = order[first]
+    parent, names, ranks, merged = read_taxdump(args.taxdump)
+    lineages = []
+    for x in order:
+        t = int(taxid[x]) if taxid[x].isdigit() else -1
+        lineages.append(lineage(int(merged.get(t, t)), parent))
+    classified = [x for x, taxa in zip(order, lineages) if taxa is not None]
+    unclassified = [genomes[x] for x, taxa in zip(order, lineages) if taxa is None]
+    sys.stderr.write(f"{len(classified)}/{len(order)} organisms classified\n")
+    if unclassified:
+        sys.stderr.write(f"Warning: {len(unclassified)} unclassified taxid will be dropped: {','.join(unclassified)}\n")
+    lineages = [t for t in lineages if t is not None]
+    tree = taxonomy_tree([genomes[x] for x in classified], lineages, names)
+    column = {g: n for n, g in enumerate(tip_names(tree))} # genomes in ncbi tree order
+    index = {g: n for n, g in enumerate(genomes)}
+    col = np.full(ngenomes, -1, dtype=np.int64)
+    col[[index[g] for g in column]] = list(column.values())
+    # species and ranks of the tips and taxa of the tree (nexus annotations)
+    taxa = {genomes[x]: names.get(t[-1], str(t[-1])) for x, t in zip(classified, lineages)}
+    rank = {names.get(t, str(t)): ranks.get(t, 'no rank') for t in set(itertools.chain.from_iterable(lineages))}
+    rank.update({genomes[x]: ranks.get(t[-1], 'no rank') for x, t in zip(classified, lineages)})
+
+    # orthogroups in > min_percent of the genomes
+    keep = og_genomes / max(len(column), 1) * 100 > args.min_percent
+    rows = (col[genome] >= 0) & keep[og]
+    sys.stderr.write(f"Ortogroups in {args.min_percent:g}% of Genomes: {np.count_nonzero(keep)} "
+                     f"Genomes: {len(column)} Genes: {np.count_nonzero(rows)}\n")
+    og, genome, genes = og[rows], col[genome[rows]], genes[rows]
+    og_names = ogs.values.astype(str)
+    present = np.unique(og)
+    og_order = present[np.argsort(og_names[present], kind='stable')] # orthogroups by name
+    row = np.full(len(ogs), -1, dtype=np.int64)
+    row[og_order] = np.arange(len(og_order))
+    og = row[og]
+
+    runlog.stage('phylip', ogs=len(og_order), genomes=len(column), genes=len(og))
+    write_phylip(args.out, tree, list(column), og, genome, len(og_order))
+
+    if args.species: # orthogroups present in the (first) genome of the taxid
+        found = [n for n, g in enumerate(column) if f'{args.species}_' in g][:1]
+        wanted = np.zeros(len(og_order), dtype=bool)
+        wanted[og[np.isin(genome, found)]] = True
+        rows = wanted[og]
+        og, genome, genes = np.cumsum(wanted)[og[rows]] - 1, genome[rows], genes[rows]
+        og_order = og_order[wanted]
+        sys.stderr.write(f"Ortogroups in {args.species}: {len(og_order)}\n")
+
+    runlog.stage('save', ogs=len(og_order))
+    outfile = f'{args.out}.tables'
+    write_tables(outfile, og_names[og_order], descriptions[og_order], list(column), tree, og, genome, genes,
+                 level=args.level, min_percent=args.min_percent, species=args.species, odb=args.odb,
+                 taxa=taxa, ranks=rank)
+    sys.stderr.write(f"Data written in: {outfile}\n")
+    runlog.close(ogs=len(og_order), genomes=len(column), genes=len(og))
+
+
+def write_phylip(base, tree, genomes, og, genome, nogs):
+    """constraint tree and 0/1 data (genomes by sorted id x orthogroups) for RAxML -m BINCAT"""
+    with open(f'{base}.phylip.tree', 'w') as f:
+        f.write(write_newick(tree, internal=False))
+    data = np.zeros((len(genomes), nogs), dtype=np.uint8)
+    data[genome, og] = 1
+    with open(f'{base}.phylip.data', 'wb') as f:
+        f.write(f'\t {len(genomes)} {nogs} \n'.encode())
+        for n in np.argsort(np.array(genomes, dtype=str), kind='stable'):
+            name = genomes[n]
+            f.write(f"{name} {' ' * max(0, 10 - len(name))}".encode() + (data[n] + ord('0')).tobytes() + b'\n')
+
+
+def write_tables(path, ogs, descriptions, genomes, tree, og, genome, genes, **meta):
+    """sparse orthogroup x genome matrix: cells (row, column, genes) sorted by row
+    and column, gene lists (genes.txt, one line per cell), orthogroups, genomes
+    and taxonomy tree"""
+    os.makedirs(path, exist_ok=True)
+    order = np.lexsort((genome, og)) # genes of a cell in table order
+    cell = og[order] * max(len(genomes), 1) + genome[order]
+    last = np.ones(len(cell), dtype=bool)
+    last[:-1] = cell[1:] != cell[:-1]
+    cells, count = np.unique(cell, return_counts=True)
+    rows = cells // max(len(genomes), 1)
+    np.save(os.path.join(path, 'indptr.npy'),
+            np.concatenate([[0], np.cumsum(np.bincount(rows, minlength=len(ogs)))]).astype(np.int64))
+    np.save(os.path.join(path, 'col.npy'), (cells % max(len(genomes), 1)).astype(np.int32))
+    np.save(os.path.join(path, 'count.npy'), count.astype(np.int32))
+    with open(os.path.join(path, 'genes.txt'), 'wb') as f:
+        for s in range(0, len(order), JOIN_GENES):
+            sep = np.where(last[s:s + JOIN_GENES], b'\n', b',')
+            f.write(b''.join(np.char.add(genes[order[s:s + JOIN_GENES]], sep).tolist()))
+    with open(os.path.join(path, 'ogs.txt'), 'w') as f:
+        f.writelines(f'{x}\n' for x in ogs)
+    with open(os.path.join(path, 'descriptions.txt'), 'w') as f:
+        f.writelines(f"{str(x).replace(chr(9), ' ').replace(chr(10), ' ')}\n" for x in descriptions)
+    with open(os.path.join(path, 'taxonomy.nwk'), 'w') as f:
+        f.write(write_newick(tree))
+    with open(os.path.join(path, 'meta.json'), 'w') as f:
+        json.dump(dict(format=FORMAT, version=1, ogs=len(ogs), genes=len(og), genomes=genomes, **meta), f, indent=1)
+
+
+def read_tables(path):
+    """(meta, ogs, descriptions, (indptr, col, count), taxonomy tree) of a .tables directory"""
+    with open(os.path.join(path, 'meta.json')) as f:
+        meta = json.load(f)
+    if meta.get('format') != FORMAT:
+        raise ValueError(f'{path}: not a {FORMAT} directory')
+    with open(os.path.join(path, 'ogs.txt')) as f:
+        ogs = f.read().splitlines()
+    with open(os.path.join(path, 'descriptions.txt')) as f:
+        descriptions = f.read().splitlines()
+    with open(os.path.join(path, 'taxonomy.nwk')) as f:
+        tree = parse_newick(f.read())
+    matrix = tuple(np.load(os.path.join(path, f'{x}.npy')) for x in ('indptr', 'col', 'count'))
+    return meta, ogs, descriptions, matrix, tree
+
+
+# order stage
+
+def genome_order(tree, genomes, ladder, random=None):
+    """column of each genome in the order of the ladderized tree (or random);
+    genomes not in the tree follow, in their order"""
+    tips = tip_names(ladderize(tree, ladder))
+    if random is not None:
+        tips = list(random.permutation(tips))
+    index = {g: n for n, g in enumerate(genomes)}
+    order = [index[g] for g in tips if g in index]
+    missing = sorted(set(range(len(genomes))) - set(order))
+    if missing:
+        sys.stderr.write(f"Warning: {len(missing)} genomes not in the tree, placed last: "
+                         f"{','.join(genomes[n] for n in missing)}\n")
+    return np.array(order + missing, dtype=np.int64)
+
+
+def row_chunks(matrix, ngenomes, columns, cells=cotr_io.CHUNK_CELLS):
+    """(rows, counts) of the matrix by chunks of rows, columns permuted (column
+    n of the output is matrix column columns[n])"""
+    indptr, col, count = matrix
+    position = np.empty(ngenomes, dtype=np.int64)
+    position[columns] = np.arange(ngenomes)
+    nrows = max(1, cells // max(1, ngenomes))
+    for a in range(0, len(indptr) - 1, nrows):
+        b = min(a + nrows, len(indptr) - 1)
+        values = np.zeros((b - a, ngenomes), dtype=np.int32)
+        s, t = indptr[a], indptr[b]
+        values[np.repeat(np.arange(b - a), np.diff(indptr[a:b + 1])), position[col[s:t]]] = count[s:t]
+        yield slice(a, b), values
+
+
+def write_text(base, tables, genomes, columns, ogs, descriptions, matrix):
+    """.csv (gene lists), .csv.num_m (gene numbers) and .csv.num (0/1) tables"""
+    indptr, col, _ = matrix
+    position = np.empty(len(genomes), dtype=np.int64)
+    position[columns] = np.arange(len(genomes))
+    with open(f'{base}.csv', 'w') as csv, open(f'{base}.csv.num_m', 'w') as num_m, \
+            open(f'{base}.csv.num', 'w') as num, open(os.path.join(tables, 'genes.txt')) as genes:
+        csv.write('\t'.join(['Orthogroup', 'Description'] + [genomes[n] for n in columns]) + '\n')
+        for rows, values in row_chunks(matrix, len(genomes), columns):
+            s, t = indptr[rows.start], indptr[rows.stop]
+            cells = np.full(values.shape, '', dtype=object)
+            cells[np.repeat(np.arange(values.shape[0]), np.diff(indptr[rows.start:rows.stop + 1])),
+                  position[col[s:t]]] = [x.rstrip('\n') for x in itertools.islice(genes, t - s)]
+            names = ogs[rows]
+            csv.writelines('\t'.join([og, d] + c) + '\n'
+                           for og, d, c in zip(names, descriptions[rows], cells.tolist()))
+            num_m.writelines(f'{og}\t' + '\t'.join(map(str, v)) + '\n' for og, v in zip(names, values.tolist()))
+            num.writelines(f'{og}\t' + '\t'.join(map(str, v)) + '\n'
+                           for og, v in zip(names, np.minimum(values, 1).tolist()))
+
+
+def order_stage(args, runlog):
+    meta, ogs, descriptions, matrix, taxonomy = read_tables(args.tables)
+    genomes = meta['genomes']
+    base = re.sub(r'\.tables/*$', '', args.tables)
+    tree = taxonomy
+    if args.tree == 'raxml': # named by the taxonomy clades
+        raxml = os.path.join(os.path.dirname(base), f'RAxML_bestTree.{os.path.basename(base)}')
+        if not os.path.isfile(raxml):
+            sys.exit(f"File {raxml} not found")
+        with open(raxml) as f:
+            tree = name_clades(parse_newick(f.read()), taxonomy)
+    if args.out_root != 'none':
+        found = [x for x in preorder(tree) if x.children and x.name == args.out_root]
+        if found:
+            tree = root_at(tree, found[0])
+    random = np.random.default_rng(args.seed) if args.tree == 'random' else None
+    text = set(args.ladderize if args.text == [] else args.text or [])
+    cache = cotr_io.cache_dir(args.cache)
+    for ladder in args.ladderize:
+        runlog.stage(f'order {ladder}', ogs=len(ogs), genomes=len(genomes))
+        columns = genome_order(tree, genomes, ladder, random)
+        name = f'{base}.{args.tree}.{ladder}'
+        with open(f'{name}.nexus', 'w') as f:
+            f.write(write_nexus(ladderize(tree, ladder), meta.get('taxa', {}), meta.get('ranks', {})))
+        with cotr_io.TableWriter(f'{name}.presence', [genomes[n] for n in columns], level=meta['level'],
+                                 tree=args.tree, ladder=ladder, source=os.path.basename(os.path.normpath(args.tables))) as out:
+            for rows, values in row_chunks(matrix, len(genomes), columns):
+                out.write(ogs[rows], values, descriptions[rows])
+        sys.stderr.write(f"presence table written in: {name}.presence\n")
+        if cache is not None: # transition matrix of cotr_transitions.py
+            cotr_io.load_transitions(f'{name}.presence', cache_dir=cache)
+        if ladder in text:
+            write_text(name, args.tables, genomes, columns, np.array(ogs, dtype=object),
+                       np.array(descriptions, dtype=object), matrix)
+            sys.stderr.write(f"csv, csv.num and csv.num_m tables written in: {name}.csv*\n")
+    runlog.close()
+
+
+if __name__ == '__main__':
+    common = argparse.ArgumentParser(add_help=False)
+    common.add_argument('--log', default=None, help='Append JSON-lines records of the stages (wall time, peak RSS) to this file')
+    ap = argparse.ArgumentParser(description='Orthogroup x genome tables of a taxonomic level (OrthoDB or OMA HOGs)')
+    stages = ap.add_subparsers(dest='stage', required=True)
+    read = stages.add_parser('read', parents=[common], help='read the OrthoDB tables of a level ({level}.tables)')
+    read.add_argument('-l', '--level', default='Eukaryota', help='taxonomic level (default Eukaryota)')
+    read.add_argument('-s', '--species', default=None, help='only orthogroups present in the species taxid')
+    read.add_argument('-m', '--min_percent', type=float, default=1,
+                      help='include orthogroups present in more than x percent of the genomes (default 1)')
+    read.add_argument('--odb', default=ODB, help=f'path or url prefix of the _levels, _OGs and _OG2genes .tab.gz '
+                      f'tables (urls are downloaded to the current directory; default {ODB})')
+    read.add_argument('--taxdump', default=TAXDUMP, help=f'NCBI taxdump.tar.gz, path or url (default {TAXDUMP})')
+    read.add_argument('-o', '--out', default=None, help='output prefix (default: the level)')
+    order = stages.add_parser('order', parents=[common], help='order the genomes of a .tables by a tree')
+    order.add_argument('tables', help='.tables directory (cotr_tables.py read)')
+    order.add_argument('-t', '--tree', default='raxml', choices=('ncbi', 'raxml', 'random'),
+                       help='order genomes by the ncbi tree (partially resolved), the ncbi-constrained raxml tree '
+                       '(RAxML_bestTree.{level}, fully resolved) or randomly (default raxml)')
+    order.add_argument('-o', '--out_root', default='Viridiplantae', help='group for tree rooting (none: no rooting)')
+    order.add_argument('-d', '--ladderize', nargs='+', default=['RL'], choices=('RL', 'LL', 'NL'),
+                       help='tree orientations (ladderized right, left, not ladderized), one table each (default RL)')
+    order.add_argument('--text', nargs='*', default=None, choices=('RL', 'LL', 'NL'),
+                       help='also write the .csv, .csv.num and .csv.num_m tables (of these orientations, all if none given)')
+    order.add_argument('--cache', default=None, help='Directory of the transition cache of the tables '
+                       '(as cotr_transitions.py; default: $XDG_CACHE_HOME/cotransitions; "none" to skip)')
+    order.add_argument('--seed', type=int, default=None, help='seed of the random order (-t random)')
+    args = ap.parse_args()
+
+    runlog = cotr_log.RunLog(args.log, **{k: v for k, v in vars(args).items() if k != 'log'})
+    if args.stage == 'read':
+        args.out = args.out or args.level
+        runlog.stage('level orthogroups')
+        read_stage(args, runlog)
+    else:
+        order_stage(args, runlog)
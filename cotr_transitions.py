@@ -1,52 +1,355 @@
 #!/usr/bin/env python3
 # coding: utf-8
 
+import os
+import resource
 import sys
 import numpy as np
 import pandas as pd
 import argparse
 
+import cotr_io
+import cotr_lib
+import cotr_log
+import cotr_stats
+
 ap = argparse.ArgumentParser()
-ap.add_argument('csv',help='tab-separated file with gene occurrence (genes by rows)')
+ap.add_argument('csv',nargs='+',help='tab-separated file with gene occurrence (genes by rows); '
+				'with several files (e.g. RL LL NL orderings of the same table) and --fisher, '
+				'only pairs with k>0 significant in all orientations are written')
 ap.add_argument('-m','--min_transitions',default=0,
 				type=int,help='Minimum number of co-evolutionary transitions in a gene pair')
 ap.add_argument('-c','--count_consecutive',action='store_true',
 				help='Do not penalize concecutive transitions (e.g. 101)')
+ap.add_argument('-b','--backend',default='auto',choices=('auto',)+cotr_lib.BACKENDS,
+				help='Concordance engine: dense (BLAS products), bitset (packed popcount, low memory), '
+				'sparse (inverted index of transition positions) or auto (sparse or dense by density)')
+ap.add_argument('--block_size',default=None,type=int,
+				help='Gene rows scored per block (default: automatic)')
+ap.add_argument('-w','--workers',default=1,type=int,
+				help='Worker processes for pair scoring (consider OPENBLAS_NUM_THREADS=1 with many workers)')
+ap.add_argument('-f','--fisher',action='store_true',
+				help='Add k_score, Fisher p and Holm p.adj (as cotr_Fisher.r), sorted by p')
+ap.add_argument('-p','--p.cutoff',dest='p_cutoff',default=1,type=float,
+				help='p cutoff (with --fisher): pairs with p <= cutoff are kept')
+ap.add_argument('-pa','--padj.cutoff',dest='padj_cutoff',default=1,type=float,
+				help='p.adj cutoff (with --fisher): pairs with p.adj <= cutoff are kept (inclusive)')
+ap.add_argument('--adjust',default='holm',choices=tuple(cotr_stats.ADJUST),
+				help='Multiple-test correction of p.adj (with --fisher): holm (as cotr_Fisher.r) or BH')
+ap.add_argument('--ptable',default=None,
+				help='Directory of the persistent p-value table (default: $XDG_CACHE_HOME/cotransitions; "none" to keep it in memory)')
+ap.add_argument('-o','--binary',default=None,
+				help='Write pairs to this directory as a binary column table (see cotr_io.py) instead of TSV to STDOUT')
+ap.add_argument('--cache',default=None,
+				help='Directory of the transition cache of each csv (default: $XDG_CACHE_HOME/cotransitions; "none" to disable)')
+ap.add_argument('--top_k',default=None,type=int,
+				help='Keep only the N best partners of each orthogroup (by --rank; with several csv, ranked in the first)')
+ap.add_argument('--rank',default='k',choices=('k','k_score','p'),
+				help='Ranking of partners for --top_k')
+ap.add_argument('--checkpoint',default=None,
+				help='Save the scored row blocks in this directory (with a manifest of inputs and parameters)')
+ap.add_argument('--resume',action='store_true',
+				help='Continue the run saved in --checkpoint, scoring only the unfinished blocks')
+ap.add_argument('--shard',default=None,
+				help='i/N: score only the i-th of N shares (1..N, balanced by pairs) of the row blocks into --checkpoint, '
+				'without output; shards can run on different nodes sharing the directory')
+ap.add_argument('--merge',action='store_true',
+				help='Write the output of a --checkpoint whose blocks are all done (e.g. by --shard runs)')
+ap.add_argument('--update',default=None,
+				help='Checkpoint of an earlier run (same parameters, e.g. on a previous release): pairs of unchanged '
+				'orthogroups are taken from it and only new or changed ones are scored, into a new --checkpoint')
+ap.add_argument('--log',default=None,
+				help='Append JSON-lines records of the run to this file: stages (wall time, peak RSS) and periodic '
+				'progress of the pair loop (pairs/s, ETA, pairs emitted and pruned)')
+ap.add_argument('--log_interval',default=cotr_log.INTERVAL,type=float,
+				help='Seconds between progress records of --log')
+ap.add_argument('--profile',default=None,
+				help='Profile the run (main process) into this file: cProfile stats, or pyinstrument report for .html')
+query = ap.add_mutually_exclusive_group()
+query.add_argument('--query',default=None,
+				help='Score only these orthogroups against all others: file of ids (first column), "-" for STDIN, '
+				'or comma-separated ids')
+query.add_argument('--pairs',default=None,
+				help='Score only the orthogroup pairs in this tab-separated file (first two columns)')
 args = ap.parse_args()
+ptable_dir = cotr_io.cache_dir(args.ptable)
+if (args.resume or args.shard or args.merge) and not args.checkpoint:
+    ap.error('--resume, --shard and --merge require --checkpoint')
+if args.shard:
+    try:
+        shard, nshards = (int(x) for x in args.shard.split('/'))
+        assert 1 <= shard <= nshards
+    except (ValueError, AssertionError):
+        ap.error(f'--shard {args.shard}: expected i/N with 1 <= i <= N')
+if args.update and (not args.checkpoint or args.resume or args.shard or args.merge):
+    ap.error('--update requires a new --checkpoint (not --resume, --shard or --merge)')
+if args.checkpoint and (args.query is not None or args.pairs is not None):
+    ap.error('--checkpoint applies to all-pairs runs (not --query or --pairs)')
+if len(args.csv) > 1 and not args.fisher:
+    ap.error('several csv files (ladder orientations) require --fisher')
+if args.profile:
+    cotr_log.profile(args.profile)
+runlog = cotr_log.RunLog(args.log, args.log_interval, csv=args.csv, min_transitions=args.min_transitions,
+                         backend=args.backend, workers=args.workers, fisher=args.fisher)
+runlog.stage('transitions')
 
-csv = pd.read_table(args.csv, header=None, index_col=0, comment='#')
-ngenes, norgs = len(csv.index), len(csv.columns)
-
-tr = csv.diff(axis=1) #iterative difference
-tr = tr.applymap(lambda x: 1 if x>1 else -1 if x<-1 else x) #increasing (1) or decreasing (-1) only
-
-tr_l = tr.values.tolist()
-
-if not args.count_consecutive: #count only once consecutive state transitions (-1,1)
-	for r in tr_l:
-		for i in range(len(r)-1):
-			if (r[i]+r[i+1]==0):
-				r[i+1]=0
+tables = [cotr_io.load_transitions(f, args.count_consecutive, cotr_io.cache_dir(args.cache)) for f in args.csv]
+names, tr, tt = tables[0]
+for f, (ogs, other, _) in zip(args.csv[1:], tables[1:]): # orientations share the row index
+    if other.shape != tr.shape or set(ogs) != set(names):
+        ap.error(f'{f}: genes or organisms differ from {args.csv[0]}')
+ngenes, norgs = tr.shape
+labels = cotr_lib.ladder_labels(args.csv)
 
-# sets for fast comparison
-t01 = [set(np.nonzero(row > 0)[0]) for row in np.array(tr_l)] # 0->1 transitons
-t10 = [set(np.nonzero(row < 0)[0]) for row in np.array(tr_l)] # 1->0 transitons
-tt = [len(a | b) for a,b in zip(t01,t10)] #total transitions
+# transition matrices for block comparison (one per orientation)
+tts, engines, trs = [], [], []
+for ogs, other, t in tables:
+    rows = slice(None) if ogs == names else pd.Index(ogs).get_indexer(names)
+    if args.checkpoint: # kept in the checkpoint for --update
+        trs.append(other[rows])
+    t01, t10 = cotr_lib.transition_matrices(other[rows]) # 0->1 and 1->0 transitons
+    tts.append(np.asarray(t[rows], dtype=int)) #total transitions
+    engines.append(cotr_lib.prepare(t01, t10, args.backend))
+tt = tts[0]
+del tables, other, tr, t01, t10
 
 sys.stderr.write("done transitions\n")
+sys.stderr.write(f"peak memory (transitions): {resource.getrusage(resource.RUSAGE_SELF).ru_maxrss // 1024} MB\n")
+runlog.stage('pairs', genes=ngenes, orgs=norgs, backends=[e[0] for e in engines])
 
-print('Orthogroup1','Orthogroup2','orgs','t1','t2','c','d','k', sep="\t")
-counter = 0
-for i in range(ngenes-1):
-    for j in range(i+1,ngenes):
-        concordant = len(t01[i] & t01[j]) + len(t10[i] & t10[j])
-        discordant = len(t10[i] & t01[j]) + len(t01[i] & t10[j])
-        k = concordant - discordant
-        if abs(k) >= args.min_transitions:
-            print(tr.index[i],tr.index[j], norgs, tt[i], tt[j], concordant, discordant, k, sep='\t')
-            counter += 1
+npairs = ngenes*(ngenes-1)//2
+sizes = None # pairs covered by each tile (progress records)
+if args.query is not None or args.pairs is not None:
+    index = pd.Index(names)
+    if args.query is not None:
+        if args.query == '-' or os.path.isfile(args.query):
+            with (sys.stdin if args.query == '-' else open(args.query)) as f:
+                ids = [x.split('\t')[0].strip() for x in f if x.strip() and not x.startswith('#')]
+        else:
+            ids = args.query.split(',')
+        pos = index.get_indexer(ids)
+        missing = [x for x, p in zip(ids, pos) if p < 0]
+        queries = pd.unique(pos[pos >= 0])
+        npairs = len(queries)*(ngenes-1) - len(queries)*(len(queries)-1)//2
+        tiles = [[cotr_lib.query_pairs(e, queries, ngenes, args.min_transitions) for e in engines]]
+        sizes = [npairs]
+    else:
+        given = pd.read_table(args.pairs, header=None, comment='#', usecols=[0, 1], dtype=str)
+        pi, pj = index.get_indexer(given[0]), index.get_indexer(given[1])
+        if len(pi) and pi[0] < 0 and pj[0] < 0: # header line
+            given, pi, pj = given[1:], pi[1:], pj[1:]
+        missing = list(given[0][pi < 0]) + list(given[1][pj < 0])
+        found = (pi >= 0) & (pj >= 0) & (pi != pj)
+        key = np.minimum(pi, pj).astype(np.int64)*ngenes + np.maximum(pi, pj) # unordered pairs
+        first = np.sort(np.unique(key[found], return_index=True)[1])
+        pi, pj = pi[found][first], pj[found][first]
+        npairs = len(pi)
+        tiles = [[cotr_lib.list_pairs(e, pi, pj, args.min_transitions) for e in engines]]
+        sizes = [npairs]
+    for x in dict.fromkeys(missing):
+        sys.stderr.write(str(x) + " missing\n")
+else:
+    tiles = None
+
+cutoffs = [dict(min_transitions=args.min_transitions) for _ in engines]
+if args.fisher or args.rank == 'p':
+    fisher = cotr_stats.PValueTable(norgs, int(max(t.max(initial=0) for t in tts)), ptable_dir)
+if args.fisher:
+    cutoff = min(args.p_cutoff, args.padj_cutoff) # p.adj >= p: no other pair can pass
+    if args.adjust == 'BH': # BH p.adj also depends on larger p-values, up to the p.adj cutoff
+        cutoff = args.padj_cutoff
+    if cutoff < 1: # drop pairs above the cutoff inside the pair loop
+        kmin = fisher.kmin(cutoff)
+        for cut, t in zip(cutoffs, tts):
+            cut.update(tt=t, kmin=kmin)
+    selected = [cotr_io.SortedRuns(('i', 'j', 'c', 'd', 'k', 'p'), 'p') for _ in engines]
+    header = list(cotr_lib.FISHER_HEADER)
+    for label in labels[1:]:
+        header += [f'{x}.{label}' for x in cotr_lib.FISHER_HEADER[3:]]
+if not args.shard: # shards only save blocks
+    if args.fisher:
+        sys.stderr.write("calculating probabilities (output table to %s)\n" % (args.binary or 'STDOUT'))
+        if not args.binary:
+            print(*header, sep="\t")
+    elif args.binary:
+        writer = cotr_io.PairWriter(args.binary, names, norgs, source=os.path.abspath(args.csv[0]))
+    else:
+        print('Orthogroup1','Orthogroup2','orgs','t1','t2','c','d','k', sep="\t")
+prune = tiles is None and (args.min_transitions > 0 or 'kmin' in cutoffs[0])
+if prune: # skip pairs that cannot reach the cutoffs (|k| <= min(t1,t2))
+    for cut, t in zip(cutoffs, tts):
+        cut.update(tt=t, feasible=cotr_lib.feasible_pairs(int(t.max(initial=0)), args.min_transitions,
+                                                           cut.get('kmin') if args.min_transitions <= 0 else None))
+counters = [0 for _ in engines]
+evaluated = [0 for _ in engines]
+if tiles is None and args.checkpoint: # saved blocks are read back, the others scored and saved
+    manifest = dict(inputs=[dict(file=os.path.basename(f), key=cotr_io.file_key(f)) for f in args.csv],
+                    count_consecutive=args.count_consecutive, min_transitions=args.min_transitions,
+                    kmin_cutoff=cutoff if args.fisher and cutoff < 1 else None, ngenes=ngenes, orgs=norgs)
+    # shards must agree on the blocks: sized for the number of shards, not of local workers
+    blocks = cotr_lib.row_blocks(ngenes, args.block_size, 4 * nshards if args.shard else args.workers)
+    try:
+        checkpoint = cotr_io.Checkpoint(args.checkpoint, manifest, blocks,
+                                        args.resume or args.merge or bool(args.shard))
+    except ValueError as e:
+        ap.error(str(e))
+    checkpoint.save_matrix(names, trs)
+    if args.update:
+        try:
+            previous = cotr_io.Checkpoint.open(args.update)
+            changed = [x for x in ('count_consecutive', 'min_transitions', 'kmin_cutoff')
+                       if previous.manifest.get(x) != manifest[x]]
+            if changed or len(previous.manifest['inputs']) != len(args.csv):
+                raise ValueError(f"{args.update}: run with other parameters ({', '.join(changed) or 'inputs'})")
+            if previous.pending():
+                raise ValueError(f'{args.update}: {len(previous.pending())} blocks not done')
+            scored = checkpoint.update(previous, names, [cotr_io.row_hashes(t) for t in trs], engines, cutoffs,
+                                       args.backend)
+        except ValueError as e:
+            ap.error(str(e))
+        sys.stderr.write(f"update: {len(scored)} of {ngenes} orthogroups new or changed since {args.update}\n")
+    del trs
+    pending = checkpoint.pending()
+    sys.stderr.write(f"checkpoint: {len(checkpoint.blocks) - len(pending)} of {len(checkpoint.blocks)} blocks done\n")
+    if args.merge and pending:
+        ap.error(f'{args.checkpoint}: {len(pending)} blocks not done')
+    if args.shard:
+        mine = set(cotr_lib.shard_blocks(checkpoint.blocks, ngenes, shard - 1, nshards))
+        pending = [n for n in pending if n in mine]
+    computed = cotr_lib.iter_multi_pairs(engines, ngenes, workers=args.workers, cutoffs=cutoffs,
+                                         tiles=[checkpoint.blocks[n] for n in pending])
+    sizes = [(b - a) * (2 * ngenes - a - b - 1) // 2 for a, b in checkpoint.blocks]
+    if args.shard:
+        mine = [sizes[n] for n in pending]
+        for n, tile in checkpoint.store(pending, runlog.track(computed, mine, sum(mine))):
+            pass
+        sys.stderr.write(f"shard {args.shard}: {len(pending)} blocks scored; "
+                         f"{len(checkpoint.pending())} of {len(checkpoint.blocks)} blocks left\n")
+        runlog.close(shard=args.shard, blocks=len(pending))
+        sys.exit(0)
+    tiles = checkpoint.tiles(pending, computed)
+if tiles is None:
+    blocks = cotr_lib.row_blocks(ngenes, args.block_size, args.workers)
+    sizes = [(b - a) * (2 * ngenes - a - b - 1) // 2 for a, b in blocks]
+    tiles = cotr_lib.iter_multi_pairs(engines, ngenes, workers=args.workers, cutoffs=cutoffs, tiles=blocks)
+tiles = runlog.track(tiles, sizes, npairs)
+if args.top_k: # best partners of each gene, scored again as a single tile
+    best = cotr_lib.TopK(ngenes, args.top_k)
+    for tile in tiles:
+        for o, pairs in enumerate(tile):
+            counters[o] += pairs.tested
+            evaluated[o] += pairs.evaluated
+        i, j, k = tile[0].i, tile[0].j, tile[0].k
+        if args.rank == 'k':
+            score = k
+        elif args.rank == 'k_score':
+            score = np.nan_to_num(cotr_stats.k_score(k, tt[i], tt[j]), nan=-np.inf)
+        else:
+            score = -fisher(k, tt[i], tt[j])
+        best.add(i, j, score)
+    i, j = best.pairs()
+    tiles = [[cotr_lib.list_pairs(e, i, j, args.min_transitions)._replace(tested=0, evaluated=0) for e in engines]]
+for tile in tiles:
+    for o, pairs in enumerate(tile):
+        counters[o] += pairs.tested
+        evaluated[o] += pairs.evaluated
+        if args.fisher:
+            p = fisher(pairs.k, tts[o][pairs.i], tts[o][pairs.j])
+            keep = p <= cutoff
+            selected[o].add(**{x: a[keep] for x, a in zip(('i', 'j', 'c', 'd', 'k', 'p'), pairs[:5] + (p,))})
+        elif args.binary:
+            writer.write(i=pairs.i, j=pairs.j, t1=tt[pairs.i], t2=tt[pairs.j], c=pairs.c, d=pairs.d, k=pairs.k)
+        else:
+            sys.stdout.write(cotr_lib.format_pairs(names, norgs, tt, *pairs[:5]))
 
 # All done:
+runlog.stage('adjust' if args.fisher else None, pairs=npairs, tested=counters, evaluated=evaluated)
 sys.stderr.write("done concordance\n")
-summary = "Gene pairs: " + str(int((ngenes*(ngenes-1))/2)) + "; >cutoff: " + str(counter) + "\n" 
-sys.stderr.write(summary)
+sys.stderr.write(f"peak memory: {resource.getrusage(resource.RUSAGE_SELF).ru_maxrss // 1024} MB\n")
+for label, counter in zip(labels, counters):
+    summary = "Gene pairs: " + str(npairs) + "; >cutoff: " + str(counter) + "\n" 
+    sys.stderr.write(summary if len(labels) == 1 else f"{label} {summary}")
+if prune:
+    for label, n in zip(labels, evaluated):
+        summary = f"Pairs evaluated: {n}; pruned by transition bounds: {npairs - n}\n"
+        sys.stderr.write(summary if len(labels) == 1 else f"{label} {summary}")
+if args.binary and not args.fisher:
+    writer.close()
+
+if args.fisher and len(selected) == 1: # streamed in p order: memory bounded by SortedRuns
+    runs, counter = selected[0], counters[0]
+    adjust = cotr_stats.SortedAdjust(counter, args.adjust) # all tested pairs count (conservative with --top_k)
+    padj, at = runs.array(), 0
+    for rows in runs.merge():
+        padj[at:at + len(rows['p'])] = adjust(rows['p'])
+        at += len(rows['p'])
+    adjust.finish(padj)
+
+    def passing(): # chunks of the output table
+        at = 0
+        for rows in runs.merge():
+            adj = padj[at:at + len(rows['p'])]
+            at += len(adj)
+            keep = (adj <= args.padj_cutoff) & (rows['p'] <= args.p_cutoff)
+            i, j, c, d, k, p = (rows[x][keep] for x in ('i', 'j', 'c', 'd', 'k', 'p'))
+            yield i, j, c, d, k, cotr_stats.k_score(k, tt[i], tt[j]), p, adj[keep]
+
+    npass = 0
+    if args.binary:
+        with cotr_io.PairWriter(args.binary, names, norgs, cotr_io.FISHER_COLUMNS, source=os.path.abspath(args.csv[0]),
+                                labels=labels, p_cutoff=args.p_cutoff, padj_cutoff=args.padj_cutoff,
+                                adjust=args.adjust) as out:
+            for i, j, c, d, k, ks, p, adj in passing():
+                out.write(**dict(zip(cotr_io.FISHER_COLUMNS, (i, j, tt[i], tt[j], c, d, k, ks, p, adj))))
+                npass += len(i)
+    else:
+        specs = [None] * 3 # R formats each column as a whole
+        for columns in passing():
+            specs = [cotr_stats.format_r_spec(x, spec=sp) for x, sp in zip(columns[5:], specs)]
+        for columns in passing():
+            sys.stdout.write(cotr_lib.format_fisher(names, norgs, tt, *columns, specs=specs))
+            npass += len(columns[0])
+    runs.close()
+    sys.stderr.write(f"{npass} gene pairs with p <= {args.p_cutoff:g} and p.adj <= {args.padj_cutoff:g}\n")
+    runlog.close(significant=npass)
+elif args.fisher:
+    tables = []
+    for runs, counter in zip(selected, counters):
+        rows = list(runs.merge())
+        i, j, c, d, k, p = ([np.concatenate([r[x] for r in rows]) for x in ('i', 'j', 'c', 'd', 'k', 'p')]
+                            if rows else [np.empty(0, dtype=int)]*6)
+        runs.close()
+        padj = cotr_stats.ADJUST[args.adjust](p, counter) # all tested pairs count (conservative with --top_k)
+        keep = (padj <= args.padj_cutoff) & (p <= args.p_cutoff) & (k > 0) # positive co-transitions only
+        tables.append([x[keep] for x in (i, j, c, d, k, p, padj)])
+    # pairs significant in every orientation (by sorted pair keys)
+    keys = [t[0].astype(np.int64) * ngenes + t[1] for t in tables]
+    tables = [[x[np.argsort(key, kind='stable')] for x in t] for t, key in zip(tables, keys)]
+    keys = [np.sort(key) for key in keys]
+    common = keys[0]
+    for key in keys[1:]:
+        common = np.intersect1d(common, key, assume_unique=True)
+    tables = [[x[np.searchsorted(key, common)] for x in t] for t, key in zip(tables, keys)]
+    order = np.argsort(tables[0][5], kind='stable') # sorted by p (ties in pair order)
+    columns = []
+    for o, (i, j, c, d, k, p, padj) in enumerate(tables):
+        i, j, c, d, k, p, padj = (x[order] for x in (i, j, c, d, k, p, padj))
+        ks = cotr_stats.k_score(k, tts[o][i], tts[o][j])
+        columns += [i, j, c, d, k, ks, p, padj] if o == 0 else [tts[o][i], tts[o][j], c, d, k, ks, p, padj]
+    if args.binary:
+        i, j = columns[:2]
+        bin_columns = list(cotr_io.FISHER_COLUMNS)
+        for label in labels[1:]:
+            bin_columns += [f'{x}.{label}' for x in cotr_io.FISHER_COLUMNS[2:]]
+        values = [i, j, tt[i], tt[j]] + columns[2:]
+        with cotr_io.PairWriter(args.binary, names, norgs, bin_columns, source=os.path.abspath(args.csv[0]),
+                                labels=labels, p_cutoff=args.p_cutoff, padj_cutoff=args.padj_cutoff,
+                                adjust=args.adjust) as out:
+            out.write(**dict(zip(bin_columns, values)))
+    else:
+        sys.stdout.write(cotr_lib.format_fisher(names, norgs, tt, *columns))
+    summary = f"{len(common)} gene pairs with p <= {args.p_cutoff:g} and p.adj <= {args.padj_cutoff:g}"
+    sys.stderr.write(f"{summary} in {', '.join(labels)}\n")
+    runlog.close(significant=len(common))
+else:
+    runlog.close()
@@ -0,0 +1,46 @@
+# coding: utf-8
+#
+# Shared fixtures of the tests: repository modules on the path, small random
+# gene occurrence tables and a runner of cotr_transitions.py
+#
+import os
+import subprocess
+import sys
+
+import numpy as np
+import pytest
+
+ROOT = os.path.join(os.path.dirname(os.path.realpath(__file__)), '..')
+sys.path.insert(0, ROOT)
+
+
+@pytest.fixture
+def table(tmp_path):
+    """table(name, ngenes, norgs, seed) -> path of a random .csv.num table (rows
+    of different prevalence, a few gene counts of 2); rows=(names, values)
+    writes the given rows instead"""
+
+    def make(name='table', ngenes=60, norgs=40, seed=0, rows=None):
+        if rows is None:
+            rng = np.random.default_rng(seed)
+            values = (rng.random((ngenes, norgs)) < rng.uniform(0.1, 0.9, (ngenes, 1))).astype(int)
+            values[rng.random((ngenes, norgs)) < 0.05] *= 2
+            rows = ([f'{x}at0' for x in range(ngenes)], values)
+        path = tmp_path / f'{name}.csv.num'
+        with open(path, 'w') as f:
+            f.writelines('\t'.join([x] + [str(v) for v in row]) + '\n' for x, row in zip(*rows))
+        return str(path)
+    return make
+
+
+@pytest.fixture
+def transitions(tmp_path):
+    """transitions(*args) -> (stdout, stderr) of cotr_transitions.py, without caches"""
+
+    def run(*args, check=True):
+        done = subprocess.run([sys.executable, os.path.join(ROOT, 'cotr_transitions.py'), '--cache', 'none',
+                               '--ptable', 'none', *map(str, args)], capture_output=True, text=True, cwd=tmp_path)
+        if check and done.returncode:
+            raise AssertionError(done.stderr)
+        return done.stdout, done.stderr
+    return run
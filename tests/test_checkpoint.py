@@ -0,0 +1,84 @@
+# coding: utf-8
+#
+# Checkpointed runs of cotr_transitions.py (--checkpoint with --resume,
+# --shard/--merge and --update) against the output of a single run
+#
+import numpy as np
+import pytest
+
+FISHER = ['--fisher', '-p', '0.05', '-m', '2', '--block_size', '6']
+
+
+def summary(stderr):
+    """pair counts of the run (tested pairs and whether pruned pairs are reported)"""
+    lines = stderr.splitlines()
+    return [x for x in lines if x.startswith('Gene pairs')], any(x.startswith('Pairs evaluated') for x in lines)
+
+
+@pytest.fixture
+def versions(table):
+    """paths of a table and of a later release (rows changed, removed, added)"""
+    rng = np.random.default_rng(4)
+    names = [f'{x}at0' for x in range(80)]
+    values = (rng.random((80, 36)) < rng.uniform(0.2, 0.8, (80, 1))).astype(int)
+    old = table('v1', rows=(names, values))
+    changed = values.copy()
+    changed[::9] = rng.permutation(changed[::9], axis=1)
+    keep = np.arange(80) % 13 != 5
+    extra = (rng.random((3, 36)) < 0.5).astype(int)
+    new = table('v2', rows=([x for x, k in zip(names, keep) if k] + ['new1', 'new2', 'new3'],
+                            np.vstack([changed[keep], extra])))
+    return old, new
+
+
+def test_resume(table, transitions):
+    path = table()
+    expected, _ = transitions(*FISHER, path)
+    transitions(*FISHER, '--checkpoint', 'ck', '--shard', '1/3', path) # as an interrupted run
+    out, err = transitions(*FISHER, '--checkpoint', 'ck', '--resume', path)
+    assert out == expected
+    assert 'blocks done' in err
+
+
+def test_resume_done(table, transitions):
+    path = table()
+    expected, _ = transitions(*FISHER, '--checkpoint', 'ck', path)
+    assert transitions(*FISHER, '--checkpoint', 'ck', '--resume', path)[0] == expected
+
+
+def test_shards_merge(table, transitions):
+    path = table()
+    expected, _ = transitions(*FISHER, path)
+    for shard in ('1/3', '2/3'):
+        transitions(*FISHER, '--checkpoint', 'ck', '--shard', shard, path)
+    failed = transitions(*FISHER, '--checkpoint', 'ck', '--merge', path, check=False)
+    assert failed[1] and 'blocks not done' in failed[1]
+    transitions(*FISHER, '--checkpoint', 'ck', '--shard', '3/3', path)
+    assert transitions(*FISHER, '--checkpoint', 'ck', '--merge', path)[0] == expected
+
+
+def test_checkpoint_other_parameters(table, transitions):
+    path = table()
+    transitions(*FISHER, '--checkpoint', 'ck', '--shard', '1/2', path)
+    _, err = transitions('--fisher', '-m', '3', '--checkpoint', 'ck', '--resume', path, check=False)
+    assert 'other inputs or parameters' in err
+
+
+@pytest.mark.parametrize('args', [FISHER, ['-m', '3'], ['--fisher', '-p', '1e-3', '--adjust', 'BH']])
+def test_update(versions, transitions, args):
+    old, new = versions
+    transitions(*args, '--checkpoint', 'ck1', old)
+    expected, full = transitions(*args, new)
+    out, err = transitions(*args, '--checkpoint', 'ck2', '--update', 'ck1', new)
+    assert out == expected
+    assert 'update: ' in err
+    assert summary(err) == summary(full)
+
+
+def test_update_chain(versions, transitions):
+    """an updated checkpoint can be updated in turn (back to the first release)"""
+    old, new = versions
+    transitions(*FISHER, '--checkpoint', 'ck1', old)
+    transitions(*FISHER, '--checkpoint', 'ck2', '--update', 'ck1', new)
+    expected, _ = transitions(*FISHER, old)
+    assert transitions(*FISHER, '--checkpoint', 'ck3', '--update', 'ck2', old)[0] == expected
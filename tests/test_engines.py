@@ -0,0 +1,79 @@
+# coding: utf-8
+#
+# Pairs of cotr_transitions.py (every concordance engine, blocks, workers)
+# against the original implementation (per-row loop and set intersections)
+#
+import numpy as np
+import pandas as pd
+import pytest
+
+import cotr_lib
+
+
+def baseline(path, min_transitions=0, count_consecutive=False):
+    """output rows of the original cotr_transitions.py"""
+    csv = pd.read_table(path, header=None, index_col=0, comment='#')
+    ngenes, norgs = len(csv.index), len(csv.columns)
+    tr_l = np.clip(np.diff(csv.values, axis=1), -1, 1).tolist() # csv.diff(axis=1) without its NaN column
+    if not count_consecutive:
+        for r in tr_l:
+            for i in range(len(r) - 1):
+                if r[i] + r[i + 1] == 0:
+                    r[i + 1] = 0
+    t01 = [set(np.nonzero(row > 0)[0]) for row in np.array(tr_l)]
+    t10 = [set(np.nonzero(row < 0)[0]) for row in np.array(tr_l)]
+    tt = [len(a | b) for a, b in zip(t01, t10)]
+    rows = []
+    for i in range(ngenes - 1):
+        for j in range(i + 1, ngenes):
+            concordant = len(t01[i] & t01[j]) + len(t10[i] & t10[j])
+            discordant = len(t10[i] & t01[j]) + len(t01[i] & t10[j])
+            k = concordant - discordant
+            if abs(k) >= min_transitions:
+                rows.append([str(x) for x in (csv.index[i], csv.index[j], norgs, tt[i], tt[j],
+                                              concordant, discordant, k)])
+    return rows
+
+
+def output_rows(text):
+    lines = text.splitlines()
+    assert lines[0].split('\t') == ['Orthogroup1', 'Orthogroup2', 'orgs', 't1', 't2', 'c', 'd', 'k']
+    return [line.split('\t') for line in lines[1:]]
+
+
+@pytest.mark.parametrize('backend', ('auto',) + cotr_lib.BACKENDS)
+@pytest.mark.parametrize('min_transitions, count_consecutive', [(0, False), (3, False), (0, True), (4, True)])
+def test_backends_match_baseline(table, transitions, backend, min_transitions, count_consecutive):
+    path = table()
+    args = ['-b', backend, '-m', min_transitions] + (['-c'] if count_consecutive else [])
+    out, _ = transitions(*args, path)
+    assert output_rows(out) == baseline(path, min_transitions, count_consecutive)
+
+
+@pytest.mark.parametrize('backend', cotr_lib.BACKENDS)
+def test_blocks_and_workers_match_baseline(table, transitions, backend):
+    path = table(ngenes=90, norgs=30, seed=1)
+    out, _ = transitions('-b', backend, '-m', 2, '--block_size', 7, '-w', 3, path)
+    assert output_rows(out) == baseline(path, 2)
+
+
+def test_sparse_rows_match_baseline(table, transitions):
+    """mostly absent rows (the sparse engine of the auto backend) and rows without transitions"""
+    rng = np.random.default_rng(2)
+    values = (rng.random((70, 120)) < 0.01).astype(int)
+    values[:5] = 0
+    values[5:10] = 1
+    path = table(rows=([f'{x}at0' for x in range(70)], values))
+    for backend in cotr_lib.BACKENDS:
+        out, _ = transitions('-b', backend, path)
+        assert output_rows(out) == baseline(path)
+
+
+def test_engines_block_pairs():
+    rng = np.random.default_rng(3)
+    tr = cotr_lib.transitions((rng.random((50, 25)) < 0.5).astype(int))
+    t01, t10 = cotr_lib.transition_matrices(tr)
+    pairs = [cotr_lib.block_pairs(cotr_lib.prepare(t01, t10, b), 0, 50, 50, 2) for b in cotr_lib.BACKENDS]
+    for other in pairs[1:]:
+        for a, b in zip(pairs[0], other):
+            assert np.array_equal(a, b)
@@ -0,0 +1,56 @@
+# coding: utf-8
+#
+# R-like number formatting (cotr_stats.format_r) and the TSV export of binary
+# pair tables (cotr_io.write_tsv) against the TSV written by cotr_transitions.py
+#
+import io
+
+import numpy as np
+import pytest
+
+import cotr_io
+import cotr_stats
+
+
+@pytest.mark.parametrize('values, expected', [
+    ([0.025, 1], ['0.025', '1.000']),  # format(c(0.025, 1), digits=5)
+    ([0.123456789], ['0.12346']),
+    ([-1.5, 2], ['-1.5', '2.0']),
+    ([1e-10, 0.5], ['1e-10', '5e-01']),
+    ([1e-120, 1], ['1e-120', '1e+00']),
+    ([123456.7, 0.5], ['123456.7', '0.5']),
+    ([0, 0.5], ['0.0', '0.5']),
+    ([np.nan, np.inf, 1], ['NaN', 'Inf', '1']),
+])
+def test_format_r_values(values, expected):
+    assert cotr_stats.format_r(values) == expected
+
+
+@pytest.mark.parametrize('scale', [1, 1e-3, 1e-30, 1e5])
+def test_format_r_round_trip(scale):
+    """formatted values read back as the values to 5 significant digits"""
+    rng = np.random.default_rng(5)
+    x = np.concatenate([rng.random(200) * scale, 10 ** rng.uniform(-8, 0, 50) * scale, [0.0, scale]])
+    back = np.array([float(v) for v in cotr_stats.format_r(x)])
+    assert np.allclose(back, x, rtol=5e-5, atol=0)
+
+
+def test_format_r_spec_of_chunks():
+    """a column formatted by chunks with the spec of all of them is formatted as a whole"""
+    rng = np.random.default_rng(6)
+    x = np.concatenate([rng.random(100), 10 ** rng.uniform(-12, -3, 100), [1.0]])
+    spec = None
+    for s in range(0, len(x), 30):
+        spec = cotr_stats.format_r_spec(x[s:s + 30], spec=spec)
+    chunks = sum((cotr_stats.format_r(x[s:s + 30], spec=spec) for s in range(0, len(x), 30)), [])
+    assert chunks == cotr_stats.format_r(x)
+
+
+@pytest.mark.parametrize('chunk', [5, 1 << 20])
+def test_write_tsv_matches_direct_tsv(table, transitions, tmp_path, chunk):
+    path = table(ngenes=80, seed=7)
+    expected, _ = transitions('--fisher', '-p', '0.2', path)
+    transitions('--fisher', '-p', '0.2', '-o', 'pairs', path)
+    out = io.StringIO()
+    cotr_io.write_tsv(str(tmp_path / 'pairs'), out, chunk=chunk)
+    assert out.getvalue() == expected
@@ -0,0 +1,98 @@
+# coding: utf-8
+#
+# Fisher p-values and multiple-test corrections of cotr_stats against scipy
+# and R (p.adjust) reference values
+#
+import numpy as np
+import pytest
+from scipy import stats
+
+import cotr_stats
+
+P = np.array([0.01, 0.04, 0.03, 0.005, 0.2])
+
+
+def holm_reference(p):
+    """Holm adjusted p-values from the definition (step-down, running maximum)"""
+    order = np.argsort(p, kind='stable')
+    adj, top = np.empty(len(p)), 0.0
+    for rank, n in enumerate(order):
+        top = max(top, (len(p) - rank) * p[n])
+        adj[n] = min(1.0, top)
+    return adj
+
+
+def random_p(n=500, seed=0):
+    rng = np.random.default_rng(seed)
+    p = np.concatenate([rng.random(n) ** 4, rng.choice([1e-6, 0.01, 0.5, 1.0], 50)]) # ties
+    return rng.permutation(p)
+
+
+def test_holm_r_values():
+    # p.adjust(c(0.01, 0.04, 0.03, 0.005, 0.2), "holm")
+    assert np.allclose(cotr_stats.holm(P), [0.04, 0.09, 0.09, 0.025, 0.2])
+
+
+def test_bh_r_values():
+    # p.adjust(c(0.01, 0.04, 0.03, 0.005, 0.2), "BH")
+    assert np.allclose(cotr_stats.bh(P), [0.025, 0.05, 0.05, 0.025, 0.2])
+
+
+def test_holm_reference():
+    p = random_p()
+    assert np.allclose(cotr_stats.holm(p), holm_reference(p), rtol=1e-12)
+
+
+def test_bh_scipy():
+    p = random_p()
+    assert np.allclose(cotr_stats.bh(p), stats.false_discovery_control(p, method='bh'), rtol=1e-12)
+
+
+def test_adjust_of_smallest_p():
+    """m tests of which only the smallest p-values are passed"""
+    p = np.sort(random_p())
+    passed, limit = p[:200], p[200]
+    assert np.allclose(cotr_stats.holm(passed, len(p)), cotr_stats.holm(p)[:200], rtol=1e-12)
+    adj, full = cotr_stats.bh(passed, len(p)), cotr_stats.bh(p)[:200]
+    exact = full < limit
+    assert exact.any() and np.allclose(adj[exact], full[exact], rtol=1e-12)
+
+
+@pytest.mark.parametrize('method', tuple(cotr_stats.ADJUST))
+def test_sorted_adjust_by_chunks(method):
+    p = np.sort(random_p())
+    adjust = cotr_stats.SortedAdjust(len(p), method)
+    q = np.concatenate([adjust(p[s:s + 37]) for s in range(0, len(p), 37)])
+    assert np.allclose(adjust.finish(q, chunk=50), cotr_stats.ADJUST[method](p), rtol=1e-12)
+
+
+@pytest.mark.parametrize('orgs, tmax', [(12, 12), (40, 25), (200, 60)])
+def test_pvalue_table_scipy(orgs, tmax):
+    table = cotr_stats.PValueTable(orgs, tmax)
+    t1, t2 = (x.ravel() for x in np.meshgrid(np.arange(tmax + 1), np.arange(tmax + 1)))
+    t1, t2 = np.repeat(t1, tmax + 1), np.repeat(t2, tmax + 1)
+    k = np.tile(np.arange(tmax + 1), (tmax + 1) ** 2)
+    ok = k <= np.minimum(t1, t2)
+    k, t1, t2 = k[ok], t1[ok], t2[ok]
+    # P(X >= k), X hypergeometric (orgs, t2, t1 draws); no valid 2x2 table (fisher.pval errors): 1
+    expected = np.where((k > 0) & (t1 + t2 - k <= orgs), stats.hypergeom.sf(k - 1, orgs, t2, t1), 1)
+    assert np.allclose(table(k, t1, t2), expected, rtol=1e-9, atol=0)
+    assert np.allclose(table(-k, t1, t2), expected, rtol=1e-9, atol=0)
+
+
+def test_pvalue_table_kmin():
+    table = cotr_stats.PValueTable(40, 25)
+    kmin = table.kmin(1e-3)
+    for t1 in range(26):
+        for t2 in range(26):
+            passing = [k for k in range(min(t1, t2) + 1) if table(k, t1, t2) <= 1e-3]
+            assert kmin[t1, t2] == (passing[0] if passing else min(t1, t2) + 1)
+
+
+def test_pvalue_table_saved(tmp_path):
+    first = cotr_stats.PValueTable(50, 30, str(tmp_path / 'tables'))
+    assert sorted(x.name for x in (tmp_path / 'tables').iterdir()) == [
+        'cotr_pvalues.50.30.offsets.npy', 'cotr_pvalues.50.30.values.npy']
+    again, smaller = (cotr_stats.PValueTable(50, t, str(tmp_path / 'tables')) for t in (30, 20))
+    assert isinstance(again.values, np.memmap) and smaller.tmax == 30
+    assert np.array_equal(again.values, first.values) and np.array_equal(again.offsets, first.offsets)